@@ -0,0 +1,69 @@
+"""
+Tiled raster export against a single-process render of the same frame.
+
+    python benchmarks/export_tiles.py [--workers N ...] [--dpi DPI]
+
+Draws circles, rectangles and polylines straddling every tile corner,
+plus a ring of circles, and renders the export with one worker and with
+each given worker count. Reports the time of each and exits with an
+error if any tiled render differs from the single one by a pixel.
+"""
+import os
+import sys
+import time
+import argparse
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+def scene(frame, workers):
+    """Layer elements with shapes on each corner of the tiles an export with the most workers uses."""
+    elements = main.empty_elements()
+    for i in range(12):
+        angle = 2 * np.pi * i / 12
+        elements['circles'].append(main.CircleShape(150 + 50 * np.cos(angle), 150 + 50 * np.sin(angle), 5,
+                                                    'green', True))
+
+    renderer = main.ExportRenderer(workers)
+    fig, ax, _ = main.build_frame(frame)
+    to_data = ax.transData.inverted()
+    height = fig.canvas.get_renderer().height
+    for _, _, right, bottom in renderer.tiles(renderer.window(fig), workers):
+        x, y = to_data.transform((right, height - bottom))
+        elements['circles'].append(main.CircleShape(x, y, 3, 'blue', True))
+        elements['rectangles'].append(main.RectangleShape(x - 2, x + 2, y - 6, y - 4, 'red'))
+        elements['polylines'].append(main.PolylineShape([(x - 3, y + 3), (x, y + 5), (x + 3, y + 3)], 'black'))
+    return elements
+
+def run():
+    parser = argparse.ArgumentParser(description="Check tiled exports against single-process ones")
+    parser.add_argument("--workers", type=int, nargs='+', default=[2, 3, 4, 7], help="worker counts to compare")
+    parser.add_argument("--dpi", type=int, default=300)
+    args = parser.parse_args()
+
+    # Tile even this small scene
+    main.EXPORT_PARALLEL_SHAPES = 0
+    frame = main.ExportFrame((8, 6), args.dpi, (0.125, 0.11, 0.775, 0.77), (0, 300), (0, 300), 'Project: bench', None)
+
+    failed = False
+    for workers in args.workers:
+        layers = [scene(frame, workers)]
+        start = time.perf_counter()
+        single = main.ExportRenderer(1).render(frame, layers)
+        middle = time.perf_counter()
+        tiled = main.ExportRenderer(workers).render(frame, layers)
+        end = time.perf_counter()
+
+        diff = np.abs(single.astype(int) - tiled.astype(int)).max(axis=2)
+        count = int((diff > 0).sum())
+        failed |= count > 0
+        print(f"{workers} workers: single {middle - start:.2f} s, tiled {end - middle:.2f} s, "
+              f"{count} pixels differ (max {diff.max()})")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    run()
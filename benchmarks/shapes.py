@@ -0,0 +1,66 @@
+"""
+Memory and access cost of shapes stored as slotted Shape objects, against
+the plain dicts layers held them in before.
+
+    python benchmarks/shapes.py [--count N]
+
+Memory is measured with tracemalloc while the shapes are built; access
+time is a loop summing the four coordinates of every rectangle, the
+pattern of the renderers and selection code.
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+def rectangle_dict(i):
+    return {'x1': i * 0.5, 'x2': i * 0.5 + 10, 'y1': i * 0.25, 'y2': i * 0.25 + 5,
+            'color': 'red', 'filled': False}
+
+def rectangle_shape(i):
+    return main.RectangleShape(i * 0.5, i * 0.5 + 10, i * 0.25, i * 0.25 + 5, 'red')
+
+def sum_dicts(shapes):
+    return sum(s['x1'] + s['x2'] + s['y1'] + s['y2'] for s in shapes)
+
+def sum_shapes(shapes):
+    return sum(s.x1 + s.x2 + s.y1 + s.y2 for s in shapes)
+
+def measure(make, total, count, repeat):
+    # Built once untraced for timing, then again under tracemalloc for size
+    start = time.perf_counter()
+    shapes = [make(i) for i in range(count)]
+    build = time.perf_counter() - start
+    del shapes
+
+    tracemalloc.start()
+    shapes = [make(i) for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    access = min(timed(total, shapes) for _ in range(repeat))
+    return size / count, build / count * 1e9, access / count * 1e9
+
+def timed(function, shapes):
+    start = time.perf_counter()
+    function(shapes)
+    return time.perf_counter() - start
+
+def run():
+    parser = argparse.ArgumentParser(description="Compare slotted shapes with dict elements")
+    parser.add_argument("--count", type=int, default=200000, help="rectangles per representation")
+    parser.add_argument("--repeat", type=int, default=5, help="access loops, the fastest is reported")
+    args = parser.parse_args()
+
+    print(f"{args.count} rectangles")
+    print(f"{'':8}{'bytes/shape':>12}{'build ns':>10}{'access ns':>11}")
+    for label, make, total in (("dict", rectangle_dict, sum_dicts), ("slots", rectangle_shape, sum_shapes)):
+        size, build, access = measure(make, total, args.count, args.repeat)
+        print(f"{label:8}{size:12.0f}{build:10.0f}{access:11.0f}")
+
+if __name__ == "__main__":
+    run()
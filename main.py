@@ -2,19 +2,112 @@ import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog, filedialog
 import os
 import json
+import re
+import io
+import gzip
+import glob
+import bisect
 import uuid
+import time
+import queue
+import asyncio
+import threading
+import contextlib
+import copy
+import functools
+import operator
+import itertools
+import math
+import shutil
+import hashlib
+import sys
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, namedtuple
+import xml.etree.ElementTree as ET
+import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.backends.backend_agg import FigureCanvasAgg, RendererAgg
+from matplotlib.artist import Artist
+from matplotlib.font_manager import FontProperties
 from matplotlib.patches import Rectangle, Circle
 from matplotlib.lines import Line2D
+from matplotlib.collections import PathCollection, EllipseCollection
+from matplotlib.path import Path
+from matplotlib.image import AxesImage
+from matplotlib.colors import is_color_like, to_rgba
+from matplotlib.transforms import Bbox
+from matplotlib.axis import Axis
+from matplotlib.backend_bases import MouseEvent, ResizeEvent, MouseButton
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Use a class to manage global state more safely
+ELEMENT_TYPES = ('rectangles', 'lines', 'circles', 'texts', 'polylines')
+
+# Numeric fields of each element type, and which of them are x or y coordinates.
+# Polylines keep their vertices in an array; their fields here are its bounding box
+ELEMENT_COORDS = {
+    'rectangles': ('x1', 'x2', 'y1', 'y2'),
+    'lines': ('x1', 'y1', 'x2', 'y2'),
+    'circles': ('x', 'y', 'radius'),
+    'texts': ('x1', 'x2', 'y1', 'y2'),
+    'polylines': ('x1', 'x2', 'y1', 'y2')
+}
+X_COLUMNS = {'rectangles': [0, 1], 'lines': [0, 2], 'circles': [0], 'texts': [0, 1], 'polylines': [0, 1]}
+Y_COLUMNS = {'rectangles': [2, 3], 'lines': [1, 3], 'circles': [1], 'texts': [2, 3], 'polylines': [2, 3]}
+
+# ZiggleScript commands that expand into many shapes
+GENERATOR_COMMANDS = ("REPEAT", "GRID", "ARRAY")
+
+# Localhost port of the ZiggleScript command server (override with ZIGGLE_PORT)
+DEFAULT_COMMAND_PORT = 7455
+
+# Edit history kept in memory before older blocks are spilled to disk (override with ZIGGLE_HISTORY_MB)
+HISTORY_MEMORY_BUDGET = int(os.environ.get("ZIGGLE_HISTORY_MB", 64)) * 1024 * 1024
+
+# Long side in pixels of the preview image saved with a project
+PREVIEW_SIZE = 224
+
+# Rendered zoom-pyramid tiles kept for all layers together (override with ZIGGLE_TILE_MB)
+TILE_MEMORY_BUDGET = int(os.environ.get("ZIGGLE_TILE_MB", 96)) * 1024 * 1024
+
+# Grid in canvas millimetres that compressed project files round coordinates to
+# (override with ZIGGLE_STORAGE_GRID)
+STORAGE_GRID = float(os.environ.get("ZIGGLE_STORAGE_GRID", 0.01))
+
+# Saved previews and exports kept on disk for reuse (override with ZIGGLE_RENDER_CACHE_MB)
+RENDER_CACHE_DIR = "render_cache"
+RENDER_CACHE_BUDGET = int(os.environ.get("ZIGGLE_RENDER_CACHE_MB", 64)) * 1024 * 1024
+
+# Worker processes drawing the tiles of raster exports (override with ZIGGLE_EXPORT_WORKERS).
+# Scenes of fewer shapes are exported in one piece in this process, which is
+# faster than starting on the pool.
+EXPORT_WORKERS = int(os.environ.get("ZIGGLE_EXPORT_WORKERS", os.cpu_count() or 1))
+EXPORT_PARALLEL_SHAPES = 20000
+
+# Canvas events a recorded session captures
+SESSION_EVENTS = ('button_press_event', 'motion_notify_event', 'button_release_event', 'scroll_event', 'resize_event')
+
+# Export file types drawn by the tiled renderer; other types are saved by matplotlib
+RASTER_EXPORT_FORMATS = ('', '.png', '.jpg', '.jpeg', '.tif', '.tiff', '.webp')
+
+# Screen pixels a simplified freehand stroke may stray from the pointer's path
+FREEHAND_TOLERANCE = float(os.environ.get("ZIGGLE_FREEHAND_TOLERANCE", 0.75))
+
+# Threads shared by all open projects for loading, importing and saving files
+# (override with ZIGGLE_BACKGROUND_WORKERS)
+BACKGROUND_WORKERS = int(os.environ.get("ZIGGLE_BACKGROUND_WORKERS", 4))
+background_pool = ThreadPoolExecutor(BACKGROUND_WORKERS, thread_name_prefix="ziggle")
+
+# Drawing state of one open project
 class ZiggleState:
     def __init__(self):
         self.fig = None
@@ -23,10 +116,95 @@ class ZiggleState:
         self.height = 0
         self.undo_stack = []
         self.redo_stack = []
+        self.project = None
 
-# Create a singleton instance of the state
+# State of the project in the front tab, which ZiggleScript commands act on
 ziggle_state = ZiggleState()
 
+class Workspace:
+    """
+    The open projects, one notebook tab each. Only the project in the front
+    tab keeps its artists and background tile rendering; the others are
+    suspended until their tab is shown again.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.notebook = None
+        self.projects = []
+        self.current = None
+        self.command_server = None
+
+    def add_tab(self, project):
+        """Return a new tab frame for the project, replacing the landing page with the notebook on first use."""
+        if self.notebook is None:
+            self.root = project.root
+            for widget in self.root.winfo_children():
+                widget.destroy()
+            self.notebook = ttk.Notebook(self.root)
+            self.notebook.pack(fill=tk.BOTH, expand=True)
+            self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+        frame = tk.Frame(self.notebook, bg='#f0f4f8')
+        self.notebook.add(frame, text=project.project_name)
+        return frame
+
+    def open(self, project):
+        self.projects.append(project)
+        self.activate(project)
+
+    def activate(self, project):
+        """Bring a project to the front, suspending the one it replaces."""
+        global ziggle_state
+        if project is self.current:
+            return
+        if self.current is not None:
+            self.current.suspend()
+        self.current = project
+        ziggle_state = project.state
+        project.resume()
+
+    def on_tab_changed(self, event):
+        selected = self.notebook.select()
+        for project in self.projects:
+            if project.tab_frame is not None and str(project.tab_frame) == selected:
+                self.activate(project)
+                return
+
+    def close(self, project):
+        """Remove a project's tab; closing the last one brings back the landing page."""
+        global ziggle_state
+        if project.recorder is not None:
+            project.recorder.close()
+            project.recorder = None
+        project.suspend()
+        for layer in project.layers:
+            # Its tiles would only crowd the other projects' out of the shared cache
+            layer.cache.pyramid.forget()
+        self.projects.remove(project)
+        if self.current is project:
+            self.current = None
+        if project.tab_frame is not None:
+            self.notebook.forget(project.tab_frame)
+            project.tab_frame.destroy()
+        if self.projects:
+            self.activate(self.projects[-1])
+            return
+        ziggle_state = ZiggleState()
+        if self.notebook is not None:
+            self.notebook.destroy()
+            self.notebook = None
+            ask_for_project_details(self.root)
+
+    def shutdown(self):
+        """Stop the background reads of open projects once the window is gone; pending saves still finish."""
+        for project in self.projects:
+            for job in (project.svg_import, project.project_load):
+                if job is not None:
+                    job.cancel()
+        background_pool.shutdown(wait=True)
+
+workspace = Workspace()
+
 class GraphPlot:
     def __init__(self, root, project_name, project_id, width_val, height_val):
         self.root = root
@@ -42,6 +220,9 @@ class GraphPlot:
         
         # Temporary preview element
         self.preview_element = None
+
+        # Freehand stroke or polyline being drawn, as a StrokeSimplifier
+        self.stroke = None
         
         # Text input variables
         self.text_input_dialog = None
@@ -54,15 +235,62 @@ class GraphPlot:
         self.max_zoom_out = 1.0  # Default max zoom out level
         self.min_zoom_in = 10.0  # Default min zoom in level
 
-        # Project elements tracking with undo/redo support
-        self.project_elements = {
-            'rectangles': [],
-            'lines': [],
-            'circles': [],
-            'texts': []
-        }
-        self.undo_stack = []
-        self.redo_stack = []
+        # Compositing mode: each layer's shapes live in one off-screen raster
+        self.use_raster_cache = True
+
+        # Drop duplicate and degenerate shapes whenever the project is saved
+        self.compact_on_save = False
+
+        # Save coordinates rounded to storage_grid, packed and gzipped
+        self.compressed_storage = False
+        self.storage_grid = STORAGE_GRID
+
+        # Layers, each tracking its own elements, and the edit history across them
+        self.layers = [Layer("Layer 1")]
+        self.active_layer = self.layers[0]
+        self.history = EditHistory(self.history_dir())
+
+        # Raster paints deferred while a batch of commands is applied
+        self.paint_batch = None
+
+        # Scene digest for render caching, with the history state it was taken at
+        self.digest_state = None
+        self.digest = None
+
+        # Canvas events are written here while a session is being recorded
+        self.recorder = None
+
+        # Background SVG import, project load and ZiggleScript program, if running
+        self.svg_import = None
+        self.project_load = None
+        self.script_job = None
+
+        # Pending tile rendering slice, and exact render once the view settles
+        self.tile_pump_id = None
+        self.exact_view_id = None
+
+        # Screen area changed by edits, redrawn and blitted once Tk is idle
+        self.dirty_region = None
+        self.dirty_flush_id = None
+
+        # Selected element indices per type, within selection_layer
+        self.selection = {}
+        self.selection_layer = None
+        self.selection_artist = None
+
+        # This project's own figure and script undo stacks; ZiggleScript
+        # commands draw into its active layer while its tab is in front
+        self.state = ZiggleState()
+        self.state.project = self
+        self.state.width, self.state.height = width_val, height_val
+
+        # Notebook tab holding the layout, and whether the project is behind another tab
+        self.tab_frame = None
+        self.suspended = False
+
+        # Background write of the last save, if one was started
+        self.save_future = None
+        workspace.open(self)
 
         # Create the main application layout
         self.create_layout()
@@ -70,59 +298,155 @@ class GraphPlot:
         # Try to load existing project state
         self.load_project_state()
 
+    @property
+    def project_elements(self):
+        return self.active_layer.elements
+
     def undo_last_action(self):
-        if not self.project_elements:
-            return
-
-        # Determine which list to remove from based on the last added element
-        if self.project_elements['rectangles']:
-            removed_element = self.project_elements['rectangles'].pop()
-            action_type = 'rectangles'
-        elif self.project_elements['lines']:
-            removed_element = self.project_elements['lines'].pop()
-            action_type = 'lines'
-        elif self.project_elements['circles']:
-            removed_element = self.project_elements['circles'].pop()
-            action_type = 'circles'
-        elif self.project_elements['texts']:
-            removed_element = self.project_elements['texts'].pop()
-            action_type = 'texts'
-        else:
+        action = self.history.undo_action()
+        if action is None:
             return
 
-        # Add to undo stack for potential redo
-        self.redo_stack.append({
-            'type': action_type,
-            'element': removed_element
-        })
+        layer = self.get_layer(action['layer']) or self.active_layer
+        if layer.locked:
+            return
 
-        # Redraw everything
-        self.redraw_project_elements()
+        apply_action(layer, action, reverse=True)
+        self.history.cursor -= 1
+        self.clear_selection()
+
+        # Only the area the action touched needs re-rendering
+        self.redraw_layer(layer, action)
 
     def redo_last_action(self):
-        if not self.redo_stack:
+        action = self.history.redo_action()
+        if action is None:
             return
 
-        # Get the last undone action
-        last_action = self.redo_stack.pop()
-        
-        # Restore the element to its original list
-        action_type = last_action['type']
-        element = last_action['element']
-        
-        # Add back to the corresponding list
-        self.project_elements[action_type].append(element)
+        layer = self.get_layer(action['layer']) or self.active_layer
+        if layer.locked:
+            return
+
+        apply_action(layer, action)
+        self.history.cursor += 1
+        self.clear_selection()
+
+        self.redraw_layer(layer, action)
+
+    def record_action(self, action):
+        """Append an action to the edit history, dropping anything that could be redone."""
+        self.history.record(action, self.history_snapshot)
 
-        # Redraw everything
+    def history_snapshot(self):
+        # Shapes are immutable, so copying the lists is enough
+        return {
+            layer.id: {element_type: list(layer.elements[element_type]) for element_type in ELEMENT_TYPES}
+            for layer in self.layers
+        }
+
+    def element_count(self):
+        return sum(len(layer.elements[element_type]) for layer in self.layers for element_type in ELEMENT_TYPES)
+
+    def history_dir(self):
+        return os.path.join("project", self.project_name, "history")
+
+    def goto_history(self, position):
+        """
+        Jump to any point in the edit history. Restores the nearest snapshot
+        when that is closer than stepping from the current position, then
+        replays only the deltas in between.
+        """
+        if self.svg_import is not None:
+            raise ValueError("Wait for the SVG import to finish")
+        if self.project_load is not None:
+            raise ValueError("Wait for the project to finish loading")
+
+        history = self.history
+        position = max(0, min(position, history.count))
+
+        block = history.block_for(position)
+        if block is not None and position - block['start'] < abs(position - history.cursor):
+            snapshot = history.snapshot_of(block)
+            for layer in self.layers:
+                elements = snapshot.get(layer.id, {})
+                for element_type in ELEMENT_TYPES:
+                    layer.elements[element_type][:] = elements.get(element_type, [])
+                    layer.indexes[element_type].reset()
+            history.cursor = block['start']
+
+        while history.cursor > position:
+            action = history.action_at(history.cursor - 1)
+            apply_action(self.get_layer(action['layer']) or self.active_layer, action, reverse=True)
+            history.cursor -= 1
+        while history.cursor < position:
+            action = history.action_at(history.cursor)
+            apply_action(self.get_layer(action['layer']) or self.active_layer, action)
+            history.cursor += 1
+
+        for layer in self.layers:
+            layer.cache.pyramid.forget()
+        self.clear_selection()
         self.redraw_project_elements()
 
+    def open_history_dialog(self):
+        dialog = tk.Toplevel(self.root)
+        dialog.title("History")
+        dialog.geometry("360x140")
+
+        position_var = tk.IntVar(value=self.history.cursor)
+        label = tk.Label(dialog, text=f"Step {self.history.cursor} of {self.history.count}")
+        label.pack(pady=5)
+
+        scale = tk.Scale(dialog, from_=0, to=self.history.count, orient=tk.HORIZONTAL,
+                         variable=position_var, length=320)
+        scale.pack(padx=10)
+
+        def go():
+            self.goto_history(position_var.get())
+            label.config(text=f"Step {self.history.cursor} of {self.history.count}")
+
+        tk.Button(dialog, text="Go", command=go).pack(pady=5)
+
     def on_mouse_press(self, event):
-        if event.inaxes != ziggle_state.ax:
+        if event.inaxes != self.state.ax:
             return
 
         # Store the starting coordinates
         self.start_x, self.start_y = event.xdata, event.ydata
+
+        # A polyline left open when another tool was picked ends here
+        if self.stroke is not None and self.current_tool != 'polyline':
+            self.finish_stroke()
+
+        # Panning works in pixels so repeated callbacks stay idempotent
+        if self.current_tool == 'pan':
+            self.pan_start = (event.x, event.y,
+                              self.state.ax.get_xlim(), self.state.ax.get_ylim())
+            return
+
+        if self.current_tool in ('rectangle', 'line', 'circle', 'text', 'freehand', 'polyline') and self.active_layer.locked:
+            self.drawing_mode = False
+            messagebox.showwarning("Layer Locked", f"Layer '{self.active_layer.name}' is locked")
+            return
         
+        if self.current_tool == 'freehand':
+            self.stroke = StrokeSimplifier(self.start_x, self.start_y, self.stroke_tolerance())
+            self.show_stroke()
+            return
+
+        if self.current_tool == 'polyline':
+            # Clicks add vertices; a double or right click ends the polyline
+            if event.dblclick or event.button == MouseButton.RIGHT:
+                if self.stroke is not None:
+                    self.finish_stroke()
+            elif self.stroke is None:
+                self.stroke = StrokeSimplifier(self.start_x, self.start_y, 0.0)
+                self.show_stroke()
+            else:
+                self.stroke.add(self.start_x, self.start_y)
+                self.show_stroke()
+            return
+
         # Handle text tool specifically
         if self.current_tool == 'text':
             # Remove any existing preview
@@ -133,36 +457,21 @@ class GraphPlot:
             # Only place text if we have input
             if self.current_text:
                 # Create text element
-                text_data = {
-                    'x1': self.start_x,
-                    'x2': self.start_x,  # For text, x1 and x2 are the same
-                    'y1': self.start_y,
-                    'y2': self.start_y,  # For text, y1 and y2 are the same
-                    'text': self.current_text,
-                    'color': self.current_color,
-                    'font_size': self.current_font_size
-                }
-                self.project_elements['texts'].append(text_data)
-                
-                # Place the text
-                create_text(
-                    self.start_x, self.start_x, 
-                    self.start_y, self.start_y, 
-                    self.current_text, 
-                    self.current_color, 
-                    self.current_font_size
+                text_data = TextShape(
+                    x1=self.start_x,
+                    x2=self.start_x,  # For text, x1 and x2 are the same
+                    y1=self.start_y,
+                    y2=self.start_y,  # For text, y1 and y2 are the same
+                    text=self.current_text,
+                    color=self.current_color,
+                    font_size=self.current_font_size
                 )
+                self.commit_element('texts', text_data)
 
                 # Reset text-related variables
                 self.current_text = ""
                 self.current_tool = None
                 self.drawing_mode = False
-
-                # Clear redo stack
-                self.redo_stack.clear()
-
-                # Redraw canvas
-                ziggle_state.fig.canvas.draw_idle()
         else:
             # Existing press handling for other tools
             self.drawing_mode = True
@@ -173,7 +482,24 @@ class GraphPlot:
                 self.preview_element = None
 
     def on_mouse_move(self, event):
-        if not self.drawing_mode or event.inaxes != ziggle_state.ax:
+        if event.inaxes != self.state.ax:
+            return
+
+        if self.current_tool == 'pan':
+            if self.pan_start:
+                self.pan_to(event)
+            return
+
+        if self.stroke is not None:
+            if self.current_tool == 'freehand':
+                self.stroke.add(event.xdata, event.ydata)
+                self.show_stroke()
+            else:
+                # Rubber band from the last vertex to the pointer
+                self.show_stroke((event.xdata, event.ydata))
+            return
+
+        if not self.drawing_mode:
             return
 
         # Remove previous preview if exists
@@ -185,9 +511,9 @@ class GraphPlot:
         curr_x, curr_y = event.xdata, event.ydata
 
         # Create preview based on current tool
-        if self.current_tool == 'rectangle':
+        if self.current_tool in ('rectangle', 'select'):
             # Preview rectangle
-            self.preview_element = ziggle_state.ax.add_patch(
+            self.preview_element = self.state.ax.add_patch(
                 plt.Rectangle(
                     (min(self.start_x, curr_x), min(self.start_y, curr_y)), 
                     abs(curr_x - self.start_x), 
@@ -200,7 +526,7 @@ class GraphPlot:
         
         elif self.current_tool == 'line':
             # Preview line
-            self.preview_element, = ziggle_state.ax.plot(
+            self.preview_element, = self.state.ax.plot(
                 [self.start_x, curr_x], 
                 [self.start_y, curr_y], 
                 color=self.current_color, 
@@ -210,7 +536,7 @@ class GraphPlot:
         elif self.current_tool == 'circle':
             # Preview circle
             radius = ((curr_x - self.start_x)**2 + (curr_y - self.start_y)**2)**0.5
-            self.preview_element = ziggle_state.ax.add_patch(
+            self.preview_element = self.state.ax.add_patch(
                 plt.Circle(
                     (self.start_x, self.start_y), 
                     radius, 
@@ -221,78 +547,875 @@ class GraphPlot:
             )
 
         # Refresh the canvas to show preview
-        ziggle_state.fig.canvas.draw_idle()
+        self.state.fig.canvas.draw_idle()
 
     def on_mouse_release(self, event):
-        if event.inaxes != ziggle_state.ax:
+        if self.current_tool == 'pan':
+            self.pan_start = None
+            return
+
+        if self.current_tool == 'freehand':
+            # The stroke ends wherever the button comes up, even outside the axes
+            if self.stroke is not None:
+                if event.inaxes == self.state.ax:
+                    self.stroke.add(event.xdata, event.ydata)
+                self.finish_stroke()
+            return
+        if self.current_tool == 'polyline':
+            return
+
+        if event.inaxes != self.state.ax:
             return
 
         if not self.drawing_mode:
             return
+        if self.current_tool != 'select' and self.active_layer.locked:
+            return
 
         # Remove preview element
         if self.preview_element:
+            bounds = artist_bounds(self.preview_element)
             self.preview_element.remove()
             self.preview_element = None
+            self.mark_dirty(bounds)
 
         end_x, end_y = event.xdata, event.ydata
+
+        if self.current_tool == 'select':
+            self.select(box=(
+                min(self.start_x, end_x), max(self.start_x, end_x),
+                min(self.start_y, end_y), max(self.start_y, end_y)
+            ))
         
-        if self.current_tool == 'rectangle':
-            rect_data = {
-                'x1': min(self.start_x, end_x), 
-                'x2': max(self.start_x, end_x), 
-                'y1': min(self.start_y, end_y), 
-                'y2': max(self.start_y, end_y), 
-                'color': self.current_color,
-                'filled': False
-            }
-            self.project_elements['rectangles'].append(rect_data)
-            create_rectangle(
-                min(self.start_x, end_x), 
-                max(self.start_x, end_x), 
-                min(self.start_y, end_y), 
-                max(self.start_y, end_y), 
-                self.current_color
+        elif self.current_tool == 'rectangle':
+            rect_data = RectangleShape(
+                x1=min(self.start_x, end_x),
+                x2=max(self.start_x, end_x),
+                y1=min(self.start_y, end_y),
+                y2=max(self.start_y, end_y),
+                color=self.current_color,
+                filled=False
             )
-            
-            # Clear redo stack when a new action is performed
-            self.redo_stack.clear()
+            self.commit_element('rectangles', rect_data)
         
         elif self.current_tool == 'line':
-            line_data = {
-                'x1': self.start_x, 
-                'y1': self.start_y, 
-                'x2': end_x, 
-                'y2': end_y, 
-                'color': self.current_color
-            }
-            self.project_elements['lines'].append(line_data)
-            create_line(self.start_x, self.start_y, end_x, end_y, 
-                        self.current_color)
-            
-            # Clear redo stack when a new action is performed
-            self.redo_stack.clear()
+            line_data = LineShape(
+                x1=self.start_x,
+                y1=self.start_y,
+                x2=end_x,
+                y2=end_y,
+                color=self.current_color
+            )
+            self.commit_element('lines', line_data)
         
         elif self.current_tool == 'circle':
             radius = ((end_x - self.start_x)**2 + (end_y - self.start_y)**2)**0.5
-            circle_data = {
-                'x': self.start_x, 
-                'y': self.start_y, 
-                'radius': radius, 
-                'color': self.current_color,
-                'filled': False
-            }
-            self.project_elements['circles'].append(circle_data)
-            create_circle(self.start_x, self.start_y, radius, 
-                          self.current_color)
-            
-            # Clear redo stack when a new action is performed
-            self.redo_stack.clear()
+            circle_data = CircleShape(
+                x=self.start_x,
+                y=self.start_y,
+                radius=radius,
+                color=self.current_color,
+                filled=False
+            )
+            self.commit_element('circles', circle_data)
         
         # Reset drawing mode
         self.drawing_mode = False
-        
-        ziggle_state.fig.canvas.draw_idle()
+
+    def stroke_tolerance(self):
+        # FREEHAND_TOLERANCE screen pixels in data units, at the current zoom
+        xlim = self.state.ax.get_xlim()
+        return FREEHAND_TOLERANCE * abs(xlim[1] - xlim[0]) / max(self.state.ax.bbox.width, 1)
+
+    def show_stroke(self, cursor=None):
+        """Preview the stroke being drawn as one line, continued to the pointer if given."""
+        points = self.stroke.points()
+        if cursor is not None:
+            points = np.vstack([points, cursor])
+        if self.preview_element is None:
+            self.preview_element = self.state.ax.add_line(Line2D(
+                points[:, 0], points[:, 1], color=self.current_color, linewidth=2
+            ))
+        else:
+            self.preview_element.set_data(points[:, 0], points[:, 1])
+        self.state.fig.canvas.draw_idle()
+
+    def finish_stroke(self):
+        """Commit the stroke being drawn as one polyline, unless it never left its first point."""
+        stroke, self.stroke = self.stroke, None
+        if self.preview_element is not None:
+            bounds = artist_bounds(self.preview_element)
+            self.preview_element.remove()
+            self.preview_element = None
+            self.mark_dirty(bounds)
+        points = stroke.points()
+        if len(points) >= 2 and not self.active_layer.locked:
+            self.commit_element('polylines', PolylineShape(points, self.current_color))
+
+    def commit_element(self, element_type, element):
+        """Add a new element to the active layer and draw only that element."""
+        layer = self.active_layer
+        if layer.locked:
+            raise ValueError(f"Layer '{layer.name}' is locked")
+
+        layer.elements[element_type].append(element)
+        self.record_action({
+            'action': 'add',
+            'layer': layer.id,
+            'type': element_type,
+            'element': element
+        })
+
+        if not self.use_raster_cache and layer.visible:
+            artist = draw_element(self.state.ax, element_type, element)
+            artist.set_zorder(artist.get_zorder() + 3 * self.layer_rank(layer))
+            self.mark_dirty(display_bounds(self.state.ax, element_type, [element]))
+        else:
+            self.paint_new_elements(layer, element_type, [element])
+
+    def commit_elements(self, element_type, elements):
+        """Add many elements of one type with a single insert, paint and undo entry."""
+        layer = self.active_layer
+        if layer.locked:
+            raise ValueError(f"Layer '{layer.name}' is locked")
+
+        layer.elements[element_type].extend(elements)
+        self.record_action({
+            'action': 'add_batch',
+            'layer': layer.id,
+            'type': element_type,
+            'elements': elements
+        })
+        self.show_new_elements(layer, element_type, elements)
+
+    def show_new_elements(self, layer, element_type, elements):
+        if not self.use_raster_cache and layer.visible:
+            for artist in add_element_artists(self.state.ax, {element_type: elements}):
+                artist.set_zorder(artist.get_zorder() + 3 * self.layer_rank(layer))
+            self.mark_dirty(display_bounds(self.state.ax, element_type, elements))
+        else:
+            self.paint_new_elements(layer, element_type, elements)
+
+    def paint_new_elements(self, layer, element_type, elements):
+        layer.cache.pyramid.forget(lambda ax: display_bounds(ax, element_type, elements), reshaped=False)
+        self.schedule_tiles()
+
+        if self.paint_batch is not None:
+            self.paint_batch.setdefault((layer, element_type), []).extend(elements)
+            return
+
+        if not layer.visible:
+            # Re-rendered when the layer is shown again
+            layer.cache.invalidate()
+        elif layer.cache.valid:
+            # Paint onto the layer's cached raster instead of adding live artists
+            layer.cache.paint(element_type, elements)
+            self.mark_dirty(display_bounds(self.state.ax, element_type, elements))
+        else:
+            layer.cache.render(self.state.ax, layer.elements)
+            self.state.fig.canvas.draw_idle()
+
+    @contextlib.contextmanager
+    def batch_paint(self):
+        """Defer raster paints of new elements and apply them once per layer and type."""
+        if self.paint_batch is not None:
+            yield
+            return
+
+        self.paint_batch = {}
+        try:
+            yield
+        finally:
+            batch, self.paint_batch = self.paint_batch, None
+            for (layer, element_type), elements in batch.items():
+                self.paint_new_elements(layer, element_type, elements)
+
+    def discard_pending_paint(self, layer=None):
+        # A full re-render already includes the pending elements
+        if self.paint_batch:
+            for key in [key for key in self.paint_batch if layer is None or key[0] is layer]:
+                del self.paint_batch[key]
+
+    def pan_to(self, event):
+        press_x, press_y, start_xlim, start_ylim = self.pan_start
+        bbox = self.state.ax.bbox
+
+        # Convert the pixel offset into data units at the current zoom
+        dx = (event.x - press_x) * (start_xlim[1] - start_xlim[0]) / bbox.width
+        dy = (event.y - press_y) * (start_ylim[1] - start_ylim[0]) / bbox.height
+
+        self.state.ax.set_xlim(start_xlim[0] - dx, start_xlim[1] - dx)
+        self.state.ax.set_ylim(start_ylim[0] - dy, start_ylim[1] - dy)
+
+        self.refresh_view()
+
+    def refresh_view(self):
+        """
+        Redraw after a view change. Layers whose raster no longer covers the
+        view are shown from their tile pyramids at once and rendered exactly
+        when the view has settled; without Tk they are rendered right away.
+        """
+        if self.use_raster_cache:
+            stale = [layer for layer in self.layers
+                     if layer.visible and not layer.cache.covers(self.state.ax)]
+            if self.root is None:
+                for layer in stale:
+                    layer.cache.render(self.state.ax, layer.elements)
+            elif stale:
+                # Layers without every tile yet keep their old raster, stretched
+                for layer in stale:
+                    layer.cache.show_tiles(self.state.ax)
+                self.schedule_exact_view()
+            self.schedule_tiles()
+        self.state.fig.canvas.draw_idle()
+
+    def schedule_exact_view(self):
+        # Pushed back by every zoom or pan step, so it runs once the view settles
+        if self.exact_view_id is not None:
+            self.root.after_cancel(self.exact_view_id)
+        self.exact_view_id = self.root.after(VIEW_SETTLE_MS, self.render_exact_view)
+
+    def render_exact_view(self):
+        self.exact_view_id = None
+        if not self.use_raster_cache:
+            return
+        for layer in self.layers:
+            if layer.visible and not layer.cache.covers(self.state.ax):
+                layer.cache.render(self.state.ax, layer.elements)
+        self.state.fig.canvas.draw_idle()
+
+    def schedule_tiles(self):
+        if (self.root is not None and self.use_raster_cache and not self.suspended
+                and self.tile_pump_id is None):
+            self.tile_pump_id = self.root.after_idle(self.render_tiles)
+
+    def tile_jobs(self):
+        """Missing pyramid tiles of the visible layers as (layer, key), most useful first."""
+        jobs = []
+        for layer in self.layers:
+            if layer.visible:
+                wanted = layer.cache.pyramid.wanted(self.state.ax)
+                jobs.extend((rank, index, layer, key) for index, (rank, key) in enumerate(wanted))
+        jobs.sort(key=lambda job: job[:2])
+        return [(layer, key) for _, _, layer, key in jobs]
+
+    def render_tiles(self):
+        """Render missing pyramid tiles around the view, a few milliseconds per Tk idle slice."""
+        self.tile_pump_id = None
+        if (not self.use_raster_cache or self.suspended or self.svg_import is not None
+                or self.project_load is not None or self.script_job is not None):
+            # Shapes still streaming in would outdate the tiles slice by slice
+            return
+
+        deadline = time.perf_counter() + TILE_TIME_BUDGET
+        jobs = self.tile_jobs()
+        while jobs and time.perf_counter() < deadline:
+            layer, key = jobs.pop(0)
+            layer.cache.pyramid.render_tile(*key, layer.elements)
+        if jobs:
+            self.tile_pump_id = self.root.after(1, self.render_tiles)
+
+    def on_resize(self, event):
+        # The pixel scale changed, so every cached raster is stale
+        for layer in self.layers:
+            layer.cache.invalidate()
+        self.refresh_view()
+
+    def redraw_layer(self, layer, action=None):
+        """
+        Re-render a single layer after its elements changed. Given the action
+        that changed it, only the area the action touched is re-rasterized and
+        redrawn on screen.
+        """
+        layer.cache.pyramid.forget(None if action is None else lambda ax: action_bounds(ax, layer, action))
+        self.schedule_tiles()
+
+        if not self.use_raster_cache:
+            self.redraw_project_elements()
+            return
+
+        if not layer.visible:
+            # Re-rendered when it is shown again
+            self.discard_pending_paint(layer)
+            layer.cache.invalidate()
+            return
+
+        bounds = None
+        if action is not None and not self.paint_batch and layer.cache.covers(self.state.ax):
+            bounds = action_bounds(layer.cache.ax, layer, action)
+        if bounds is None:
+            self.discard_pending_paint(layer)
+            layer.cache.render(self.state.ax, layer.elements)
+            self.state.fig.canvas.draw_idle()
+            return
+
+        layer.cache.repaint(layer.elements, bounds)
+        self.mark_dirty(action_bounds(self.state.ax, layer, action))
+
+    def mark_dirty(self, bounds):
+        """Queue a screen-space (x0, x1, y0, y1) box to be redrawn and blitted once Tk is idle."""
+        if bounds is None or self.state.fig is None or self.suspended:
+            # A suspended project is redrawn whole when its tab is shown again
+            return
+        x0, x1, y0, y1 = bounds
+        box = Bbox.from_extents(x0, y0, x1, y1)
+        self.dirty_region = box if self.dirty_region is None else Bbox.union([self.dirty_region, box])
+
+        if self.root is None:
+            self.flush_dirty()
+        elif self.dirty_flush_id is None:
+            self.dirty_flush_id = self.root.after_idle(self.flush_dirty)
+
+    def flush_dirty(self):
+        """Redraw only the dirty part of the axes and blit it, instead of a whole frame."""
+        self.dirty_flush_id = None
+        bounds, self.dirty_region = self.dirty_region, None
+        if bounds is None:
+            return
+
+        canvas = self.state.fig.canvas
+        renderer = getattr(canvas, 'renderer', None)
+        if renderer is None or canvas.get_renderer() is not renderer:
+            # Nothing was drawn at this size yet, so there is no frame to patch
+            canvas.draw_idle()
+            return
+
+        region = pixel_box((bounds.x0, bounds.x1, bounds.y0, bounds.y1), self.state.ax.bbox)
+        if region is not None:
+            draw_region(self.state.ax, renderer, region)
+            canvas.blit(region)
+
+    def suspend(self):
+        """
+        Put the project behind another tab: finish any stroke and stop its
+        tile rendering and screen updates. Without the raster cache the
+        per-shape artists are dropped too; the layer rasters are kept, so
+        showing the project again usually costs a single draw.
+        """
+        if self.stroke is not None:
+            self.finish_stroke()
+        if self.root is not None:
+            for after_id in (self.tile_pump_id, self.exact_view_id, self.dirty_flush_id):
+                if after_id is not None:
+                    self.root.after_cancel(after_id)
+        self.tile_pump_id = self.exact_view_id = self.dirty_flush_id = None
+        self.dirty_region = None
+        if not self.use_raster_cache and self.state.ax is not None:
+            self.state.ax.clear()
+            self.selection_artist = None
+        self.suspended = True
+
+    def resume(self):
+        """Bring the project back to the front after suspend()."""
+        if not self.suspended:
+            return
+        self.suspended = False
+        if hasattr(self, 'command_server_var'):
+            # The server takes commands for whichever tab is in front, and may have been toggled from another
+            self.command_server_var.set(workspace.command_server is not None)
+        if self.use_raster_cache:
+            self.refresh_view()
+        else:
+            self.redraw_project_elements()
+
+    @contextlib.contextmanager
+    def current(self):
+        """Point ziggle_state at this project while its background work runs commands."""
+        global ziggle_state
+        previous, ziggle_state = ziggle_state, self.state
+        try:
+            yield
+        finally:
+            ziggle_state = previous
+
+    # Layer management
+    def get_layer(self, key):
+        """Find a layer by id or by name."""
+        for layer in self.layers:
+            if key in (layer.id, layer.name):
+                return layer
+        return None
+
+    def layer_rank(self, layer):
+        return sorted(self.layers, key=lambda l: l.z_order).index(layer)
+
+    def add_layer(self, name=None):
+        z_order = max(layer.z_order for layer in self.layers) + 1
+        layer = Layer(name or f"Layer {len(self.layers) + 1}", z_order=z_order)
+        layer.cache.zorder = 1 + z_order * 0.01
+        self.layers.append(layer)
+        self.active_layer = layer
+        self.clear_selection()
+        self.refresh_layers_panel()
+        return layer
+
+    def set_active_layer(self, key):
+        layer = self.get_layer(key)
+        if layer is None:
+            raise ValueError(f"Unknown layer: {key}")
+        self.active_layer = layer
+        self.clear_selection()
+        self.refresh_layers_panel()
+
+    def set_layer_visible(self, layer, visible):
+        layer.visible = visible
+        if self.use_raster_cache:
+            if visible and not layer.cache.covers(self.state.ax):
+                layer.cache.render(self.state.ax, layer.elements)
+            elif layer.cache.image is not None:
+                # Hidden layers keep their raster but are skipped at draw time
+                layer.cache.image.set_visible(visible)
+            self.state.fig.canvas.draw_idle()
+        else:
+            self.redraw_project_elements()
+        self.refresh_layers_panel()
+
+    def set_layer_locked(self, layer, locked):
+        layer.locked = locked
+        self.refresh_layers_panel()
+
+    def move_layer(self, layer, step):
+        """Swap a layer's z-order with its neighbour above (step=1) or below (step=-1)."""
+        ordered = sorted(self.layers, key=lambda l: l.z_order)
+        index = ordered.index(layer)
+        other_index = index + step
+        if not 0 <= other_index < len(ordered):
+            return
+
+        other = ordered[other_index]
+        layer.z_order, other.z_order = other.z_order, layer.z_order
+        for changed in (layer, other):
+            changed.cache.zorder = 1 + changed.z_order * 0.01
+            if changed.cache.image is not None:
+                changed.cache.image.set_zorder(changed.cache.zorder)
+
+        if self.use_raster_cache:
+            self.state.fig.canvas.draw_idle()
+        else:
+            self.redraw_project_elements()
+        self.refresh_layers_panel()
+
+    def create_layers_panel(self, parent):
+        layers_panel = tk.Frame(parent, width=160, bg='#2c3e50')
+        layers_panel.pack(side=tk.RIGHT, fill=tk.Y)
+        layers_panel.pack_propagate(False)
+
+        tk.Label(layers_panel, text="Layers", bg='#2c3e50', fg='white',
+                 font=('Segoe UI', 10, 'bold')).pack(pady=5)
+
+        self.layers_listbox = tk.Listbox(
+            layers_panel,
+            bg='#34495e',
+            fg='white',
+            font=('Segoe UI', 9),
+            borderwidth=0,
+            highlightthickness=0,
+            selectbackground='#3498db',
+            exportselection=False
+        )
+        self.layers_listbox.pack(fill=tk.BOTH, expand=True, padx=5)
+        self.layers_listbox.bind('<<ListboxSelect>>', self.on_layer_select)
+
+        # Layer buttons act on the active layer
+        layer_buttons = [
+            ("Add", lambda: self.add_layer()),
+            ("Raise", lambda: self.move_layer(self.active_layer, 1)),
+            ("Lower", lambda: self.move_layer(self.active_layer, -1)),
+            ("Show/Hide", lambda: self.set_layer_visible(self.active_layer, not self.active_layer.visible)),
+            ("Lock/Unlock", lambda: self.set_layer_locked(self.active_layer, not self.active_layer.locked))
+        ]
+
+        for label, command in layer_buttons:
+            btn = tk.Button(layers_panel, text=label, command=command,
+                            bg='#34495e', fg='white', relief=tk.FLAT)
+            btn.pack(fill=tk.X, padx=5, pady=2)
+
+        self.refresh_layers_panel()
+
+    def refresh_layers_panel(self):
+        listbox = getattr(self, 'layers_listbox', None)
+        if listbox is None:
+            return
+
+        # Topmost layer first
+        self.layers_panel_order = sorted(self.layers, key=lambda l: l.z_order, reverse=True)
+        listbox.delete(0, tk.END)
+        for index, layer in enumerate(self.layers_panel_order):
+            flags = ("" if layer.visible else " (hidden)") + (" (locked)" if layer.locked else "")
+            listbox.insert(tk.END, layer.name + flags)
+            if layer is self.active_layer:
+                listbox.selection_set(index)
+
+    def on_layer_select(self, event):
+        selection = self.layers_listbox.curselection()
+        if selection:
+            self.active_layer = self.layers_panel_order[selection[0]]
+            self.clear_selection()
+
+    # Selection and bulk transforms
+    def select(self, element_types=None, box=None, color=None):
+        """
+        Select the active layer's elements that match every given filter.
+        box is (x1, x2, y1, y2); an element is selected when it lies fully inside.
+        """
+        layer = self.active_layer
+        self.selection = query_elements(layer, element_types, color, box)
+        self.selection_layer = layer
+        self.show_selection()
+        return self.selection_count()
+
+    def count_elements(self, element_types=None, color=None, box=None):
+        """Count the active layer's elements matching every given filter, as select would."""
+        found = query_elements(self.active_layer, element_types, color, box)
+        return sum(len(indices) for indices in found.values())
+
+    def delete_elements(self, element_types=None, color=None, box=None):
+        """Delete the active layer's elements matching every given filter as one undoable step."""
+        layer = self.active_layer
+        if layer.locked:
+            raise ValueError(f"Layer '{layer.name}' is locked")
+
+        found = query_elements(layer, element_types, color, box)
+        if not found:
+            return 0
+        action = {
+            'action': 'delete',
+            'layer': layer.id,
+            'changes': {
+                element_type: {'indices': indices,
+                               'elements': [layer.elements[element_type][i] for i in indices.tolist()]}
+                for element_type, indices in found.items()
+            }
+        }
+        # Selected positions no longer point at the same shapes
+        if self.selection_layer is layer:
+            self.clear_selection()
+        apply_action(layer, action)
+        self.record_action(action)
+        self.redraw_layer(layer, action)
+        return sum(len(indices) for indices in found.values())
+
+    def selection_count(self):
+        return sum(len(indices) for indices in self.selection.values())
+
+    def clear_selection(self):
+        self.selection = {}
+        self.selection_layer = None
+        self.show_selection()
+
+    def selection_bounds(self):
+        bounds = [
+            element_bounds(element_type, coords_array(self.selection_layer.elements[element_type],
+                                                      element_type, indices))
+            for element_type, indices in self.selection.items()
+        ]
+        return (
+            min(b[0].min() for b in bounds), max(b[1].max() for b in bounds),
+            min(b[2].min() for b in bounds), max(b[3].max() for b in bounds)
+        )
+
+    def show_selection(self):
+        """Outline the selection with a single dashed box, whatever its size."""
+        if self.selection_artist is not None:
+            bounds = artist_bounds(self.selection_artist)
+            self.selection_artist.remove()
+            self.selection_artist = None
+            self.mark_dirty(bounds)
+
+        if self.selection:
+            xmin, xmax, ymin, ymax = self.selection_bounds()
+            self.selection_artist = self.state.ax.add_patch(Rectangle(
+                (xmin, ymin), xmax - xmin, ymax - ymin,
+                fill=False, edgecolor='orange', linestyle='--', linewidth=1.5, zorder=3
+            ))
+            self.mark_dirty(artist_bounds(self.selection_artist))
+
+    def transform_selection(self, operation, *args, center=None):
+        """
+        Apply one bulk operation ('move', 'scale', 'rotate' or 'recolor') to the
+        selection as array operations, with one redraw and one undo entry.
+        """
+        layer = self.selection_layer
+        if not self.selection or layer is None:
+            return 0
+        if layer.locked:
+            raise ValueError(f"Layer '{layer.name}' is locked")
+        if operation == 'scale' and args[0] <= 0:
+            raise ValueError("Scale factor must be positive")
+
+        if center is None and operation in ('scale', 'rotate'):
+            xmin, xmax, ymin, ymax = self.selection_bounds()
+            center = ((xmin + xmax) / 2, (ymin + ymax) / 2)
+
+        changes = {}
+        for element_type, indices in self.selection.items():
+            elements = layer.elements[element_type]
+            if operation == 'recolor':
+                changes[element_type] = {
+                    'indices': indices,
+                    'before_colors': [elements[i].color for i in indices.tolist()],
+                    'after_color': args[0]
+                }
+            elif element_type == 'polylines':
+                # Every vertex moves, not just the bounding box, so whole shapes are kept
+                before = [elements[i] for i in indices.tolist()]
+                changes[element_type] = {
+                    'indices': indices,
+                    'before_elements': before,
+                    'after_elements': [shape.transformed(operation, args, center) for shape in before]
+                }
+            else:
+                before = coords_array(elements, element_type, indices)
+                changes[element_type] = {
+                    'indices': indices,
+                    'before': before,
+                    'after': transform_coords(element_type, before, operation, args, center)
+                }
+
+        action = {'action': 'transform', 'layer': layer.id, 'changes': changes}
+        apply_action(layer, action)
+        self.record_action(action)
+
+        self.redraw_layer(layer, action)
+        self.show_selection()
+        return self.selection_count()
+
+    # SVG import
+    def import_svg(self, path=None):
+        """Import an SVG file into a new layer, in the background while Tk is running."""
+        if path is None:
+            path = filedialog.askopenfilename(filetypes=[("SVG files", "*.svg"), ("All files", "*.*")])
+            if not path:
+                return None
+        if self.svg_import is not None:
+            raise ValueError("An SVG import is already running")
+        if not os.path.isfile(path):
+            raise ValueError(f"No such file: {path}")
+
+        # Locked so nothing else lands between the imported shapes
+        layer = self.add_layer(os.path.splitext(os.path.basename(path))[0])
+        self.set_layer_locked(layer, True)
+
+        self.svg_import = SvgImport(self, path, layer)
+        if self.root is None:
+            self.svg_import.run()
+        else:
+            self.open_import_dialog(self.svg_import)
+            self.svg_import.start()
+        return layer
+
+    def import_svg_from_ui(self):
+        try:
+            self.import_svg()
+        except ValueError as e:
+            messagebox.showerror("Import SVG", str(e))
+
+    def open_import_dialog(self, svg_import):
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Import SVG")
+        dialog.geometry("320x110")
+
+        tk.Label(dialog, text=f"Importing {os.path.basename(svg_import.path)}").pack(pady=5)
+        progress = ttk.Progressbar(dialog, maximum=100, length=280)
+        progress.pack(padx=10)
+        tk.Button(dialog, text="Cancel", command=svg_import.cancel).pack(pady=5)
+
+        svg_import.on_progress = lambda fraction: progress.config(value=fraction * 100)
+        svg_import.on_done = dialog.destroy
+
+    def add_imported_elements(self, layer, elements):
+        # Painted in the order a full render draws the types
+        for element_type in DRAW_ORDER:
+            items = elements.get(element_type)
+            if items:
+                layer.elements[element_type].extend(items)
+                self.show_new_elements(layer, element_type, items)
+
+    def finish_import(self, svg_import):
+        """Record what an import added as undoable batches and release its layer."""
+        self.svg_import = None
+        layer = svg_import.layer
+        self.schedule_tiles()
+        self.set_layer_locked(layer, False)
+
+        for element_type, items in svg_import.imported.items():
+            if items:
+                self.record_action({
+                    'action': 'add_batch',
+                    'layer': layer.id,
+                    'type': element_type,
+                    'elements': items
+                })
+
+        count = sum(len(items) for items in svg_import.imported.values())
+        if svg_import.error is not None:
+            logger.error(f"SVG import of {svg_import.path} failed after {count} shapes: {svg_import.error}")
+            if self.root is not None:
+                messagebox.showerror("Import SVG", f"Import stopped after {count} shapes: {svg_import.error}")
+        else:
+            logger.info(f"Imported {count} shapes from {svg_import.path} into layer '{layer.name}'")
+
+    # Scene compaction
+    def compact_layer(self, layer):
+        """Compact one layer as a single undoable step and return the report."""
+        compacted, report = compact_elements(layer.elements)
+        if report['after'] < report['before']:
+            action = {
+                'action': 'replace',
+                'layer': layer.id,
+                'before': {element_type: list(layer.elements[element_type]) for element_type in ELEMENT_TYPES},
+                'after': compacted
+            }
+            apply_action(layer, action)
+            self.record_action(action)
+            self.redraw_layer(layer)
+        return report
+
+    def compact_scene(self, layers=None):
+        """Compact every unlocked layer and return the combined report."""
+        self.clear_selection()
+        total = {'before': 0, 'after': 0, 'degenerate': 0, 'duplicates': 0, 'merged': 0}
+        for layer in layers or self.layers:
+            if layer.locked:
+                continue
+            for key, value in self.compact_layer(layer).items():
+                total[key] += value
+        logger.info(f"Compacted {self.project_name}: {format_compaction_report(total)}")
+        return total
+
+    def compact_from_ui(self):
+        report = self.compact_scene()
+        messagebox.showinfo("Compact Scene", format_compaction_report(report))
+
+    def open_transform_dialog(self):
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Select & Transform")
+        dialog.geometry("380x330")
+
+        # Selection filters
+        select_frame = tk.LabelFrame(dialog, text="Select")
+        select_frame.pack(fill=tk.X, padx=10, pady=5)
+
+        type_var = tk.StringVar(value="all")
+        tk.OptionMenu(select_frame, type_var, "all", *ELEMENT_TYPES).grid(row=0, column=0, padx=5)
+        tk.Label(select_frame, text="Color:").grid(row=0, column=1)
+        color_entry = tk.Entry(select_frame, width=10)
+        color_entry.grid(row=0, column=2, padx=5)
+        count_label = tk.Label(select_frame, text=f"{self.selection_count()} selected")
+        count_label.grid(row=1, column=0, columnspan=3, pady=2)
+
+        def select():
+            element_types = None if type_var.get() == "all" else [type_var.get()]
+            color = color_entry.get().strip() or None
+            count = self.select(element_types, color=color)
+            count_label.config(text=f"{count} selected")
+
+        tk.Button(select_frame, text="Select", command=select).grid(row=0, column=3, padx=5)
+
+        # Transform operations, each with its own labelled parameter fields,
+        # filled in with values that leave the selection as it is
+        transform_frame = tk.LabelFrame(dialog, text="Transform")
+        transform_frame.pack(fill=tk.X, padx=10, pady=5)
+
+        operations = [
+            ("Move", 'move', [("dx", "0"), ("dy", "0")]),
+            ("Scale", 'scale', [("factor", "1")]),
+            ("Rotate", 'rotate', [("degrees", "0")])
+        ]
+
+        for row, (label, operation, fields) in enumerate(operations):
+            entries = []
+            for column, (field, default) in enumerate(fields):
+                tk.Label(transform_frame, text=f"{field}:").grid(row=row, column=2 * column, padx=(3, 0), pady=3)
+                entry = tk.Entry(transform_frame, width=6)
+                entry.insert(0, default)
+                entry.grid(row=row, column=2 * column + 1, padx=(0, 3), pady=3)
+                entries.append(entry)
+
+            def run(operation=operation, entries=entries):
+                try:
+                    values = [float(entry.get()) for entry in entries]
+                    self.transform_selection(operation, *values)
+                except ValueError as e:
+                    messagebox.showerror("Transform Error", str(e))
+
+            tk.Button(transform_frame, text=label, command=run, width=8).grid(row=row, column=4, padx=5)
+
+        def recolor():
+            self.transform_selection('recolor', self.current_color)
+
+        tk.Button(dialog, text="Recolor to Current Color", command=recolor).pack(pady=5)
+        tk.Button(dialog, text="Clear Selection",
+                  command=lambda: (self.clear_selection(), count_label.config(text="0 selected"))).pack(pady=5)
+
+    def toggle_command_server(self):
+        if self.command_server_var.get():
+            server = CommandServer(
+                self.root,
+                port=int(os.environ.get('ZIGGLE_PORT', DEFAULT_COMMAND_PORT)),
+                socket_path=os.environ.get('ZIGGLE_SOCKET')
+            )
+            try:
+                server.start()
+            except OSError as e:
+                self.command_server_var.set(False)
+                messagebox.showerror("Command Server Error", f"Could not start command server: {str(e)}")
+                return
+            workspace.command_server = server
+        elif workspace.command_server is not None:
+            workspace.command_server.stop()
+            workspace.command_server = None
+
+    def toggle_raster_cache(self):
+        self.use_raster_cache = self.raster_cache_var.get()
+        # Live mode edits do not keep the tiles up to date
+        for layer in self.layers:
+            layer.cache.pyramid.forget()
+        self.redraw_project_elements()
+
+    def toggle_session_recording(self):
+        if self.record_session_var.get():
+            path = filedialog.asksaveasfilename(
+                defaultextension=".jsonl",
+                filetypes=[("Recorded sessions", "*.jsonl *.jsonl.gz"), ("All files", "*.*")]
+            )
+            if not path:
+                self.record_session_var.set(False)
+                return
+            try:
+                if self.project_load is not None:
+                    raise ValueError("the project is still loading")
+                self.recorder = SessionRecorder(self, path)
+            except (OSError, ValueError) as e:
+                self.record_session_var.set(False)
+                messagebox.showerror("Record Session", f"Could not record session: {e}")
+        elif self.recorder is not None:
+            recorder, self.recorder = self.recorder, None
+            recorder.close()
+            messagebox.showinfo("Record Session", f"Recorded {recorder.count} events to {recorder.path}")
+
+    def record_event(self, event):
+        if self.recorder is not None:
+            self.recorder.record(event)
+
+    def tool_state(self):
+        """What canvas events act on besides the scene: the tool, its pending input and the active layer."""
+        return {
+            'tool': self.current_tool,
+            'drawing': self.drawing_mode,
+            'color': self.current_color,
+            'text': self.current_text,
+            'font_size': self.current_font_size,
+            'layer': self.active_layer.id
+        }
+
+    def set_tool_state(self, state):
+        self.current_tool = state['tool']
+        self.drawing_mode = state['drawing']
+        self.current_color = state['color']
+        self.current_text = state['text']
+        self.current_font_size = state['font_size']
+        self.active_layer = self.get_layer(state['layer']) or self.active_layer
 
     def set_text_tool(self):
         self.current_tool = 'text'
@@ -342,112 +1465,227 @@ class GraphPlot:
         cancel_btn.pack(pady=5)
 
     def redraw_project_elements(self):
-        # Clear existing plot
-        ziggle_state.ax.clear()
-        ziggle_state.ax.grid(True, linestyle='--', alpha=0.7)
-        ziggle_state.ax.set_xlim(0, self.width_val)
-        ziggle_state.ax.set_ylim(0, self.height_val)
-        ziggle_state.ax.set_aspect('equal')
-        ziggle_state.ax.set_title(f'Project: {self.project_name}', fontsize=10)
-
-        # Redraw rectangles
-        for rect in self.project_elements.get('rectangles', []):
-            create_rectangle(
-                rect['x1'], rect['x2'], 
-                rect['y1'], rect['y2'], 
-                rect['color'], 
-                rect.get('filled', False)
-            )
-
-        # Redraw lines
-        for line in self.project_elements.get('lines', []):
-            create_line(
-                line['x1'], line['y1'], 
-                line['x2'], line['y2'], 
-                line['color']
-            )
-
-        # Redraw circles
-        for circle in self.project_elements.get('circles', []):
-            create_circle(
-                circle['x'], circle['y'], 
-                circle['radius'], 
-                circle['color'], 
-                circle.get('filled', False)
-            )
+        if self.suspended and not self.use_raster_cache:
+            # Behind another tab there are no live artists; resume() draws them
+            return
 
-        # Redraw texts
-        for text in self.project_elements.get('texts', []):
-            create_text(
-                text['x1'], text['x2'], 
-                text['y1'], text['y2'], 
-                text['text'], 
-                text['color'], 
-                text['font_size']
-            )
+        # Clear existing plot
+        self.state.ax.clear()
+        self.state.ax.set_xlim(0, self.width_val)
+        self.state.ax.set_ylim(0, self.height_val)
+        self.state.ax.set_aspect('equal')
+        decorate_axes(self.state.ax, f'Project: {self.project_name}')
+
+        self.discard_pending_paint()
+        for rank, layer in enumerate(sorted(self.layers, key=lambda l: l.z_order)):
+            # Clearing the axes also dropped the cached raster image
+            layer.cache.detach()
+
+            if not layer.visible:
+                continue
+
+            if self.use_raster_cache:
+                # Rasterize the layer's committed shapes once for the current view
+                layer.cache.render(self.state.ax, layer.elements)
+            else:
+                for element_type in ('rectangles', 'lines', 'circles', 'polylines'):
+                    for element in layer.elements.get(element_type, []):
+                        artist = draw_element(self.state.ax, element_type, element)
+                        artist.set_zorder(artist.get_zorder() + 3 * rank)
+
+                # Labels share one artist drawing cached glyph runs
+                for artist in add_element_artists(self.state.ax, {'texts': layer.elements['texts']}):
+                    artist.set_zorder(artist.get_zorder() + 3 * rank)
+
+        # Clearing the axes also dropped the selection outline
+        self.selection_artist = None
+        self.show_selection()
 
         # Refresh the canvas
-        ziggle_state.fig.canvas.draw_idle()
+        self.state.fig.canvas.draw_idle()
+        self.schedule_tiles()
 
     def save_project(self, show_message=True):
+        """
+        Save the project. The layers, edit history and preview are taken here
+        and encoded and written on the shared background_pool, so saving a
+        large project leaves the window responsive; saves of one project are
+        written in the order they were made.
+        """
         try:
             # Ensure project directory exists
             project_dir = os.path.join("project", self.project_name)
             os.makedirs(project_dir, exist_ok=True)
 
-            # Save project metadata
-            project_info_path = os.path.join(project_dir, "project_state.json")
-            with open(project_info_path, 'w') as f:
-                json.dump({
-                    'name': self.project_name,
-                    'id': self.project_id,
-                    'width': self.width_val,
-                    'height': self.height_val,
-                    'elements': self.project_elements
-                }, f, indent=4)
-
-            # Save the current figure
-            figure_path = os.path.join(project_dir, "project_figure.png")
-            ziggle_state.fig.savefig(figure_path, dpi=300, bbox_inches='tight')
-
-            if show_message:
-                messagebox.showinfo("Save Project", f"Project '{self.project_name}' saved successfully!")
-            logger.info(f"Project {self.project_name} saved")
+            if self.project_load is not None:
+                raise ValueError("the project is still loading")
+
+            if self.compact_on_save:
+                self.compact_scene()
+
+            grid = self.storage_grid if self.compressed_storage else None
+            layers = [layer.snapshot() for layer in self.layers]
+            # The saved figure is only a preview; export renders the full figure
+            write_preview = self.preview_job(os.path.join(project_dir, "project_figure.png"))
+            # Keep the edit history next to the project
+            write_history = self.history.prepare_save(self.element_count())
+            previous = self.save_future
+
+            def write():
+                if previous is not None:
+                    wait([previous])
+                write_project_file(project_dir, self.project_state(grid, layers), compressed=grid is not None)
+                write_history()
+                write_preview()
+
+            self.save_future = self.history.pending = background_pool.submit(write)
         except Exception as e:
             messagebox.showerror("Save Error", f"Could not save project: {str(e)}")
             logger.error(f"Project save error: {e}")
+            return
+
+        self.finish_save(self.save_future, show_message)
+
+    def finish_save(self, future, show_message):
+        """Report a save once its file is written, polling from root.after; without Tk, wait for it."""
+        if self.root is not None and not future.done():
+            self.root.after(50, self.finish_save, future, show_message)
+            return
+
+        error = future.exception()
+        if error is not None:
+            messagebox.showerror("Save Error", f"Could not save project: {str(error)}")
+            logger.error(f"Project save error: {error}")
+            return
+        if show_message:
+            messagebox.showinfo("Save Project", f"Project '{self.project_name}' saved successfully!")
+        logger.info(f"Project {self.project_name} saved")
+
+    def project_state(self, grid=None, layers=None):
+        """
+        The project file contents, with shapes packed on grid if one is given.
+        layers, such as snapshots taken for a background save, default to the
+        project's own.
+        """
+        if layers is None:
+            layers = self.layers
+        # Project metadata; the storage grid must come before the layers it packs
+        state = {
+            'name': self.project_name,
+            'id': self.project_id,
+            'width': self.width_val,
+            'height': self.height_val
+        }
+        if grid is not None:
+            state['storage'] = {'grid': grid}
+        state['layers'] = [layer.to_dict(grid) for layer in layers]
+        if grid is not None:
+            # Packed shapes refer to their colors by style id
+            state['storage']['styles'] = [[style.color, style.filled] for style in styles.styles]
+        state['active_layer'] = self.active_layer.id
+        return state
 
     def load_project_state(self):
+        """
+        Load the saved project, streaming it in the background while Tk is
+        running so the window is usable at once. Shapes are added in chunks.
+        """
         try:
             project_dir = os.path.join("project", self.project_name)
             project_info_path = os.path.join(project_dir, "project_state.json")
-            
-            if os.path.exists(project_info_path):
-                with open(project_info_path, 'r') as f:
-                    project_data = json.load(f)
-                
-                # Restore project elements
-                self.project_elements = project_data.get('elements', {
-                    'rectangles': [],
-                    'lines': [],
-                    'circles': [],
-                    'texts': []
-                })
+            if os.path.exists(project_info_path + ".gz"):
+                project_info_path += ".gz"
 
-                # Redraw existing elements
-                self.redraw_project_elements()
-
-                logger.info(f"Loaded project state for {self.project_name}")
+            if os.path.exists(project_info_path):
+                # Later saves keep the storage mode the project was saved in
+                self.compressed_storage = project_info_path.endswith(".gz")
+                if hasattr(self, 'compressed_storage_var'):
+                    self.compressed_storage_var.set(self.compressed_storage)
+
+                # The layers shown until the first saved one is read take no edits
+                for layer in self.layers:
+                    layer.cache.pyramid.forget()
+                    self.set_layer_locked(layer, True)
+
+                self.project_load = ProjectLoad(self, project_info_path)
+                if self.root is None:
+                    self.project_load.run()
+                else:
+                    self.open_load_progress(self.project_load)
+                    self.project_load.start()
         except Exception as e:
             logger.warning(f"Could not load project state: {e}")
 
+    def open_load_progress(self, project_load):
+        frame = tk.Frame(self.toolbar_frame, bg='#34495e')
+        frame.pack(side=tk.LEFT, padx=10)
+        tk.Label(frame, text="Loading", bg='#34495e', fg='white').pack(side=tk.LEFT)
+        progress = ttk.Progressbar(frame, maximum=100, length=120)
+        progress.pack(side=tk.LEFT, padx=5)
+
+        project_load.on_progress = lambda fraction: progress.config(value=fraction * 100)
+        project_load.on_done = frame.destroy
+
+    def add_loaded_layer(self, project_load, layer):
+        if len(project_load.layers) == 1:
+            # The first saved layer replaces the placeholder ones
+            self.layers = [layer]
+            self.active_layer = layer
+            self.clear_selection()
+            self.redraw_project_elements()
+        else:
+            self.layers.append(layer)
+        self.refresh_layers_panel()
+
+    def finish_load(self, project_load):
+        """Unlock the loaded layers and reopen the edit history saved with them."""
+        self.project_load = None
+        for layer in self.layers:
+            layer.locked = project_load.locked.get(layer, False)
+        self.active_layer = self.get_layer(project_load.fields.get('active_layer')) or self.active_layer
+
+        # Shapes in compressed projects were rounded to the grid they were saved with
+        grid = project_load.fields.get('storage', {}).get('grid')
+        if grid is not None:
+            self.storage_grid = grid
+
+        # Edits made while loading start a history of their own
+        if project_load.error is None and self.history.count == 0:
+            self.history = EditHistory.load(self.history_dir(), self.history_snapshot(), grid=grid)
+        self.refresh_layers_panel()
+
+        if project_load.out_of_order:
+            # Shapes were painted in file order rather than by type, so settle
+            # the stacking with one exact render of the view
+            for layer in self.layers:
+                layer.cache.invalidate()
+            self.refresh_view()
+        else:
+            self.schedule_tiles()
+
+        if project_load.error is not None:
+            logger.warning(f"Could not load project state after {project_load.count} shapes: {project_load.error}")
+            if self.root is not None:
+                messagebox.showerror("Load Project", f"Loading stopped after {project_load.count} shapes: "
+                                                     f"{project_load.error}")
+        else:
+            logger.info(f"Loaded project state for {self.project_name}")
+
     def create_layout(self):
-        # Clear existing widgets
-        for widget in self.root.winfo_children():
-            widget.destroy()
+        if self.root is None:
+            # Headless, as when replaying a recorded session: an Agg canvas and no widgets
+            self.state.fig = Figure(figsize=(8, 6))
+            self.state.ax = self.state.fig.add_subplot()
+            HeadlessCanvas(self.state.fig)
+            self.init_axes(self.width_val, self.height_val)
+            self.connect_events(self.state.fig.canvas)
+            return
+
+        # Each open project lays itself out in its own notebook tab
+        self.tab_frame = workspace.add_tab(self)
 
         # Main container with grid layout
-        self.main_frame = tk.Frame(self.root, bg='#f0f4f8')
+        self.main_frame = tk.Frame(self.tab_frame, bg='#f0f4f8')
         self.main_frame.pack(fill=tk.BOTH, expand=True)
 
         # Toolbar (Top)
@@ -460,6 +1698,9 @@ class GraphPlot:
         # Left side panel for tools
         self.create_side_panel(middle_frame)
 
+        # Right side panel for layers
+        self.create_layers_panel(middle_frame)
+
         # Graph area
         self.graph_frame = tk.Frame(middle_frame, bg='white')
         self.graph_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
@@ -471,15 +1712,25 @@ class GraphPlot:
         self.create_command_input()
 
         # Connect mouse events
-        ziggle_state.fig.canvas.mpl_connect('button_press_event', self.on_mouse_press)
-        ziggle_state.fig.canvas.mpl_connect('motion_notify_event', self.on_mouse_move)
-        ziggle_state.fig.canvas.mpl_connect('button_release_event', self.on_mouse_release)
-        ziggle_state.fig.canvas.mpl_connect('scroll_event', self.on_scroll)
+        self.connect_events(self.state.fig.canvas)
+
+        workspace.notebook.select(self.tab_frame)
+
+    def connect_events(self, canvas):
+        # The recorder goes first, so it sees the tool state the handlers act on
+        for name in SESSION_EVENTS:
+            canvas.mpl_connect(name, self.record_event)
+        canvas.mpl_connect('button_press_event', self.on_mouse_press)
+        canvas.mpl_connect('motion_notify_event', self.on_mouse_move)
+        canvas.mpl_connect('button_release_event', self.on_mouse_release)
+        canvas.mpl_connect('scroll_event', self.on_scroll)
+        canvas.mpl_connect('resize_event', self.on_resize)
 
     def create_toolbar(self):
         toolbar_frame = tk.Frame(self.main_frame, bg='#34495e', height=40)
         toolbar_frame.pack(fill=tk.X)
         toolbar_frame.pack_propagate(False)
+        self.toolbar_frame = toolbar_frame
 
         # Project name display
         project_label = tk.Label(toolbar_frame, text=f"Project: {self.project_name}", 
@@ -488,9 +1739,12 @@ class GraphPlot:
 
         # Toolbar buttons
         toolbar_buttons = [
+            ("Close", self.close_project),
             ("New", self.new_project),
             ("Save", self.save_project),
-            ("Export", self.export_project)
+            ("Export", self.export_project),
+            ("Import", self.import_svg_from_ui),
+            ("Compact", self.compact_from_ui)
         ]
 
         for label, command in toolbar_buttons:
@@ -508,6 +1762,96 @@ class GraphPlot:
         )
         text_btn.pack(side=tk.LEFT, padx=5, pady=5)
 
+        # Selection and transform dialog
+        transform_btn = tk.Button(
+            toolbar_frame,
+            text="Transform",
+            command=self.open_transform_dialog,
+            bg='#2980b9',
+            fg='white'
+        )
+        transform_btn.pack(side=tk.LEFT, padx=5, pady=5)
+
+        # Jump anywhere in the edit history
+        history_btn = tk.Button(
+            toolbar_frame,
+            text="History",
+            command=self.open_history_dialog,
+            bg='#2980b9',
+            fg='white'
+        )
+        history_btn.pack(side=tk.LEFT, padx=5, pady=5)
+
+        # Compositing mode toggle
+        self.raster_cache_var = tk.BooleanVar(value=self.use_raster_cache)
+        cache_check = tk.Checkbutton(
+            toolbar_frame,
+            text="Cached Render",
+            variable=self.raster_cache_var,
+            command=self.toggle_raster_cache,
+            bg='#34495e',
+            fg='white',
+            selectcolor='#2c3e50',
+            activebackground='#34495e'
+        )
+        cache_check.pack(side=tk.LEFT, padx=5, pady=5)
+
+        # Compact the scene on every save
+        self.compact_on_save_var = tk.BooleanVar(value=self.compact_on_save)
+        compact_check = tk.Checkbutton(
+            toolbar_frame,
+            text="Compact on Save",
+            variable=self.compact_on_save_var,
+            command=lambda: setattr(self, 'compact_on_save', self.compact_on_save_var.get()),
+            bg='#34495e',
+            fg='white',
+            selectcolor='#2c3e50',
+            activebackground='#34495e'
+        )
+        compact_check.pack(side=tk.LEFT, padx=5, pady=5)
+
+        # Smaller, rounded project files
+        self.compressed_storage_var = tk.BooleanVar(value=self.compressed_storage)
+        compressed_check = tk.Checkbutton(
+            toolbar_frame,
+            text="Compressed Save",
+            variable=self.compressed_storage_var,
+            command=lambda: setattr(self, 'compressed_storage', self.compressed_storage_var.get()),
+            bg='#34495e',
+            fg='white',
+            selectcolor='#2c3e50',
+            activebackground='#34495e'
+        )
+        compressed_check.pack(side=tk.LEFT, padx=5, pady=5)
+
+        # Accept ZiggleScript from other processes
+        self.command_server_var = tk.BooleanVar(value=workspace.command_server is not None)
+        server_check = tk.Checkbutton(
+            toolbar_frame,
+            text="Listen",
+            variable=self.command_server_var,
+            command=self.toggle_command_server,
+            bg='#34495e',
+            fg='white',
+            selectcolor='#2c3e50',
+            activebackground='#34495e'
+        )
+        server_check.pack(side=tk.LEFT, padx=5, pady=5)
+
+        # Record canvas input for replay with --replay
+        self.record_session_var = tk.BooleanVar(value=False)
+        record_check = tk.Checkbutton(
+            toolbar_frame,
+            text="Record",
+            variable=self.record_session_var,
+            command=self.toggle_session_recording,
+            bg='#34495e',
+            fg='white',
+            selectcolor='#2c3e50',
+            activebackground='#34495e'
+        )
+        record_check.pack(side=tk.LEFT, padx=5, pady=5)
+
     def create_side_panel(self, parent):
         side_panel = tk.Frame(parent, width=60, bg='#2c3e50')
         side_panel.pack(side=tk.LEFT, fill=tk.Y)
@@ -517,8 +1861,11 @@ class GraphPlot:
         tools = [
             ("Rectangle", self.set_rectangle_tool),
             ("Line", self.set_line_tool),
+            ("Freehand", self.set_freehand_tool),
+            ("Polyline", self.set_polyline_tool),
             ("Circle", self.set_circle_tool),
             ("Text", self.set_text_tool),
+            ("Select", self.set_select_tool),
             ("Pan", self.set_pan_tool),
             ("Zoom", self.set_zoom_tool)
         ]
@@ -536,53 +1883,43 @@ class GraphPlot:
             btn.pack(pady=2)
 
     def create_graph(self, width_val, height_val):
-        # Clear any existing figure
-        plt.close('all')
-        
-        # Create new figure with specified dimensions
-        ziggle_state.fig, ziggle_state.ax = plt.subplots(figsize=(8, 6))
-        
+        # A figure of this project's own, outside pyplot, so the other open projects keep theirs
+        self.state.fig = Figure(figsize=(8, 6))
+        self.state.ax = self.state.fig.add_subplot()
+        self.init_axes(width_val, height_val)
+
+        # Create canvas
+        canvas = FigureCanvasTkAgg(self.state.fig, master=self.graph_frame)
+        canvas.draw()
+        canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+        return canvas
+
+    def init_axes(self, width_val, height_val):
         # Set fixed limits based on input dimensions
-        ziggle_state.ax.set_xlim(0, width_val)
-        ziggle_state.ax.set_ylim(0, height_val)
+        self.state.ax.set_xlim(0, width_val)
+        self.state.ax.set_ylim(0, height_val)
         
         # Store original limits for zoom restrictions
         self.original_xlim = (0, width_val)
         self.original_ylim = (0, height_val)
         
         # Set aspect ratio to be equal
-        ziggle_state.ax.set_aspect('equal')
-        
-        # Add grid
-        ziggle_state.ax.grid(True, linestyle='--', alpha=0.7)
-        
-        # Set title
-        ziggle_state.ax.set_title(f'Project: {self.project_name}', fontsize=10)
+        self.state.ax.set_aspect('equal')
         
-        # Create canvas
-        canvas = FigureCanvasTkAgg(ziggle_state.fig, master=self.graph_frame)
-        canvas.draw()
-        canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
-        
-        # Connect mouse events
-        canvas.mpl_connect('button_press_event', self.on_mouse_press)
-        canvas.mpl_connect('motion_notify_event', self.on_mouse_move)
-        canvas.mpl_connect('button_release_event', self.on_mouse_release)
-        canvas.mpl_connect('scroll_event', self.on_scroll)
-        
-        return canvas
+        # Add grid and title
+        decorate_axes(self.state.ax, f'Project: {self.project_name}')
 
     def on_scroll(self, event):
         # Only zoom if inside the axes
-        if event.inaxes != ziggle_state.ax:
+        if event.inaxes != self.state.ax:
             return
 
         # Determine zoom direction
         zoom_factor = 1.1 if event.button == 'up' else 0.9
 
         # Get current view limits
-        cur_xlim = ziggle_state.ax.get_xlim()
-        cur_ylim = ziggle_state.ax.get_ylim()
+        cur_xlim = self.state.ax.get_xlim()
+        cur_ylim = self.state.ax.get_ylim()
 
         # Calculate new view limits
         new_width = (cur_xlim[1] - cur_xlim[0]) * zoom_factor
@@ -617,11 +1954,11 @@ class GraphPlot:
             return
 
         # Set new limits
-        ziggle_state.ax.set_xlim(new_xlim)
-        ziggle_state.ax.set_ylim(new_ylim)
+        self.state.ax.set_xlim(new_xlim)
+        self.state.ax.set_ylim(new_ylim)
 
-        # Redraw
-        ziggle_state.fig.canvas.draw_idle()
+        # Redraw (zooming changes the pixel scale, so this re-rasterizes)
+        self.refresh_view()
 
     def ask_for_project_details(self):
         # Create a dialog for project details
@@ -668,9 +2005,8 @@ class GraphPlot:
             # Close the dialog
             details_window.destroy()
 
-            # Create the project
-            graph_plot = GraphPlot(self.root, project_name, project_id, width, height)
-            graph_plot.create_graph(width, height)
+            # Open the project in a new tab
+            GraphPlot(self.root, project_name, project_id, width, height)
 
         # Create button
         create_btn = tk.Button(details_window, text="Create Project", command=validate_and_create)
@@ -736,6 +2072,14 @@ class GraphPlot:
         self.current_tool = 'line'
         self.drawing_mode = True
 
+    def set_freehand_tool(self):
+        self.current_tool = 'freehand'
+        self.drawing_mode = True
+
+    def set_polyline_tool(self):
+        self.current_tool = 'polyline'
+        self.drawing_mode = True
+
     def set_circle_tool(self):
         self.current_tool = 'circle'
         self.drawing_mode = True
@@ -745,6 +2089,10 @@ class GraphPlot:
         # Open text input dialog
         self.open_text_input_dialog()
 
+    def set_select_tool(self):
+        self.current_tool = 'select'
+        self.drawing_mode = True
+
     def set_pan_tool(self):
         self.current_tool = 'pan'
         self.drawing_mode = False
@@ -756,24 +2104,23 @@ class GraphPlot:
     def set_color(self, color):
         self.current_color = color
 
-    # Mouse event handlers
-    def on_mouse_move(self, event):
-        if event.inaxes != ziggle_state.ax:
-            return
-
-        if self.current_tool == 'pan' and self.pan_start:
-            dx = event.xdata - self.pan_start[0]
-            dy = event.ydata - self.pan_start[1]
-            
-            ziggle_state.ax.set_xlim(ziggle_state.ax.get_xlim() - dx)
-            ziggle_state.ax.set_ylim(ziggle_state.ax.get_ylim() - dy)
-            
-            ziggle_state.fig.canvas.draw_idle()
-
     # Project management methods
     def new_project(self):
         self.ask_for_project_details()
 
+    def close_project(self):
+        """Close the project's tab, offering to save it first."""
+        if self.svg_import is not None or self.project_load is not None or self.script_job is not None:
+            messagebox.showwarning("Close Project", "Wait for the running import, load or script to finish, "
+                                                    "or cancel it, before closing the project.")
+            return
+        answer = messagebox.askyesnocancel("Close Project", f"Save '{self.project_name}' before closing?")
+        if answer is None:
+            return
+        if answer:
+            self.save_project(show_message=False)
+        workspace.close(self)
+
     def export_project(self):
         try:
             # Open file dialog to choose export location
@@ -783,48 +2130,3182 @@ class GraphPlot:
             )
             
             if export_path:
-                # Save high-resolution figure
-                ziggle_state.fig.savefig(export_path, dpi=300, bbox_inches='tight')
+                self.export_figure(export_path)
                 messagebox.showinfo("Export Successful", f"Project exported to {export_path}")
         except Exception as e:
             messagebox.showerror("Export Error", f"Could not export project: {str(e)}")
             logger.error(f"Project export error: {e}")
 
+    def scene_digest(self):
+        """
+        Digest of the drawn scene. Every change to the shapes moves the edit
+        history, so the digest is only recomputed after the history moved or
+        while an import adds shapes outside it.
+        """
+        state = (self.history, self.history.recorded, self.history.cursor,
+                 tuple((layer.id, layer.visible, layer.z_order) for layer in self.layers))
+        if self.svg_import is not None or self.project_load is not None:
+            return scene_digest(self.layers)
+        if self.digest_state is None or self.digest_state[0] is not state[0] or self.digest_state[1:] != state[1:]:
+            self.digest = scene_digest(self.layers)
+            self.digest_state = state
+        return self.digest
+
+    def export_figure(self, path, dpi=300):
+        """
+        Save the figure as shown at high resolution, reusing an identical
+        earlier export. Raster files are drawn from the shapes themselves by
+        the tiled export renderer; other file types are saved by matplotlib.
+        """
+        fig, ax = self.state.fig, self.state.ax
+        if os.path.splitext(path)[1].lower() not in RASTER_EXPORT_FORMATS:
+            key = render_cache.key(
+                'export', self.scene_digest(), self.width_val, self.height_val,
+                list(ax.get_xlim()), list(ax.get_ylim()), list(fig.get_size_inches()), dpi,
+                self.use_raster_cache, self.selection_key()
+            )
+            return render_cache.render(key, path, lambda path: fig.savefig(path, dpi=dpi, bbox_inches='tight'))
+
+        layers = [layer for layer in sorted(self.layers, key=lambda l: l.z_order) if layer.visible]
+        selection = None
+        if self.selection:
+            xmin, xmax, ymin, ymax = self.selection_bounds()
+            # Above every layer's shapes
+            selection = ((xmin, ymin, xmax - xmin, ymax - ymin), 3 * len(layers) + 3)
+        frame = ExportFrame(
+            tuple(fig.get_size_inches().tolist()), dpi, tuple(ax.get_position(original=True).bounds),
+            tuple(ax.get_xlim()), tuple(ax.get_ylim()), ax.get_title(), selection
+        )
+        key = render_cache.key('export-tiles', self.scene_digest(), frame)
+        return render_cache.render(key, path, lambda path: plt.imsave(
+            path, export_renderer.render(frame, [layer.elements for layer in layers]), dpi=dpi))
+
+    def selection_key(self):
+        # The selection outline is part of an exported figure
+        if self.selection_layer is None:
+            return None
+        return [self.selection_layer.id] + [
+            [element_type, sorted(map(int, indices))] for element_type, indices in sorted(self.selection.items())
+        ]
+
+    def export_preview(self, path, size=PREVIEW_SIZE):
+        """Write a quick NumPy-rasterized PNG preview of the visible layers."""
+        return self.preview_job(path, size)()
+
+    def preview_job(self, path, size=PREVIEW_SIZE):
+        """export_preview of the scene as it is now, as a function that may run on another thread."""
+        key = render_cache.key('preview', self.scene_digest(), self.width_val, self.height_val, size)
+        layers = [layer.snapshot() for layer in sorted(self.layers, key=lambda l: l.z_order)]
+        return lambda: render_cache.render(key, path, lambda path: plt.imsave(
+            path, rasterize_preview(layers, self.width_val, self.height_val, size)))
+
     def execute_command(self, event=None):
         command = self.command_input.get().strip()
         if command.endswith('<>'):
-            try:
-                commands = command.replace('<>', '\n').splitlines()
-                for cmd in commands:
-                    cmd = cmd.strip()
-                    if cmd:
-                        process_zigglescript_command(cmd)
-                self.command_input.delete(0, tk.END)
-                ziggle_state.fig.canvas.draw_idle()
-            except Exception as e:
-                messagebox.showerror("Command Error", str(e))
+            if self.script_job is not None:
+                messagebox.showerror("Command Error", "Another script is still running")
+                return
+            commands = [cmd.strip() for cmd in command.replace('<>', '\n').splitlines()]
+            self.command_input.delete(0, tk.END)
+            self.run_script([cmd for cmd in commands if cmd])
         else:
             messagebox.showerror("Invalid Command", "ZiggleScript commands must end with '<>'")
 
+    def run_script(self, commands):
+        """Run a ZiggleScript program, in time-boxed slices while Tk is running."""
+        job = self.script_job = ScriptJob(self, commands)
+        if self.root is None:
+            job.run()
+        else:
+            self.open_script_dialog(job)
+            job.start()
+        return job
+
+    def open_script_dialog(self, job):
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Run Script")
+        dialog.geometry("340x130")
+        dialog.protocol("WM_DELETE_WINDOW", job.cancel)
+
+        tk.Label(dialog, text=f"Running {len(job.commands)} commands").pack(pady=5)
+        progress = ttk.Progressbar(dialog, maximum=max(len(job.commands), 1), length=300)
+        progress.pack(padx=10)
+        status = tk.Label(dialog, text="")
+        status.pack()
+        tk.Button(dialog, text="Cancel", command=job.cancel).pack(pady=5)
+
+        # The canvas keeps redrawing, but edits wait until the script is done
+        dialog.grab_set()
+
+        def show_progress(job):
+            progress.config(value=job.position)
+            status.config(text=f"{job.position} of {len(job.commands)} commands, "
+                               f"{job.rate():.0f}/s, {len(job.errors)} errors")
+
+        job.on_progress = show_progress
+        job.on_done = dialog.destroy
+
+    def script_mark(self):
+        """Everything a ZiggleScript program can change, for rolling it back."""
+        return {
+            'history': self.history,
+            'cursor': self.history.cursor,
+            'recorded': self.history.recorded,
+            'layers': [(layer, layer.visible, layer.locked) for layer in self.layers],
+            'active_layer': self.active_layer,
+            'undo_stack': len(self.state.undo_stack)
+        }
+
+    def rollback_script(self, mark):
+        """Undo everything a ZiggleScript program did since mark was taken."""
+        history = self.history
+        if history is mark['history'] and history.recorded > mark['recorded']:
+            self.goto_history(mark['cursor'])
+            # The program's steps are gone, not waiting to be redone
+            history.truncate()
+        elif history.cursor != mark['cursor']:
+            self.goto_history(mark['cursor'])
+
+        # Layers the program added are empty again; drop them
+        kept = [layer for layer, _, _ in mark['layers']]
+        for layer in self.layers:
+            if layer not in kept and layer.cache.image is not None:
+                layer.cache.image.remove()
+                layer.cache.detach()
+        self.layers = kept
+        for layer, visible, locked in mark['layers']:
+            layer.locked = locked
+            if layer.visible != visible:
+                self.set_layer_visible(layer, visible)
+        self.active_layer = mark['active_layer']
+        self.clear_selection()
+        self.refresh_layers_panel()
+        del self.state.undo_stack[mark['undo_stack']:]
+        self.state.fig.canvas.draw_idle()
+
+    def finish_script(self, job):
+        """Report a finished or cancelled program with one summary instead of a dialog per error."""
+        self.script_job = None
+        self.schedule_tiles()
+        if job.cancelled:
+            logger.info(f"Script cancelled after {job.position} of {len(job.commands)} commands and rolled back")
+            return
+
+        for error in job.errors:
+            logger.warning(f"Script error: {error}")
+        for result in job.results:
+            logger.info(f"Script result: {result}")
+        if self.root is None:
+            # Without Tk the log is the report
+            if job.errors:
+                logger.warning(f"{len(job.errors)} of {len(job.commands)} commands failed")
+        else:
+            if job.errors:
+                messagebox.showerror("Command Error", f"{len(job.errors)} of {len(job.commands)} commands failed:\n"
+                                                      + "\n".join(first_lines(job.errors)))
+            if job.results:
+                messagebox.showinfo("Query", "\n".join(first_lines(job.results)))
+        logger.info(f"Script ran {len(job.commands)} commands at {job.rate():.0f}/s")
+
 import matplotlib.pyplot as plt
 
-def create_text(x1, x2, y1, y2, text, color, font_size):
+def first_lines(lines, limit=10):
+    """At most limit lines for a message box, noting how many more there were."""
+    shown = lines[:limit]
+    if len(lines) > limit:
+        shown.append(f"... and {len(lines) - limit} more")
+    return shown
+
+def create_text(ax, x1, x2, y1, y2, text, color, font_size):
     x_pos = (x1 + x2) / 2
     y_pos = (y1 + y2) / 2
 
-    plt.text(x_pos, y_pos, text, ha='center', va='center', color=color, fontsize=font_size)
+    # Bound to the given project's axes, not whatever pyplot considers current
+    return ax.text(x_pos, y_pos, text, ha='center', va='center', color=color, fontsize=font_size)
 
-def create_rectangle(x1, x2, y1, y2, color, filled=False):
+def create_rectangle(ax, x1, x2, y1, y2, color, filled=False):
     rect = Rectangle((x1, y1), x2-x1, y2-y1, linewidth=1, edgecolor=color, facecolor=color if filled else 'none')
-    ziggle_state.ax.add_patch(rect)
+    return ax.add_patch(rect)
 
-def create_line(x1, y1, x2, y2, color):
+def create_line(ax, x1, y1, x2, y2, color):
     line = Line2D([x1, x2], [y1, y2], color=color, linewidth=2)
-    ziggle_state.ax.add_line(line)
+    return ax.add_line(line)
 
-def create_circle(x, y, radius, color, filled=False):
+def create_circle(ax, x, y, radius, color, filled=False):
     circle = Circle((x, y), radius, edgecolor=color, facecolor=color if filled else 'none', linewidth=1)
-    ziggle_state.ax.add_patch(circle)
+    return ax.add_patch(circle)
+
+def create_polyline(ax, points, color):
+    line = Line2D(points[:, 0], points[:, 1], color=color, linewidth=2)
+    return ax.add_line(line)
+
+def draw_element(ax, element_type, element):
+    if element_type == 'rectangles':
+        return create_rectangle(ax, element.x1, element.x2, element.y1, element.y2, element.color, element.filled)
+    elif element_type == 'lines':
+        return create_line(ax, element.x1, element.y1, element.x2, element.y2, element.color)
+    elif element_type == 'circles':
+        return create_circle(ax, element.x, element.y, element.radius, element.color, element.filled)
+    elif element_type == 'texts':
+        return create_text(ax, element.x1, element.x2, element.y1, element.y2,
+                           element.text, element.color, element.font_size)
+    elif element_type == 'polylines':
+        return create_polyline(ax, element.points, element.color)
+
+# Vertices in one compound path of a style batch. Agg snaps axis-aligned
+# paths of up to 1024 vertices to whole pixels, as it does single shapes
+STYLE_BATCH_VERTICES = 1024
+
+RECTANGLE_CODES = (Path.MOVETO, Path.LINETO, Path.LINETO, Path.LINETO, Path.CLOSEPOLY)
+LINE_CODES = (Path.MOVETO, Path.LINETO)
+
+def style_runs(keys, opaque, limit):
+    """
+    Start indices of runs of consecutive shapes with equal keys, at most
+    limit long. Translucent shapes stay on their own: drawn together,
+    their overlaps would no longer darken.
+    """
+    count = len(keys)
+    start = np.ones(count, bool)
+    start[1:] = (keys[1:] != keys[:-1]) | ~opaque[1:] | ~opaque[:-1]
+    run_starts = np.flatnonzero(start)
+    offset = np.arange(count) - np.repeat(run_starts, np.diff(np.append(run_starts, count)))
+    return np.flatnonzero(start | (offset % limit == 0))
+
+def element_batches(element_type, coords, ids):
+    """
+    Number of the compound path style_batches draws each rectangle or line
+    in, counting in draw order. A subset of the shapes drawn with the
+    numbers of the whole stays split where the whole is, and so gets the
+    same pixels: merged into one path, overlapping edges blend differently.
+    """
+    if element_type == 'lines':
+        # Axis-aligned lines are snapped to pixels only in paths of their own
+        aligned = (coords[:, 0] == coords[:, 2]) | (coords[:, 1] == coords[:, 3])
+        keys, size = ids * 2 + aligned, len(LINE_CODES)
+    else:
+        keys, size = ids, len(RECTANGLE_CODES)
+    edge = styles.arrays()[0]
+    first = np.zeros(len(ids), np.intp)
+    first[style_runs(keys, edge[ids, 3] >= 1, max(STYLE_BATCH_VERTICES // size, 1))] = 1
+    return np.cumsum(first) - 1
+
+def style_batches(ax, verts, codes, ids, batches, **kwargs):
+    """
+    A collection drawing (n, k, 2) shape vertices as one compound path per
+    element_batches number: runs of consecutive shapes in the same opaque
+    style. The shapes keep their order, so the result looks as if each were
+    drawn on its own, at a fraction of the paths and draw calls.
+    """
+    count, size = verts.shape[:2]
+    starts = np.flatnonzero(np.diff(batches, prepend=-1))
+    ends = np.append(starts[1:], count)
+    verts = verts.reshape(-1, 2)
+    codes = np.tile(np.array(codes, Path.code_type), count)
+    paths = [Path(verts[start * size:end * size], codes[start * size:end * size])
+             for start, end in zip(starts.tolist(), ends.tolist())]
+    keywords = style_keywords(ids[starts])
+    keywords.update(kwargs)
+    return ax.add_collection(PathCollection(paths, **keywords), autolim=False)
+
+def add_element_artists(ax, elements):
+    """
+    Add elements to an axes as a few collections per shape type instead of
+    one artist per shape, colored from the style table. Styles match
+    create_rectangle/create_line/create_circle/create_polyline.
+    """
+    columns = {}
+    for element_type, items in elements.items():
+        if items and element_type == 'polylines':
+            columns[element_type] = ([item.points for item in items], style_ids(items), None)
+        elif items and element_type != 'texts':
+            coords, ids = coords_array(items, element_type), style_ids(items)
+            batches = element_batches(element_type, coords, ids) if element_type != 'circles' else None
+            columns[element_type] = (coords, ids, batches)
+    return add_column_artists(ax, columns, elements.get('texts', []))
+
+def add_column_artists(ax, columns, texts=()):
+    """
+    add_element_artists for shapes already gathered into (coords, style ids,
+    element_batches numbers) arrays per type, as export tiles receive them;
+    polylines come as a list of vertex arrays instead of coordinates, and
+    labels stay shapes.
+    """
+    artists = []
+
+    if 'rectangles' in columns:
+        coords, ids, batches = columns['rectangles']
+        x1, x2, y1, y2 = coords.T
+        verts = np.stack([np.column_stack(corner) for corner in
+                          ((x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1))], axis=1)
+        artists.append(style_batches(ax, verts, RECTANGLE_CODES, ids, batches))
+
+    if 'circles' in columns:
+        # Circles gain nothing from compound paths: filling the curves dominates
+        coords, ids, _ = columns['circles']
+        diameters = coords[:, 2] * 2
+        artists.append(ax.add_collection(EllipseCollection(
+            diameters, diameters, np.zeros(len(coords)),
+            units='xy',
+            offsets=coords[:, :2],
+            offset_transform=ax.transData,
+            **style_keywords(ids)
+        ), autolim=False))
+
+    if 'lines' in columns:
+        coords, ids, batches = columns['lines']
+        artists.append(style_batches(ax, coords.reshape(-1, 2, 2), LINE_CODES, ids, batches,
+                                     facecolors='none', zorder=2))
+
+    if 'polylines' in columns:
+        # One path per polyline, however many vertices, in one collection
+        points, ids, _ = columns['polylines']
+        keywords = style_keywords(ids)
+        keywords.update(facecolors='none', zorder=2)
+        artists.append(ax.add_collection(PathCollection([Path(vertices) for vertices in points], **keywords),
+                                         autolim=False))
+
+    if texts:
+        artists.append(ax.add_artist(TextLabels(texts)))
+
+    return artists
+
+# Draw order of the shape types in add_element_artists, by collection zorder
+DRAW_ORDER = ('rectangles', 'circles', 'lines', 'polylines', 'texts')
+
+# Upper bound on pixel samples evaluated at once while rasterizing a preview
+PREVIEW_BATCH_PIXELS = 1 << 21
+
+# Sizes preview sampling windows are padded to, at most 1.5x apart
+PREVIEW_WINDOW_SIZES = np.unique(np.concatenate([2 ** np.arange(15), 3 * 2 ** np.arange(14)]))
+
+# Transmittance below which a preview pixel can no longer change its 8-bit value
+PREVIEW_OPAQUE = 1 / 512
+
+# Side in pixels of the tiles used to skip shapes hidden behind covered pixels
+PREVIEW_TILE = 8
+
+@functools.lru_cache(maxsize=1024)
+def preview_color(color):
+    return to_rgba(color)
+
+def coverage_span(pixels, low, high):
+    """Fraction of each unit pixel [p, p + 1) lying inside [low, high)."""
+    return np.clip(np.minimum(pixels + 1, high) - np.maximum(pixels, low), 0, 1)
+
+def pixel_window(low, high, limit):
+    # Integer [start, start + size) pixel range around [low, high), clipped to the image
+    start = np.clip(np.floor(low), 0, limit).astype(np.int32)
+    return start, np.clip(np.ceil(high), 0, limit).astype(np.int32) - start
+
+def preview_params(element_type, elements, ids, scale, height, point, columns, rows, coords=None):
+    """
+    Pixel-space parameters of shapes for the preview rasterizer, with the
+    origin and size of the pixel window each one is sampled over, its
+    (column, width, row, height) extent on the image and its draw alpha.
+    Rows grow downwards, so y is flipped against height. ids are the
+    shapes' style ids; coords, when given, replace the elements' own.
+    """
+    if coords is None:
+        coords = coords_array(elements, element_type)
+    coords = coords * scale
+    n = len(coords)
+    _, _, widths, filled = styles.arrays()
+    half = np.maximum(widths[ids] * point, 1.0) / 2
+    filled = filled[ids]
+
+    if element_type == 'lines':
+        # Lines are sampled along their major axis, a few pixels across, so
+        # diagonal lines do not pay for their whole bounding box
+        ax, ay, bx, by = coords[:, 0], height - coords[:, 1], coords[:, 2], height - coords[:, 3]
+        steep = np.abs(by - ay) > np.abs(bx - ax)
+        au, av = np.where(steep, ay, ax), np.where(steep, ax, ay)
+        bu, bv = np.where(steep, by, bx), np.where(steep, bx, by)
+        slope = np.divide(bv - av, bu - au, out=np.zeros(n), where=bu != au)
+        reach = half * np.sqrt(1 + slope * slope) + 1
+        start, length = pixel_window(np.minimum(au, bu) - half - 1, np.maximum(au, bu) + half + 1,
+                                     np.where(steep, rows, columns))
+        across = np.ceil(2 * reach).astype(np.int32) + 1
+        c0, w = pixel_window(np.minimum(ax, bx) - half - 1, np.maximum(ax, bx) + half + 1, columns)
+        r0, h = pixel_window(np.minimum(ay, by) - half - 1, np.maximum(ay, by) + half + 1, rows)
+        params = (au, av, bu, bv, half, slope, reach, steep)
+        return params, (start, np.zeros(n, np.int32)), (length, across), (c0, w, r0, h), 1.0
+
+    if element_type == 'circles':
+        cx, cy, radius = coords[:, 0], height - coords[:, 1], coords[:, 2]
+        reach = radius + half + 1
+        c0, w = pixel_window(cx - reach, cx + reach, columns)
+        r0, h = pixel_window(cy - reach, cy + reach, rows)
+        return (cx, cy, radius, half, filled), (c0, r0), (w, h), (c0, w, r0, h), 1.0
+
+    x0 = np.minimum(coords[:, 0], coords[:, 1])
+    x1 = np.maximum(coords[:, 0], coords[:, 1])
+    y0 = height - np.maximum(coords[:, 2], coords[:, 3])
+    y1 = height - np.minimum(coords[:, 2], coords[:, 3])
+    if element_type == 'texts':
+        # Labels are greeked: a faint bar the size of the text, centred on its anchor
+        sizes = np.fromiter((t.font_size for t in elements), float, n) * point
+        widths = np.fromiter((len(t.text) for t in elements), float, n) * sizes * 0.55
+        cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+        x0, x1 = cx - widths / 2, cx + widths / 2
+        y0, y1 = cy - sizes * 0.35, cy + sizes * 0.35
+        half = np.zeros(n)
+        filled = np.ones(n, bool)
+        alpha = 0.35
+    else:
+        alpha = 1.0
+    c0, w = pixel_window(x0 - half - 1, x1 + half + 1, columns)
+    r0, h = pixel_window(y0 - half - 1, y1 + half + 1, rows)
+    return (x0, x1, y0, y1, half, filled), (c0, r0), (w, h), (c0, w, r0, h), alpha
+
+def sample_grid(c0, r0, kw, kh):
+    cols = c0[:, None, None] + np.arange(kw, dtype=np.int32)
+    rows = r0[:, None, None] + np.arange(kh, dtype=np.int32)[:, None]
+    return cols, rows
+
+def box_samples(params, c0, r0, kw, kh):
+    """Exact area coverage of axis-aligned boxes, filled or outlined."""
+    x0, x1, y0, y1, half, filled = params
+    cols, rows = sample_grid(c0, r0, kw, kh)
+    outer = coverage_span(cols, x0 - half, x1 + half) * coverage_span(rows, y0 - half, y1 + half)
+    inner = coverage_span(cols, x0 + half, x1 - half) * coverage_span(rows, y0 + half, y1 - half)
+    return cols, rows, np.where(filled, outer, outer - inner)
+
+def circle_samples(params, c0, r0, kw, kh):
+    """Coverage of circles from their distance field, ramped over one pixel."""
+    cx, cy, radius, half, filled = params
+    cols, rows = sample_grid(c0, r0, kw, kh)
+    distance = np.hypot(cols + np.float32(0.5) - cx, rows + np.float32(0.5) - cy)
+    return cols, rows, np.where(filled,
+                                np.clip(radius + half + 0.5 - distance, 0, 1),
+                                np.clip(half + 0.5 - np.abs(distance - radius), 0, 1))
+
+def line_samples(params, start, _, kw, kh):
+    """
+    Coverage of line segments from their distance field. Windows run along
+    the major axis (u) and follow the line kh pixels across it (v); steep
+    lines have u and v swapped back into columns and rows at the end.
+    """
+    au, av, bu, bv, half, slope, reach, steep = params
+    major = start[:, None, None] + np.arange(kw, dtype=np.int32)
+    u = major + np.float32(0.5)
+    centre = av + slope * (np.clip(u, np.minimum(au, bu), np.maximum(au, bu)) - au)
+    minor = np.floor(centre - reach).astype(np.int32) + np.arange(kh, dtype=np.int32)[:, None]
+    v = minor + np.float32(0.5)
+
+    du, dv = bu - au, bv - av
+    t = np.clip(((u - au) * du + (v - av) * dv) / np.maximum(du * du + dv * dv, 1e-12), 0, 1)
+    distance = np.hypot(u - au - t * du, v - av - t * dv)
+    coverage = np.clip(half + 0.5 - distance, 0, 1)
+    return np.where(steep, minor, major), np.where(steep, major, minor), coverage
+
+PREVIEW_SAMPLERS = {
+    'rectangles': box_samples,
+    'texts': box_samples,
+    'circles': circle_samples,
+    'lines': line_samples
+}
+
+def open_tile_table(clear, columns, rows):
+    """Summed-area table over preview tiles, counting those some pixel of which can still change."""
+    tile = PREVIEW_TILE
+    grid = np.zeros((-(-rows // tile) * tile, -(-columns // tile) * tile))
+    grid[:rows, :columns] = clear.reshape(rows, columns)
+    tiles = grid.reshape(grid.shape[0] // tile, tile, grid.shape[1] // tile, tile).max(axis=(1, 3))
+    table = np.zeros((tiles.shape[0] + 1, tiles.shape[1] + 1), np.int32)
+    table[1:, 1:] = (tiles > PREVIEW_OPAQUE).cumsum(0).cumsum(1)
+    return table
+
+def tiles_open(table, extent):
+    """Whether each (column, width, row, height) extent touches a tile that is still open."""
+    c0, w, r0, h = extent
+    tile = PREVIEW_TILE
+    t0, t1 = c0 // tile, (c0 + w - 1) // tile + 1
+    u0, u1 = r0 // tile, (r0 + h - 1) // tile + 1
+    return (table[u1, t1] - table[u0, t1] - table[u1, t0] + table[u0, t0]) > 0
+
+def composite_under(color, clear, pixels, owner, alpha, palette):
+    """
+    Composite samples underneath what is already in a flat premultiplied
+    colour buffer, front to back. clear holds each pixel's remaining
+    transmittance. Each sample is the coverage of one shape (owner, later
+    shapes in front) on one pixel with straight (r, g, b, 1) colour
+    palette[owner]; samples on the same pixel are combined in one pass
+    instead of one pass per overlap depth.
+    """
+    # Pixels already covered by shapes in front take nothing more
+    shown = clear[pixels] > PREVIEW_OPAQUE
+    pixels, owner, alpha = pixels[shown], owner[shown], alpha[shown]
+
+    # Nor do samples beneath an opaque sample of a shape drawn later
+    opaque = alpha >= 1
+    if opaque.any():
+        front = np.full(len(clear), -1, np.int64)
+        np.maximum.at(front, pixels[opaque], owner[opaque])
+        shown = owner >= front[pixels]
+        pixels, owner, alpha = pixels[shown], owner[shown], alpha[shown]
+
+    # Pixels left with a single sample need no ordering
+    single = np.bincount(pixels, minlength=len(clear))[pixels] == 1
+    if single.any():
+        lone = pixels[single]
+        weight = alpha[single] * clear[lone]
+        color[lone] += palette[owner[single]] * weight[:, None]
+        clear[lone] *= 1 - alpha[single]
+        single = ~single
+        pixels, owner, alpha = pixels[single], owner[single], alpha[single]
+    if not len(pixels):
+        return
+
+    ranked = np.argsort(pixels.astype(np.int64) * (int(owner.max()) + 1) + (owner.max() - owner))
+    pixels, owner = pixels[ranked], owner[ranked]
+    alpha = np.minimum(alpha[ranked], 1 - 1e-6).astype(np.float64)
+
+    first = np.r_[True, pixels[1:] != pixels[:-1]]
+    starts = np.flatnonzero(first)
+    group = np.cumsum(first) - 1
+
+    # Each sample is dimmed by the samples in front of it on the same pixel
+    log_clear = np.log1p(-alpha)
+    prefix = np.cumsum(log_clear)
+    before = prefix[starts] - log_clear[starts]
+    visible = alpha * np.exp(prefix - log_clear - before[group])
+
+    colors = palette[owner]
+    drawn = np.stack([np.bincount(group, weights=visible * colors[:, channel], minlength=len(starts))
+                      for channel in range(4)], axis=1)
+    pixels = pixels[starts]
+    color[pixels] += drawn * clear[pixels, None]
+    clear[pixels] *= np.exp(np.r_[prefix[starts[1:] - 1], prefix[-1]] - before)
+
+def polyline_segments(elements):
+    """(x1, y1, x2, y2) rows of every segment of the polylines, and which polyline each belongs to."""
+    counts = np.fromiter((len(element.points) for element in elements), np.intp, len(elements))
+    points = np.concatenate([element.points for element in elements])
+    # Drop the segments joining one polyline's last vertex to the next one's first
+    joined = np.ones(len(points) - 1, bool)
+    joined[np.cumsum(counts)[:-1] - 1] = False
+    return np.column_stack((points[:-1], points[1:]))[joined], np.repeat(np.arange(len(elements)), counts - 1)
+
+def draw_preview_shapes(color, clear, columns, rows, element_type, elements, scale, height, point):
+    ids = style_ids(elements)
+    coords = None
+    if element_type == 'polylines':
+        # Sampled segment by segment, as lines
+        coords, owner = polyline_segments(elements)
+        element_type, ids = 'lines', ids[owner]
+    params, origin, size, extent, alpha = preview_params(element_type, elements, ids, scale, height, point,
+                                                         columns, rows, coords)
+    keep = np.flatnonzero((size[0] > 0) & (size[1] > 0) & (extent[1] > 0) & (extent[3] > 0))
+    if not len(keep):
+        return
+
+    palette = styles.arrays()[0][ids[keep]]
+    opacity = (palette[:, 3] * alpha).astype(np.float32)
+    palette[:, 3] = 1.0
+
+    params = [np.asarray(p)[keep].astype(np.float32 if p.dtype.kind == 'f' else p.dtype) for p in params]
+    c0, r0 = origin[0][keep], origin[1][keep]
+    extent = [e[keep] for e in extent]
+
+    # Windows are padded to a few standard sizes and sampled a whole bucket at a time
+    classes = [np.searchsorted(PREVIEW_WINDOW_SIZES, s[keep]) for s in size]
+    buckets = classes[0] * len(PREVIEW_WINDOW_SIZES) + classes[1]
+    ends = np.cumsum(PREVIEW_WINDOW_SIZES[classes[0]] * PREVIEW_WINDOW_SIZES[classes[1]])
+    sampler = PREVIEW_SAMPLERS[element_type]
+
+    # Consecutive runs of shapes, drawn from the front; runs of about an
+    # image's worth of samples let covered pixels cull the runs behind them
+    runs, start = [], 0
+    limit = min(PREVIEW_BATCH_PIXELS, max(columns * rows, 1 << 16))
+    while start < len(keep):
+        done = ends[start - 1] if start else 0
+        stop = max(int(np.searchsorted(ends, done + limit, side='right')), start + 1)
+        runs.append((start, stop))
+        start = stop
+
+    for start, stop in reversed(runs):
+        shown = start + np.flatnonzero(tiles_open(open_tile_table(clear, columns, rows),
+                                                  [e[start:stop] for e in extent]))
+        hits = []
+        for bucket in np.unique(buckets[shown]).tolist():
+            members = shown[buckets[shown] == bucket]
+            kw, kh = PREVIEW_WINDOW_SIZES[[bucket // len(PREVIEW_WINDOW_SIZES), bucket % len(PREVIEW_WINDOW_SIZES)]]
+            cols, rws, coverage = sampler([p[members, None, None] for p in params],
+                                          c0[members], r0[members], kw, kh)
+            # Bounds are checked before broadcasting where the sampler keeps axes apart
+            hit = (coverage > 0) & ((cols >= 0) & (cols < columns)) & ((rws >= 0) & (rws < rows))
+            owner = np.broadcast_to(members[:, None, None], hit.shape)[hit]
+            hits.append((np.broadcast_to(rws * columns + cols, hit.shape)[hit], owner,
+                         coverage[hit] * opacity[owner]))
+        if not hits:
+            continue
+        pixels, owner, coverage = (np.concatenate(column) for column in zip(*hits))
+        if len(pixels):
+            composite_under(color, clear, pixels, owner, coverage, palette)
+
+def rasterize_preview(layers, width, height, size=256, point=None, background='white'):
+    """
+    Draw the visible layers of a width x height drawing, given bottom first,
+    into an RGBA uint8 array at most size pixels on its long side, using
+    NumPy only. Much cheaper than a figure savefig, for thumbnails and quick
+    previews.
+
+    point is the number of preview pixels per typographic point, which
+    scales line widths and label sizes; by default the drawing is assumed
+    to span about 480 points on screen.
+    """
+    scale = size / max(width, height)
+    columns, rows = max(1, round(width * scale)), max(1, round(height * scale))
+    if point is None:
+        point = size / 480
+
+    # Shapes are composited front to back, so covered pixels stop costing anything
+    color = np.zeros((rows * columns, 4), np.float32)
+    clear = np.ones(rows * columns, np.float32)
+    for layer in reversed(layers):
+        if not layer.visible:
+            continue
+        for element_type in reversed(DRAW_ORDER):
+            elements = layer.elements[element_type]
+            if elements:
+                draw_preview_shapes(color, clear, columns, rows, element_type, elements,
+                                    scale, height * scale, point)
+
+    backdrop = np.array(preview_color(background), np.float32)
+    backdrop[:3] *= backdrop[3]
+    color += clear[:, None] * backdrop
+    if backdrop[3] < 1:
+        opacity = color[:, 3:]
+        np.divide(color[:, :3], opacity, out=color[:, :3], where=opacity > 0)
+    color *= 255
+    color += 0.5
+    return color.astype(np.uint8).reshape(rows, columns, 4)
+
+class TextCache:
+    """
+    Measured extents and rasterized glyph runs of labels, keyed by string,
+    font size, color and dpi. Each distinct label is laid out and rasterized
+    once; drawing it again is a bitmap copy. Both are evicted least recently
+    used first.
+    """
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.extents = OrderedDict()
+        self.runs = OrderedDict()
+        self.fonts = {}
+        self.measurer = None
+
+    def font(self, font_size):
+        prop = self.fonts.get(font_size)
+        if prop is None:
+            prop = self.fonts[font_size] = FontProperties(size=font_size)
+        return prop
+
+    def measure(self, text, font_size, dpi):
+        """Return (width, height, descent) of a label in pixels."""
+        key = (text, font_size, dpi)
+        extent = self.extents.get(key)
+        if extent is None:
+            if self.measurer is None or self.measurer.dpi != dpi:
+                self.measurer = RendererAgg(1, 1, dpi)
+            extent = self.measurer.get_text_width_height_descent(text, self.font(font_size), False)
+            self._store(self.extents, key, extent)
+        else:
+            self.extents.move_to_end(key)
+        return extent
+
+    def run(self, text, font_size, color, dpi):
+        """Return the label rasterized as an RGBA array, bottom row first."""
+        key = (text, font_size, color, dpi)
+        image = self.runs.get(key)
+        if image is None:
+            width, height, descent = self.measure(text, font_size, dpi)
+            pad = 2
+            rows = int(np.ceil(height)) + 2 * pad
+            renderer = RendererAgg(int(np.ceil(width)) + 2 * pad, rows, dpi)
+            gc = renderer.new_gc()
+            gc.set_foreground(color)
+            renderer.draw_text(gc, pad, rows - pad - descent, text, self.font(font_size), 0)
+            gc.restore()
+            # draw_image takes the bottom row first
+            image = np.array(renderer.buffer_rgba())[::-1]
+            self._store(self.runs, key, image)
+        else:
+            self.runs.move_to_end(key)
+        return image
+
+    def _store(self, entries, key, value):
+        entries[key] = value
+        if len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+text_cache = TextCache()
+
+def scene_digest(layers):
+    """
+    Stable SHA-256 of what the layers draw: the visible layers bottom to top
+    and every field of their shapes, coordinates as little-endian doubles and
+    the other fields as JSON.
+    """
+    digest = hashlib.sha256()
+    for layer in sorted(layers, key=lambda l: l.z_order):
+        if not layer.visible:
+            continue
+        digest.update(b"layer\n")
+        for element_type in DRAW_ORDER:
+            items = layer.elements[element_type]
+            digest.update(f"{element_type} {len(items)}\n".encode())
+            if not items:
+                continue
+            digest.update(coords_array(items, element_type).astype('<f8').tobytes())
+            for name in SHAPE_TYPES[element_type].fields:
+                if name not in ELEMENT_COORDS[element_type]:
+                    values = list(map(operator.attrgetter(name), items))
+                    if isinstance(values[0], np.ndarray):
+                        # Polyline vertices: the count of each, then all of them as doubles
+                        digest.update(np.array([len(value) for value in values], '<i8').tobytes())
+                        digest.update(np.concatenate(values).astype('<f8').tobytes())
+                    else:
+                        digest.update(json.dumps(values).encode())
+    return digest.hexdigest()
+
+class RenderCache:
+    """
+    Rendered image files kept in one directory under a hash of everything
+    that went into them, so rendering the same scene with the same settings
+    again is a file copy. Files are evicted least recently used first once
+    the directory outgrows its budget.
+    """
+    def __init__(self, directory=RENDER_CACHE_DIR, budget=RENDER_CACHE_BUDGET):
+        self.directory = directory
+        self.budget = budget
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def path_of(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def render(self, key, path, draw):
+        """
+        Write the image for key to path, calling draw(path) only when no
+        cached copy exists. Returns whether the cache was used.
+        """
+        extension = os.path.splitext(path)[1].lower()
+        cached = self.path_of(key, extension)
+        if os.path.exists(cached):
+            shutil.copyfile(cached, path)
+            # Used just now, so evicted last
+            os.utime(cached)
+            return True
+
+        draw(path)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Copied under a temporary name so a half-written file is never reused
+            partial = cached + ".part"
+            shutil.copyfile(path, partial)
+            os.replace(partial, cached)
+            self.evict()
+        except OSError as e:
+            logger.warning(f"Could not cache render {path}: {e}")
+        return False
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".part"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.budget:
+                break
+            os.remove(path)
+            total -= size
+
+render_cache = RenderCache()
+
+def decorate_axes(ax, title):
+    ax.grid(True, linestyle='--', alpha=0.7)
+    ax.set_title(title, fontsize=10)
+
+# Everything an export draws besides the shapes: the figure size and dpi,
+# the axes position and view, the title, and the selection outline as
+# ((x, y, width, height), zorder) or None. All tuples, so frames hash.
+ExportFrame = namedtuple('ExportFrame', ('size', 'dpi', 'position', 'xlim', 'ylim', 'title', 'selection'))
+
+@functools.lru_cache(maxsize=1)
+def build_frame(frame):
+    """
+    Agg figure and axes drawing an ExportFrame, laid out and ready for
+    shapes, and the pixel boxes of its tick labels and title. Kept for the
+    next tile of the same export.
+    """
+    fig = Figure(figsize=frame.size, dpi=frame.dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes(frame.position)
+    ax.set_xlim(frame.xlim)
+    ax.set_ylim(frame.ylim)
+    ax.set_aspect('equal')
+    decorate_axes(ax, frame.title)
+    if frame.selection is not None:
+        (x, y, width, height), zorder = frame.selection
+        ax.add_patch(Rectangle((x, y), width, height, fill=False, edgecolor='orange',
+                               linestyle='--', linewidth=1.5, zorder=zorder))
+    fig.draw_without_rendering()
+    renderer = fig.canvas.get_renderer()
+    labels = [ax.xaxis.get_tightbbox(renderer), ax.yaxis.get_tightbbox(renderer), ax.title.get_window_extent(renderer)]
+    return fig, ax, [box.padded(2) for box in labels if box is not None]
+
+def render_export_tile(job):
+    """
+    Pixels of one (left, top, right, bottom) window of an export. The frame
+    is drawn on a canvas the size of the whole figure with only the shapes
+    overlapping the window, so each shape lands on exactly the pixels a
+    single full render gives it, and the window is cut out. Style ids are
+    those of the sending process's table, which comes along.
+    """
+    frame, (left, top, right, bottom), table, layers = job
+    fig, ax, labels = build_frame(frame)
+    # Text is most of the frame's drawing time; leave it out of tiles it cannot reach
+    height = fig.canvas.get_renderer().height
+    show = any(box.x1 >= left and box.x0 <= right and box.y1 >= height - bottom and box.y0 <= height - top
+               for box in labels)
+    if show != ax.title.get_visible():
+        ax.tick_params(labelbottom=show, labelleft=show)
+        ax.title.set_visible(show)
+    remap = np.array([styles.intern(*style) for style in table], np.intp)
+
+    artists = []
+    for offset, columns, texts in layers:
+        columns = {element_type: (coords, remap[ids], batches)
+                   for element_type, (coords, ids, batches) in columns.items()}
+        texts = [TextShape(*values) for values in texts]
+        for artist in add_column_artists(ax, columns, texts):
+            artist.set_zorder(artist.get_zorder() + offset)
+            artists.append(artist)
+    fig.canvas.draw()
+    pixels = np.asarray(fig.canvas.buffer_rgba())[top:bottom, left:right].copy()
+    for artist in artists:
+        artist.remove()
+    return pixels
+
+class ExportRenderer:
+    """
+    Raster exports drawn in tiles. Each tile gets only the shapes whose
+    extents overlap it and is drawn by a pool of worker processes, so a
+    high-dpi export of a large scene uses every core; the tiles are then
+    stitched together. Small scenes are drawn as one tile in this process.
+    Either way the pixels are the same.
+    """
+    def __init__(self, workers=EXPORT_WORKERS):
+        self.workers = workers
+        self.pool = None
+
+    def executor(self):
+        if self.pool is None:
+            # Spawned rather than forked: this process runs Tk and loader threads
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self.pool
+
+    @staticmethod
+    def window(fig):
+        """Pixel (left, top, right, bottom) of the figure savefig's bbox_inches='tight' would keep."""
+        renderer = fig.canvas.get_renderer()
+        box = fig.get_tightbbox(renderer).padded(plt.rcParams['savefig.pad_inches'])
+        x0, y0, x1, y1 = box.extents * fig.dpi
+        left, right = max(math.floor(x0), 0), min(math.ceil(x1), renderer.width)
+        bottom, top = max(math.floor(y0), 0), min(math.ceil(y1), renderer.height)
+        return left, renderer.height - top, right, renderer.height - bottom
+
+    @staticmethod
+    def tiles(window, workers):
+        """Split a window into about two tiles per worker, so uneven tiles even out."""
+        left, top, right, bottom = window
+        if workers <= 1:
+            return [window]
+        side = max(128, math.ceil(math.sqrt((right - left) * (bottom - top) / (2 * workers))))
+        return [(x, y, min(x + side, right), min(y + side, bottom))
+                for y in range(top, bottom, side) for x in range(left, right, side)]
+
+    def render(self, frame, layers):
+        """
+        RGBA pixels of an export of the frame with each of layers, a list of
+        element dicts from bottom to top, drawn over it.
+        """
+        fig, ax, _ = build_frame(frame)
+        height = fig.canvas.get_renderer().height
+        window = self.window(fig)
+        count = sum(len(items) for elements in layers for items in elements.values())
+        workers = self.workers if count >= EXPORT_PARALLEL_SHAPES else 1
+        tiles = self.tiles(window, workers)
+
+        # Coordinates, style ids and pixel extents of every shape, gathered once
+        gathered = []
+        for elements in layers:
+            shapes = {}
+            for element_type, items in elements.items():
+                if items:
+                    coords = coords_array(items, element_type)
+                    ids = batches = None
+                    if element_type != 'texts':
+                        ids = style_ids(items)
+                    if element_type in ('rectangles', 'lines'):
+                        batches = element_batches(element_type, coords, ids)
+                    extents = element_extents(ax, element_type, items, coords)
+                    shapes[element_type] = (items, coords, ids, batches, extents)
+            gathered.append(shapes)
+
+        table = list(styles.styles)
+        jobs = []
+        for left, top, right, bottom in tiles:
+            tile_layers = []
+            for rank, shapes in enumerate(gathered):
+                columns, texts = {}, []
+                for element_type, (items, coords, ids, batches, (x0, x1, y0, y1)) in shapes.items():
+                    hits = np.flatnonzero((x1 >= left) & (x0 <= right) &
+                                          (y1 >= height - bottom) & (y0 <= height - top))
+                    if not len(hits):
+                        continue
+                    if element_type == 'texts':
+                        texts = [items[i].values() for i in hits.tolist()]
+                    elif element_type == 'polylines':
+                        columns[element_type] = ([items[i].points for i in hits.tolist()], ids[hits], None)
+                    else:
+                        # Batched as in a render of the whole scene
+                        columns[element_type] = (coords[hits], ids[hits], None if batches is None else batches[hits])
+                # Layers stack as in the live view
+                tile_layers.append((3 * rank, columns, texts))
+            jobs.append((frame, (left, top, right, bottom), table, tile_layers))
+
+        pixels = np.zeros((window[3] - window[1], window[2] - window[0], 4), np.uint8)
+        for (left, top, right, bottom), tile in zip(tiles, self.draw(jobs, workers)):
+            pixels[top - window[1]:bottom - window[1], left - window[0]:right - window[0]] = tile
+        # The full-size figure is only worth keeping while its tiles are drawn
+        build_frame.cache_clear()
+        return pixels
+
+    def draw(self, jobs, workers):
+        if workers > 1:
+            try:
+                return list(self.executor().map(render_export_tile, jobs))
+            except (OSError, BrokenProcessPool) as e:
+                logger.warning(f"Export workers failed, drawing the tiles here: {e}")
+                self.pool = None
+        return [render_export_tile(job) for job in jobs]
+
+export_renderer = ExportRenderer()
+
+class TextLabels(Artist):
+    """
+    Many centred labels drawn as cached glyph runs from one artist, instead of
+    one Text artist with its own layout and rasterization per label.
+    """
+    zorder = 3
+
+    def __init__(self, texts):
+        super().__init__()
+        self.anchors = np.array(
+            [((t.x1 + t.x2) / 2, (t.y1 + t.y2) / 2) for t in texts], dtype=float
+        ).reshape(-1, 2)
+        self.labels = [(t.text, t.font_size, t.color) for t in texts]
+
+    def draw(self, renderer):
+        if not self.get_visible() or not self.labels:
+            return
+
+        points = self.get_transform().transform(self.anchors)
+        bbox = self.axes.bbox
+        gc = renderer.new_gc()
+        self._set_gc_clip(gc)
+
+        # Agg does not apply the clip rectangle exactly to images, so runs are cropped to it
+        clip = self.get_clip_box() if self.get_clip_on() else None
+        if clip is not None:
+            clip_x0, clip_y0 = math.floor(clip.x0), math.floor(clip.y0)
+            clip_x1, clip_y1 = math.ceil(clip.x1), math.ceil(clip.y1)
+
+        for (x, y), (text, font_size, color) in zip(points.tolist(), self.labels):
+            image = text_cache.run(text, font_size, color, renderer.dpi)
+            height, width = image.shape[:2]
+            left, bottom = round(x - width / 2), round(y - height / 2)
+            # Skip labels entirely outside the axes
+            if left > bbox.x1 or bottom > bbox.y1 or left + width < bbox.x0 or bottom + height < bbox.y0:
+                continue
+            if clip is not None:
+                # Rows are bottom first, so row i sits at y = bottom + i
+                x0, x1 = max(clip_x0 - left, 0), min(clip_x1 - left, width)
+                y0, y1 = max(clip_y0 - bottom, 0), min(clip_y1 - bottom, height)
+                if x0 >= x1 or y0 >= y1:
+                    continue
+                image = image[y0:y1, x0:x1]
+                left, bottom = left + x0, bottom + y0
+            renderer.draw_image(gc, left, bottom, image)
+
+        gc.restore()
+        self.stale = False
+
+TILE_SIZE = 256
+
+# Tk time spent rendering tiles per idle slice, and the pause after the last
+# zoom or pan step before the view is rendered exactly
+TILE_TIME_BUDGET = 0.02
+VIEW_SETTLE_MS = 150
+
+# Tiles overlapping more shapes than this are too slow to draw in one idle
+# slice; views that need them wait for the exact render instead
+TILE_SHAPE_LIMIT = 5000
+
+class TileCache:
+    """
+    Rendered tiles of every layer's zoom pyramid, least recently used first,
+    within one memory budget shared by all layers. Tiles with nothing on
+    them are kept as None and cost nothing.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.tiles = OrderedDict()
+        self.size = 0
+
+    def __contains__(self, key):
+        return key in self.tiles
+
+    def get(self, key):
+        self.tiles.move_to_end(key)
+        return self.tiles[key]
+
+    def put(self, key, tile):
+        self.discard([key])
+        self.tiles[key] = tile
+        self.size += 0 if tile is None else tile.nbytes
+        while self.size > self.budget:
+            _, old = self.tiles.popitem(last=False)
+            self.size -= 0 if old is None else old.nbytes
+
+    def discard(self, keys):
+        for key in keys:
+            if key in self.tiles:
+                tile = self.tiles.pop(key)
+                self.size -= 0 if tile is None else tile.nbytes
+
+    def keys_of(self, owner):
+        return [key for key in self.tiles if key[0] == owner]
+
+tile_cache = TileCache(TILE_MEMORY_BUDGET)
+
+def reduce_tile(pixels):
+    """Halve an RGBA tile in each direction, averaging colours by coverage."""
+    rows, columns = pixels.shape[0] // 2, pixels.shape[1] // 2
+    blocks = pixels.reshape(rows, 2, columns, 2, 4).astype(np.float32)
+    alpha = blocks[..., 3:].sum(axis=(1, 3))
+    rgb = (blocks[..., :3] * blocks[..., 3:]).sum(axis=(1, 3))
+    rgb = np.divide(rgb, alpha, out=np.zeros_like(rgb), where=alpha > 0)
+    return np.concatenate([rgb, alpha / 4], axis=2).round().astype(np.uint8)
+
+class TilePyramid:
+    """
+    Fixed-size Agg tiles of one layer at power-of-two zoom levels, anchored at
+    the drawing origin. Level 0 is the scale the pyramid was first shown at
+    and level L is 2**L times that. While the view zooms or pans, a layer is
+    shown as a mosaic of these tiles until its exact raster catches up. Edits
+    drop only the tiles their shapes' extents touch at each level.
+    """
+    MISSING = object()
+
+    def __init__(self, tile_size=TILE_SIZE):
+        self.id = uuid.uuid4().hex
+        self.tile_size = tile_size
+        self.base_scale = None
+        self.dpi = None
+        # Tiles left to the exact render for overlapping over TILE_SHAPE_LIMIT shapes
+        self.dense = set()
+        # Measured extents of the layer's shapes per level and type, as (count, arrays)
+        self.extents = {}
+        self.fig = Figure()
+        self.fig.patch.set_alpha(0)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_axes([0, 0, 1, 1])
+        self.ax.set_axis_off()
+
+    def scale_of(self, level):
+        return self.base_scale * 2.0 ** level
+
+    def attach(self, target_ax):
+        """Level of the view of target_ax; the first view fixes level 0, a dpi change starts over."""
+        xlim = target_ax.get_xlim()
+        scale = target_ax.bbox.width / (xlim[1] - xlim[0])
+        dpi = target_ax.figure.dpi
+        if dpi != self.dpi:
+            self.forget()
+            self.dpi = dpi
+            self.base_scale = scale
+        return math.ceil(math.log2(scale / self.base_scale) - 1e-9)
+
+    def _frame(self, level, i=0, j=0):
+        # Point the tile axes at one tile; tile (0, 0) maps data to level pixels
+        span = self.tile_size / self.scale_of(level)
+        self.fig.set_dpi(self.dpi)
+        self.fig.set_size_inches(self.tile_size / self.dpi, self.tile_size / self.dpi)
+        self.ax.set_xlim(i * span, (i + 1) * span)
+        self.ax.set_ylim(j * span, (j + 1) * span)
+
+    def _tile_range(self, target_ax, level, ring=0):
+        scale, size = self.scale_of(level), self.tile_size
+        xlim, ylim = target_ax.get_xlim(), target_ax.get_ylim()
+        return (math.floor(xlim[0] * scale / size) - ring, math.floor(xlim[1] * scale / size) + ring,
+                math.floor(ylim[0] * scale / size) - ring, math.floor(ylim[1] * scale / size) + ring)
+
+    def level_extents(self, level, element_type, items):
+        """Extents of a type's shapes in level pixels, measuring only shapes appended since last time."""
+        cached = self.extents.setdefault(level, {}).get(element_type)
+        if cached is not None and cached[0] == len(items):
+            return cached[1]
+
+        self._frame(level)
+        if cached is not None and cached[0] < len(items):
+            added = element_extents(self.ax, element_type, items[cached[0]:])
+            extents = tuple(np.concatenate(pair) for pair in zip(cached[1], added))
+        else:
+            extents = element_extents(self.ax, element_type, items)
+        self.extents[level][element_type] = (len(items), extents)
+        return extents
+
+    def render_tile(self, level, i, j, elements):
+        size = self.tile_size
+        overlapping = {}
+        for element_type, items in elements.items():
+            if items:
+                x0, x1, y0, y1 = self.level_extents(level, element_type, items)
+                hits = np.flatnonzero((x1 >= i * size) & (x0 <= (i + 1) * size) &
+                                      (y1 >= j * size) & (y0 <= (j + 1) * size))
+                if len(hits):
+                    overlapping[element_type] = [items[k] for k in hits.tolist()]
+
+        key = (self.id, level, i, j)
+        if not overlapping:
+            tile_cache.put(key, None)
+            return
+        if sum(len(items) for items in overlapping.values()) > TILE_SHAPE_LIMIT:
+            self.dense.add(key[1:])
+            return
+
+        self._frame(level, i, j)
+        renderer = self.canvas.get_renderer()
+        renderer.clear()
+        for artist in sorted(add_element_artists(self.ax, overlapping), key=lambda artist: artist.get_zorder()):
+            artist.draw(renderer)
+            artist.remove()
+        tile_cache.put(key, np.array(self.canvas.buffer_rgba()))
+
+    def tile(self, level, i, j):
+        """
+        Pixels of one tile, None if nothing is drawn there, or MISSING. A tile
+        not rendered yet is cut from a coarser one and enlarged, or reduced
+        from four finer ones.
+        """
+        key = (self.id, level, i, j)
+        if key in tile_cache:
+            return tile_cache.get(key)
+
+        size = self.tile_size
+        for up in (1, 2):
+            parent = (self.id, level - up, i >> up, j >> up)
+            if parent in tile_cache:
+                pixels = tile_cache.get(parent)
+                if pixels is None:
+                    return None
+                part = size >> up
+                # Tile rows run top down while j grows upwards
+                col = (i - ((i >> up) << up)) * part
+                row = ((1 << up) - 1 - (j - ((j >> up) << up))) * part
+                return pixels[row:row + part, col:col + part].repeat(1 << up, axis=0).repeat(1 << up, axis=1)
+
+        children = [(self.id, level + 1, 2 * i + di, 2 * j + dj) for dj in (1, 0) for di in (0, 1)]
+        if not all(child in tile_cache for child in children):
+            return self.MISSING
+        quarters = [tile_cache.get(child) for child in children]
+        if all(quarter is None for quarter in quarters):
+            return None
+        pixels = np.zeros((2 * size, 2 * size, 4), np.uint8)
+        for index, quarter in enumerate(quarters):
+            if quarter is not None:
+                row, col = (index // 2) * size, (index % 2) * size
+                pixels[row:row + size, col:col + size] = quarter
+        return reduce_tile(pixels)
+
+    def mosaic(self, target_ax):
+        """
+        The view of target_ax composed from tiles as (pixels, extent), or None
+        while some tile of it is missing at every usable level.
+        """
+        level = self.attach(target_ax)
+        size, scale = self.tile_size, self.scale_of(level)
+        i0, i1, j0, j1 = self._tile_range(target_ax, level)
+
+        pixels = np.zeros(((j1 - j0 + 1) * size, (i1 - i0 + 1) * size, 4), np.uint8)
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                tile = self.tile(level, i, j)
+                if tile is self.MISSING:
+                    return None
+                if tile is not None:
+                    row, col = (j1 - j) * size, (i - i0) * size
+                    pixels[row:row + size, col:col + size] = tile
+        extent = (i0 * size / scale, (i1 + 1) * size / scale, j0 * size / scale, (j1 + 1) * size / scale)
+        return pixels, extent
+
+    def wanted(self, target_ax):
+        """
+        Missing tiles worth rendering for the view of target_ax as (rank, key):
+        the view's level with a ring around it first, then one level out and
+        one level in.
+        """
+        level = self.attach(target_ax)
+        wanted = []
+        for rank, (lvl, ring) in enumerate(((level, 0), (level, 1), (level - 1, 1), (level + 1, 0))):
+            i0, i1, j0, j1 = self._tile_range(target_ax, lvl, ring)
+            for j in range(j1, j0 - 1, -1):
+                for i in range(i0, i1 + 1):
+                    if (self.id, lvl, i, j) not in tile_cache and (lvl, i, j) not in self.dense:
+                        wanted.append((rank, (lvl, i, j)))
+        return wanted
+
+    def forget(self, bounds_of=None, reshaped=True):
+        """
+        Drop the tiles an edit touched. bounds_of(ax) returns the edit's
+        (x0, x1, y0, y1) box in the pixels of ax, which is pointed at each
+        cached level in turn; without it, or if it returns None, every tile
+        goes. Edits other than appends also drop the measured extents and
+        which tiles were too dense to render.
+        """
+        if reshaped:
+            self.extents = {}
+            self.dense.clear()
+        keys = tile_cache.keys_of(self.id)
+        if bounds_of is None:
+            tile_cache.discard(keys)
+            self.extents = {}
+            self.dense.clear()
+            return
+
+        size = self.tile_size
+        for level in sorted({key[1] for key in keys}):
+            self._frame(level)
+            bounds = bounds_of(self.ax)
+            if bounds is None:
+                tile_cache.discard(keys)
+                self.extents = {}
+                self.dense.clear()
+                return
+            x0, x1, y0, y1 = bounds
+            tile_cache.discard([key for key in keys if key[1] == level and
+                                key[2] * size <= x1 and (key[2] + 1) * size >= x0 and
+                                key[3] * size <= y1 and (key[3] + 1) * size >= y0])
+
+class RasterCache:
+    """
+    Off-screen Agg raster of the committed shapes, shown in the live axes as a
+    single image. The raster covers the view plus a margin on every side, so
+    panning inside the margin and drawing previews never re-rasterize the scene.
+    """
+    def __init__(self, margin=0.5, zorder=1):
+        self.margin = margin
+        self.zorder = zorder
+        self.fig = Figure()
+        self.fig.patch.set_alpha(0)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_axes([0, 0, 1, 1])
+        self.ax.set_axis_off()
+        self.image = None
+        self.extent = None
+        self.scale = None
+        self.valid = False
+        self.pyramid = TilePyramid()
+
+    def invalidate(self):
+        self.valid = False
+
+    def detach(self):
+        # Call after the live axes were cleared, which removes the image
+        self.image = None
+        self.valid = False
+
+    def covers(self, target_ax):
+        """Whether the cached raster can display the current view of target_ax as is."""
+        if not self.valid or self.image is None:
+            return False
+
+        xlim, ylim = target_ax.get_xlim(), target_ax.get_ylim()
+        scale = target_ax.bbox.width / (xlim[1] - xlim[0])
+        if abs(scale - self.scale) > 1e-6 * self.scale:
+            return False
+
+        x0, x1, y0, y1 = self.extent
+        return x0 <= xlim[0] and xlim[1] <= x1 and y0 <= ylim[0] and ylim[1] <= y1
+
+    def render(self, target_ax, elements):
+        """Rasterize every element for the current view of target_ax."""
+        xlim, ylim = target_ax.get_xlim(), target_ax.get_ylim()
+        bbox = target_ax.bbox
+        dpi = target_ax.figure.dpi
+        grow = 1 + 2 * self.margin
+
+        x_pad = (xlim[1] - xlim[0]) * self.margin
+        y_pad = (ylim[1] - ylim[0]) * self.margin
+        self.extent = (xlim[0] - x_pad, xlim[1] + x_pad, ylim[0] - y_pad, ylim[1] + y_pad)
+        self.scale = bbox.width / (xlim[1] - xlim[0])
+
+        self.fig.set_dpi(dpi)
+        self.fig.set_size_inches(
+            max(1, round(bbox.width * grow)) / dpi,
+            max(1, round(bbox.height * grow)) / dpi
+        )
+        self.ax.clear()
+        self.ax.set_axis_off()
+        self.ax.set_xlim(self.extent[0], self.extent[1])
+        self.ax.set_ylim(self.extent[2], self.extent[3])
+
+        add_element_artists(self.ax, self.overlapping(elements))
+        self.canvas.draw()
+        self.valid = True
+        self._publish(target_ax)
+
+    def overlapping(self, elements):
+        """The elements whose extents reach into the raster; drawing the rest would only be clipped."""
+        width, height = self.fig.bbox.width, self.fig.bbox.height
+        inside = {}
+        for element_type, items in elements.items():
+            if items:
+                x0, x1, y0, y1 = element_extents(self.ax, element_type, items)
+                hits = np.flatnonzero((x1 >= 0) & (x0 <= width) & (y1 >= 0) & (y0 <= height))
+                inside[element_type] = items if len(hits) == len(items) else [items[i] for i in hits.tolist()]
+        return inside
+
+    def paint(self, element_type, elements):
+        """Draw new elements on top of the cached raster, skipping any that fall outside it."""
+        elements = self.overlapping({element_type: elements}).get(element_type)
+        if not elements:
+            return
+        for artist in add_element_artists(self.ax, {element_type: elements}):
+            self.ax.draw_artist(artist)
+            artist.remove()
+        self._publish_region(display_bounds(self.ax, element_type, elements))
+
+    def repaint(self, elements, bounds):
+        """
+        Re-rasterize one display-space (x0, x1, y0, y1) box of the cache, for
+        shapes removed or moved there. Every shape overlapping the box is drawn
+        again, clipped to it, in the same order as a full render.
+        """
+        region = pixel_box(bounds, self.fig.bbox)
+        if region is None:
+            return
+        x0, y0, x1, y1 = (int(v) for v in region.extents)
+        rows = self.image.get_array().shape[0]
+
+        # Reset to the transparent background a full render starts from
+        pixels = np.asarray(self.canvas.buffer_rgba())
+        pixels[rows - y1:rows - y0, x0:x1] = np.round(np.array(self.fig.patch.get_facecolor()) * 255)
+
+        overlapping = {}
+        for element_type, items in elements.items():
+            if items:
+                ex0, ex1, ey0, ey1 = element_extents(self.ax, element_type, items)
+                hits = np.flatnonzero((ex1 >= x0) & (ex0 <= x1) & (ey1 >= y0) & (ey0 <= y1))
+                overlapping[element_type] = [items[i] for i in hits.tolist()]
+
+        artists = add_element_artists(self.ax, overlapping)
+        for artist in sorted(artists, key=lambda artist: artist.get_zorder()):
+            artist.set_clip_box(region)
+            self.ax.draw_artist(artist)
+            artist.remove()
+        self._publish_region(bounds)
+
+    def _publish_region(self, bounds):
+        # Copy only the changed pixels into the displayed image
+        region = pixel_box(bounds, self.fig.bbox)
+        if region is None:
+            return
+        x0, y0, x1, y1 = (int(v) for v in region.extents)
+        image = self.image.get_array()
+        rows = image.shape[0]
+        image[rows - y1:rows - y0, x0:x1] = np.asarray(self.canvas.buffer_rgba())[rows - y1:rows - y0, x0:x1]
+        self.image.changed()
+
+    def show_tiles(self, target_ax):
+        """
+        Show the view of target_ax composed from the tile pyramid until the
+        next render, if the pyramid has all of it. The raster behind no
+        longer matches the image then, so nothing is painted onto it.
+        """
+        mosaic = self.pyramid.mosaic(target_ax)
+        if mosaic is None:
+            return False
+        self.valid = False
+        self._show(target_ax, *mosaic, interpolation='antialiased')
+        return True
+
+    def _publish(self, target_ax):
+        self._show(target_ax, np.array(self.canvas.buffer_rgba()), self.extent)
+
+    def _show(self, target_ax, pixels, extent, interpolation='nearest'):
+        if self.image is None:
+            self.image = AxesImage(target_ax, interpolation=interpolation, origin='upper', zorder=self.zorder)
+            self.image.set_data(pixels)
+            target_ax.add_image(self.image)
+        else:
+            self.image.set_data(pixels)
+            self.image.set_interpolation(interpolation)
+            self.image.set_visible(True)
+        self.image.set_extent(extent)
+
+@functools.lru_cache(maxsize=1024)
+def check_color(color):
+    color = str(color)
+    if not is_color_like(color):
+        raise ValueError(f"Invalid color: {color}")
+    return color
+
+def check_finite(shape, total):
+    # One check on the sum: it is finite only if every coordinate is
+    if not math.isfinite(total):
+        raise ValueError(f"{type(shape).__name__} coordinates must be finite numbers")
+
+Style = namedtuple('Style', ('color', 'filled', 'line_width', 'line_style'))
+
+class StyleTable:
+    """
+    Interned drawing styles. Shapes keep the small integer id of their style
+    instead of their own color string and fill flag. Each style's RGBA is
+    parsed once, when the style is first seen, and renderers look the colors
+    of a whole batch of shapes up by id in arrays() rather than parsing one
+    color name per shape. Ids are only meaningful within a session: project
+    files store the styles themselves.
+    """
+    def __init__(self):
+        self.styles = []
+        self.ids = {}
+        self.edge_rgba = []
+        self.face_rgba = []
+        self.cached = None
+        # Loader threads build shapes too
+        self.lock = threading.Lock()
+
+    def intern(self, color, filled=False, line_width=1.0, line_style='solid'):
+        key = (color, filled, line_width, line_style)
+        style_id = self.ids.get(key)
+        if style_id is None:
+            with self.lock:
+                style_id = self.ids.get(key)
+                if style_id is None:
+                    rgba = to_rgba(color)
+                    self.styles.append(Style(*key))
+                    self.edge_rgba.append(rgba)
+                    self.face_rgba.append(rgba if filled else (0.0, 0.0, 0.0, 0.0))
+                    style_id = len(self.styles) - 1
+                    self.ids[key] = style_id
+        return style_id
+
+    def __getitem__(self, style_id):
+        return self.styles[style_id]
+
+    def __len__(self):
+        return len(self.styles)
+
+    def arrays(self):
+        """(edge RGBA, face RGBA, line width, filled) arrays indexed by style id."""
+        cached = self.cached
+        if cached is None or len(cached[0]) != len(self.styles):
+            with self.lock:
+                cached = self.cached = (
+                    np.array(self.edge_rgba, float).reshape(-1, 4),
+                    np.array(self.face_rgba, float).reshape(-1, 4),
+                    np.array([style.line_width for style in self.styles], float),
+                    np.array([style.filled for style in self.styles], bool)
+                )
+        return cached
+
+styles = StyleTable()
+
+def style_ids(elements):
+    return np.array(list(map(operator.attrgetter('style'), elements)), np.intp)
+
+def style_keywords(ids):
+    """
+    Collection keywords drawing items in the styles with these ids: edge
+    and face RGBA taken from the style table, and line widths and styles,
+    given once when all the items share them.
+    """
+    edge, face, widths, _ = styles.arrays()
+    used = [styles[style_id] for style_id in np.unique(ids).tolist()]
+    # Two antialiasing flags keep matplotlib from drawing a collection of a
+    # single path as a marker, which rasterizes it differently: a shape then
+    # draws the same alone, as in an export tile, as among others
+    keywords = {'edgecolors': edge[ids], 'facecolors': face[ids], 'antialiaseds': (True, True)}
+    if len({style.line_width for style in used}) == 1:
+        keywords['linewidths'] = used[0].line_width
+    else:
+        keywords['linewidths'] = widths[ids]
+    if len({style.line_style for style in used}) == 1:
+        keywords['linestyles'] = used[0].line_style
+    else:
+        keywords['linestyles'] = [styles[style_id].line_style for style_id in ids.tolist()]
+    return keywords
+
+class Shape:
+    """
+    Base of the slotted shape types stored in layers. Each field is converted
+    and validated once, when the shape is built from JSON, script parameters
+    or tool input. Shapes are never changed in place afterwards: edits build a
+    new one with replace(), which lets the edit history share them safely.
+    """
+    __slots__ = ()
+    element_type = None
+    # Constructor arguments in order, as stored in project files
+    fields = ()
+    # Stroke width in points of the shape's style
+    line_width = 1.0
+
+    @classmethod
+    def from_dict(cls, data):
+        try:
+            return cls(**{name: data[name] for name in cls.fields if name in data})
+        except TypeError as e:
+            raise ValueError(f"Invalid {cls.element_type[:-1]}: {e}") from None
+
+    @property
+    def color(self):
+        return styles[self.style].color
+
+    @property
+    def filled(self):
+        return styles[self.style].filled
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.fields)
+
+    def to_dict(self):
+        return dict(zip(self.fields, self.values()))
+
+    def replace(self, **changes):
+        fields = self.to_dict()
+        fields.update(changes)
+        return type(self)(**fields)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __hash__(self):
+        return hash(self.values())
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={value!r}" for name, value in zip(self.fields, self.values()))
+        return f"{type(self).__name__}({fields})"
+
+class RectangleShape(Shape):
+    __slots__ = ('x1', 'x2', 'y1', 'y2', 'style')
+    fields = ('x1', 'x2', 'y1', 'y2', 'color', 'filled')
+    element_type = 'rectangles'
+
+    def __init__(self, x1, x2, y1, y2, color, filled=False):
+        self.x1 = float(x1)
+        self.x2 = float(x2)
+        self.y1 = float(y1)
+        self.y2 = float(y2)
+        check_finite(self, self.x1 + self.x2 + self.y1 + self.y2)
+        self.style = styles.intern(check_color(color), bool(filled), self.line_width)
+
+class LineShape(Shape):
+    __slots__ = ('x1', 'y1', 'x2', 'y2', 'style')
+    fields = ('x1', 'y1', 'x2', 'y2', 'color')
+    element_type = 'lines'
+    line_width = 2.0
+
+    def __init__(self, x1, y1, x2, y2, color):
+        self.x1 = float(x1)
+        self.y1 = float(y1)
+        self.x2 = float(x2)
+        self.y2 = float(y2)
+        check_finite(self, self.x1 + self.y1 + self.x2 + self.y2)
+        self.style = styles.intern(check_color(color), False, self.line_width)
+
+class CircleShape(Shape):
+    __slots__ = ('x', 'y', 'radius', 'style')
+    fields = ('x', 'y', 'radius', 'color', 'filled')
+    element_type = 'circles'
+
+    def __init__(self, x, y, radius, color, filled=False):
+        self.x = float(x)
+        self.y = float(y)
+        self.radius = float(radius)
+        check_finite(self, self.x + self.y + self.radius)
+        if self.radius < 0:
+            raise ValueError(f"Invalid radius: {radius}")
+        self.style = styles.intern(check_color(color), bool(filled), self.line_width)
+
+class TextShape(Shape):
+    __slots__ = ('x1', 'x2', 'y1', 'y2', 'text', 'style', 'font_size')
+    fields = ('x1', 'x2', 'y1', 'y2', 'text', 'color', 'font_size')
+    element_type = 'texts'
+
+    def __init__(self, x1, x2, y1, y2, text, color, font_size=10):
+        self.x1 = float(x1)
+        self.x2 = float(x2)
+        self.y1 = float(y1)
+        self.y2 = float(y2)
+        check_finite(self, self.x1 + self.x2 + self.y1 + self.y2)
+        self.text = str(text)
+        self.style = styles.intern(check_color(color), False, self.line_width)
+        self.font_size = int(font_size)
+        if self.font_size <= 0:
+            raise ValueError(f"Invalid font size: {font_size}")
+
+class PolylineShape(Shape):
+    """
+    A freehand stroke or polyline. Its vertices are one read-only (n, 2)
+    array, stored in project files as a flat x, y list; x1, x2, y1 and y2
+    are their bounding box, which is all indexes and culling look at.
+    """
+    __slots__ = ('points', 'x1', 'x2', 'y1', 'y2', 'style')
+    fields = ('points', 'color')
+    element_type = 'polylines'
+    line_width = 2.0
+
+    def __init__(self, points, color):
+        try:
+            points = np.array(points, dtype=float).reshape(-1, 2)
+        except ValueError:
+            raise ValueError("Polyline points must be x, y pairs") from None
+        if len(points) < 2:
+            raise ValueError("A polyline needs at least two points")
+        check_finite(self, points.sum())
+        points.flags.writeable = False
+        self.points = points
+        (self.x1, self.y1), (self.x2, self.y2) = points.min(axis=0).tolist(), points.max(axis=0).tolist()
+        self.style = styles.intern(check_color(color), False, self.line_width)
+
+    def values(self):
+        return tuple(self.points.ravel().tolist()), self.color
+
+    def replace(self, **changes):
+        # The vertices already are an array; only parse what changed
+        return PolylineShape(changes.get('points', self.points), changes.get('color', self.color))
+
+    def transformed(self, operation, args, center=None):
+        """The polyline moved, scaled or rotated with every vertex, as transform_coords moves lines."""
+        points = self.points
+        if operation == 'move':
+            points = points + args
+        elif operation == 'scale':
+            points = np.add(center, (points - center) * args[0])
+        elif operation == 'rotate':
+            theta = np.radians(args[0])
+            cos, sin = np.cos(theta), np.sin(theta)
+            points = np.add(center, (points - center) @ np.array([[cos, sin], [-sin, cos]]))
+        else:
+            raise ValueError(f"Unknown transform: {operation}")
+        return self.replace(points=points)
+
+SHAPE_TYPES = {cls.element_type: cls for cls in (RectangleShape, LineShape, CircleShape, TextShape, PolylineShape)}
+
+def shapes_from_json(elements):
+    """Build shapes from the element dicts stored in project files."""
+    return {
+        element_type: [SHAPE_TYPES[element_type].from_dict(data) for data in items]
+        for element_type, items in (elements or {}).items()
+    }
+
+class StrokeSimplifier:
+    """
+    Simplifies a stroke while it is drawn, one pointer position at a time.
+    A position becomes a vertex only once the segment from the last vertex
+    to the newest position no longer passes within tolerance of every
+    position in between: an opening-window method, the online relative of
+    Ramer-Douglas-Peucker. The stroke stays within tolerance of the path
+    the pointer took, and holds only the vertices kept and the positions
+    since the last one.
+    """
+    def __init__(self, x, y, tolerance):
+        self.tolerance = tolerance
+        self.vertices = [(x, y)]
+        self.pending = []
+
+    def add(self, x, y):
+        if (x, y) == (self.pending[-1] if self.pending else self.vertices[-1]):
+            return
+        if self.pending and not self.covers(x, y):
+            self.vertices.append(self.pending[-1])
+            self.pending = []
+        self.pending.append((x, y))
+
+    def covers(self, x, y):
+        # Whether the segment from the last vertex to (x, y) passes close to every pending position
+        start = np.array(self.vertices[-1])
+        direction = np.array((x, y)) - start
+        offsets = np.array(self.pending) - start
+        t = np.clip(offsets @ direction / max(direction @ direction, 1e-300), 0, 1)
+        return np.hypot(*(offsets - t[:, None] * direction).T).max() <= self.tolerance
+
+    def points(self):
+        """The kept vertices and the latest position, as an (n, 2) array."""
+        return np.array(self.vertices + self.pending[-1:], dtype=float)
+
+# Shapes per packed chunk; coordinates restart from absolute values in each
+PACKED_CHUNK_SIZE = 1024
+
+# Coordinate columns packed relative to another column of the same shape
+PACKED_RELATIVE = {
+    'rectangles': (('x2', 'x1'), ('y2', 'y1')),
+    'lines': (('x2', 'x1'), ('y2', 'y1')),
+    'texts': (('x2', 'x1'), ('y2', 'y1'))
+}
+
+def quantize_shape(shape, grid):
+    """The shape with its coordinates rounded to the grid exactly as unpack_chunk restores them."""
+    if shape.element_type == 'polylines':
+        return shape.replace(points=np.round(shape.points / grid) * grid)
+    fields = ELEMENT_COORDS[shape.element_type]
+    return shape.replace(**{field: round(getattr(shape, field) / grid) * grid for field in fields})
+
+def pack_chunk(element_type, items, grid):
+    """
+    Columns of one run of shapes. Coordinates become integer grid steps; the
+    far corner or end of a shape is stored relative to its first point and
+    every column as the difference from the shape before, so typical
+    drawings pack into small, repetitive numbers. Colors and fill flags are
+    stored as one column of style ids into the table save_project writes.
+    """
+    if element_type == 'polylines':
+        return pack_polylines(items, grid)
+    fields = ELEMENT_COORDS[element_type]
+    steps = np.round(coords_array(items, element_type) / grid).astype(np.int64)
+    for field, anchor in PACKED_RELATIVE.get(element_type, ()):
+        steps[:, fields.index(field)] -= steps[:, fields.index(anchor)]
+    steps = np.diff(steps, axis=0, prepend=np.zeros((1, len(fields)), np.int64))
+
+    chunk = {field: steps[:, column].tolist() for column, field in enumerate(fields)}
+    chunk['style'] = style_ids(items).tolist()
+    for name in SHAPE_TYPES[element_type].fields:
+        if name not in fields and name not in Style._fields:
+            chunk[name] = [getattr(shape, name) for shape in items]
+    return chunk
+
+def unpack_chunk(element_type, chunk, grid, stored_styles=()):
+    """Shapes from a pack_chunk column dict; stored_styles is the project file's style table."""
+    if element_type == 'polylines':
+        return unpack_polylines(chunk, grid, stored_styles)
+    fields = ELEMENT_COORDS[element_type]
+    shape_type = SHAPE_TYPES[element_type]
+    try:
+        steps = np.cumsum(np.column_stack([np.asarray(chunk[field], dtype=np.int64) for field in fields]), axis=0)
+        for field, anchor in PACKED_RELATIVE.get(element_type, ()):
+            steps[:, fields.index(field)] += steps[:, fields.index(anchor)]
+        coords = (steps * grid).T.tolist()
+        if 'style' in chunk:
+            stored = [stored_styles[style_id] for style_id in chunk['style']]
+            style_columns = dict(zip(('color', 'filled'), zip(*stored))) if stored else {'color': (), 'filled': ()}
+        else:
+            # Packed before styles were stored
+            style_columns = chunk
+        columns = [coords[fields.index(name)] if name in fields
+                   else style_columns[name] if name in Style._fields
+                   else chunk[name]
+                   for name in shape_type.fields]
+    except (KeyError, TypeError, IndexError) as e:
+        raise ValueError(f"Invalid packed {element_type}: {e}") from None
+    if len({len(column) for column in columns}) > 1:
+        raise ValueError(f"Invalid packed {element_type}: columns differ in length")
+    return [shape_type(*row) for row in zip(*columns)]
+
+def pack_polylines(items, grid):
+    """
+    pack_chunk for polylines: the vertex count of each, then the vertices
+    of the whole run as grid steps from the vertex before, which for a
+    stroke are a few steps each.
+    """
+    steps = np.round(np.concatenate([shape.points for shape in items]) / grid).astype(np.int64)
+    steps = np.diff(steps, axis=0, prepend=np.zeros((1, 2), np.int64))
+    return {
+        'counts': [len(shape.points) for shape in items],
+        'x': steps[:, 0].tolist(),
+        'y': steps[:, 1].tolist(),
+        'style': style_ids(items).tolist()
+    }
+
+def unpack_polylines(chunk, grid, stored_styles=()):
+    try:
+        counts = np.asarray(chunk['counts'], dtype=np.intp)
+        steps = np.column_stack((np.asarray(chunk['x'], dtype=np.int64), np.asarray(chunk['y'], dtype=np.int64)))
+        colors = [stored_styles[style_id][0] for style_id in chunk['style']]
+    except (KeyError, TypeError, IndexError, ValueError) as e:
+        raise ValueError(f"Invalid packed polylines: {e}") from None
+    if len(counts) != len(colors) or counts.sum() != len(steps):
+        raise ValueError("Invalid packed polylines: columns differ in length")
+    points = np.split(np.cumsum(steps, axis=0) * grid, np.cumsum(counts)[:-1])
+    return [PolylineShape(vertices, color) for vertices, color in zip(points, colors)]
+
+def pack_elements(elements, grid):
+    return {
+        element_type: [pack_chunk(element_type, items[start:start + PACKED_CHUNK_SIZE], grid)
+                       for start in range(0, len(items), PACKED_CHUNK_SIZE)]
+        for element_type in DRAW_ORDER
+        for items in [elements[element_type]]
+    }
+
+def empty_elements():
+    return {
+        'rectangles': [],
+        'lines': [],
+        'circles': [],
+        'texts': [],
+        'polylines': []
+    }
+
+# Cells per side of an element index grid, at most, and shapes per cell aimed for
+INDEX_GRID_LIMIT = 1024
+INDEX_CELL_SHAPES = 8
+
+# Shapes an element index checks one by one before grouping them again
+INDEX_UNGROUPED_LIMIT = 4096
+
+def gather_ranges(order, starts, stops):
+    """order[starts[0]:stops[0]], order[starts[1]:stops[1]], ... concatenated."""
+    lengths = stops - starts
+    keep = lengths > 0
+    starts, lengths = starts[keep], lengths[keep]
+    if not len(lengths):
+        return np.empty(0, order.dtype)
+    offsets = np.cumsum(lengths) - lengths
+    return order[np.arange(lengths.sum()) - np.repeat(offsets - starts, lengths)]
+
+class ElementIndex:
+    """
+    Secondary indexes over one of a layer's element lists, so scene queries
+    look only at shapes that may match instead of scanning the list: the
+    shapes' bounds and style ids as arrays, positions sorted by style id,
+    and positions sorted by the grid cell holding each shape's lower left
+    corner, which a shape inside a box must have inside it too.
+
+    Nothing is read until the first query. After that, shapes appended to
+    the list are read when a query finds it longer, and apply_action reports
+    every other change, so the arrays are patched rather than read again
+    from every shape. The sorted groupings cover a prefix of the list;
+    shapes past it are checked directly until there are enough to regroup.
+    """
+    def __init__(self, element_type):
+        self.element_type = element_type
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.bounds = np.empty((0, 4))
+        self.ids = np.empty(0, np.intp)
+        self.grouped = 0
+        self.by_style = None
+        self.by_cell = None
+
+    def read(self, items):
+        bounds = np.column_stack(element_bounds(self.element_type, coords_array(items, self.element_type)))
+        return bounds.reshape(-1, 4), style_ids(items)
+
+    def sync(self, elements):
+        """Read the shapes appended since the index last saw the list."""
+        if len(elements) < self.count:
+            # A change apply_action did not report; start over
+            self.reset()
+        if len(elements) == self.count:
+            return
+        bounds, ids = self.read(elements[self.count:])
+        if len(elements) > len(self.ids):
+            capacity = max(len(elements), 2 * len(self.ids))
+            self.bounds = np.concatenate([self.bounds[:self.count], np.empty((capacity - self.count, 4))])
+            self.ids = np.concatenate([self.ids[:self.count], np.empty(capacity - self.count, np.intp)])
+        self.bounds[self.count:len(elements)] = bounds
+        self.ids[self.count:len(elements)] = ids
+        self.count = len(elements)
+
+    def ungroup_from(self, position):
+        # Positions at or past this one moved or changed
+        if position < self.grouped:
+            self.grouped = 0
+            self.by_style = self.by_cell = None
+
+    def truncate(self, length):
+        """Shapes were removed from the end of the list."""
+        if length < self.count:
+            self.count = length
+            self.ungroup_from(length)
+
+    def update(self, elements, indices):
+        """Shapes at these positions were replaced."""
+        indices = indices[indices < self.count]
+        if len(indices):
+            self.bounds[indices], self.ids[indices] = self.read([elements[i] for i in indices.tolist()])
+            self.ungroup_from(int(indices.min()))
+
+    def delete(self, indices, length):
+        """Shapes at these positions were deleted, leaving length shapes."""
+        if self.count != length + len(indices):
+            self.reset()
+            return
+        keep = np.ones(self.count, bool)
+        keep[indices] = False
+        self.bounds, self.ids = self.bounds[:self.count][keep], self.ids[:self.count][keep]
+        self.count = length
+        if len(indices):
+            self.ungroup_from(int(indices.min()))
+
+    def insert(self, elements, indices):
+        """Shapes were inserted at these ascending positions of the list."""
+        if self.count != len(elements) - len(indices):
+            self.reset()
+            return
+        bounds, ids = self.read([elements[i] for i in indices.tolist()])
+        before = indices - np.arange(len(indices))
+        self.bounds = np.insert(self.bounds[:self.count], before, bounds, axis=0)
+        self.ids = np.insert(self.ids[:self.count], before, ids)
+        self.count = len(elements)
+        if len(indices):
+            self.ungroup_from(int(indices.min()))
+
+    def group(self):
+        count = self.count
+        ids = self.ids[:count]
+        order = np.argsort(ids, kind='stable')
+        self.by_style = (order, ids[order])
+
+        xmin, ymin = self.bounds[:count, 0], self.bounds[:count, 2]
+        side = int(min(max(math.sqrt(count / INDEX_CELL_SHAPES), 1), INDEX_GRID_LIMIT))
+        x0, y0 = xmin.min(), ymin.min()
+        cell = max(xmin.max() - x0, ymin.max() - y0) / side or 1.0
+        columns = side + 1
+        keys = np.floor((ymin - y0) / cell).astype(np.int64) * columns + np.floor((xmin - x0) / cell).astype(np.int64)
+        order = np.argsort(keys, kind='stable')
+        self.by_cell = (order, keys[order], x0, y0, cell, columns)
+        self.grouped = count
+
+    def style_ranges(self, style_match):
+        order, sorted_ids = self.by_style
+        wanted = np.flatnonzero(style_match)
+        return order, np.searchsorted(sorted_ids, wanted, 'left'), np.searchsorted(sorted_ids, wanted, 'right')
+
+    def cell_ranges(self, box):
+        order, keys, x0, y0, cell, columns = self.by_cell
+        c0, c1 = (min(max(math.floor((value - x0) / cell), 0), columns - 1) for value in box[:2])
+        r0 = max(math.floor((box[2] - y0) / cell), 0)
+        r1 = min(math.floor((box[3] - y0) / cell), int(keys[-1]) // columns)
+        rows = np.arange(r0, r1 + 1, dtype=np.int64) * columns
+        if box[1] < x0 or box[0] > x0 + cell * columns:
+            rows = rows[:0]
+        return order, np.searchsorted(keys, rows + c0, 'left'), np.searchsorted(keys, rows + c1, 'right')
+
+    def query(self, elements, style_match=None, box=None):
+        """
+        Ascending positions of the shapes whose style id is set in the
+        style_match mask and that lie inside box (x1, x2, y1, y2).
+        """
+        self.sync(elements)
+        if not self.count:
+            return np.empty(0, np.intp)
+        if self.count - self.grouped > max(INDEX_UNGROUPED_LIMIT, self.grouped // 4) or not self.grouped:
+            self.group()
+
+        # Start from whichever grouping leaves fewer shapes to check
+        plans = []
+        if style_match is not None:
+            plans.append(self.style_ranges(style_match))
+        if box is not None:
+            plans.append(self.cell_ranges(box))
+        if plans:
+            order, starts, stops = min(plans, key=lambda plan: (plan[2] - plan[1]).sum())
+            candidates = gather_ranges(order, starts, stops)
+        else:
+            candidates = np.arange(self.grouped)
+        candidates = np.concatenate([candidates, np.arange(self.grouped, self.count)])
+
+        mask = np.ones(len(candidates), bool)
+        if style_match is not None:
+            mask &= style_match[self.ids[candidates]]
+        if box is not None:
+            bounds = self.bounds[candidates]
+            mask &= ((bounds[:, 0] >= box[0]) & (bounds[:, 1] <= box[1])
+                     & (bounds[:, 2] >= box[2]) & (bounds[:, 3] <= box[3]))
+        return np.sort(candidates[mask])
+
+def query_elements(layer, element_types=None, color=None, box=None):
+    """
+    Positions of the layer's shapes matching every given filter, by element
+    type, answered from the layer's element indexes. Colors match by value,
+    so 'red' also finds '#ff0000'; box is (x1, x2, y1, y2) and matches the
+    shapes lying fully inside it.
+    """
+    style_match = None
+    if color is not None:
+        style_match = (styles.arrays()[0] == to_rgba(check_color(color))).all(axis=1)
+
+    found = {}
+    for element_type in element_types or ELEMENT_TYPES:
+        elements = layer.elements[element_type]
+        if elements:
+            indices = layer.indexes[element_type].query(elements, style_match, box)
+            if len(indices):
+                found[element_type] = indices
+    return found
+
+class Layer:
+    """
+    A named group of elements with its own z-order, visibility and lock flags.
+    Each layer keeps its own RasterCache, so editing one layer re-renders only
+    that layer and a hidden layer is skipped at draw time.
+    """
+    def __init__(self, name, z_order=0, visible=True, locked=False, elements=None, layer_id=None):
+        self.id = layer_id or str(uuid.uuid4())
+        self.name = name
+        self.z_order = z_order
+        self.visible = visible
+        self.locked = locked
+        self.elements = empty_elements()
+        self.elements.update(elements or {})
+        self.indexes = {element_type: ElementIndex(element_type) for element_type in ELEMENT_TYPES}
+        self.cache = RasterCache(zorder=1 + z_order * 0.01)
+
+    def to_dict(self, grid=None):
+        """The layer as stored in project files; with a grid, its shapes are packed with pack_elements."""
+        data = {
+            'id': self.id,
+            'name': self.name,
+            'z_order': self.z_order,
+            'visible': self.visible,
+            'locked': self.locked
+        }
+        if grid is not None:
+            data['packed'] = pack_elements(self.elements, grid)
+        else:
+            # In draw order, so a project streamed back in paints as it renders
+            data['elements'] = {
+                element_type: [shape.to_dict() for shape in self.elements[element_type]]
+                for element_type in DRAW_ORDER
+            }
+        return data
+
+    def snapshot(self):
+        """A copy of the layer that later edits leave alone; shapes are immutable, so the lists are all it copies."""
+        layer = copy.copy(self)
+        layer.elements = {element_type: list(items) for element_type, items in self.elements.items()}
+        return layer
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['name'],
+            z_order=data.get('z_order', 0),
+            visible=data.get('visible', True),
+            locked=data.get('locked', False),
+            elements=shapes_from_json(data.get('elements')),
+            layer_id=data.get('id')
+        )
+
+def shape_count(snapshot):
+    """Number of shapes in a history snapshot, {layer id: {element_type: shapes}}."""
+    return sum(len(items) for elements in snapshot.values() for items in elements.values())
+
+def action_size(action):
+    """Rough in-memory footprint of a history entry, in bytes."""
+    kind = action['action']
+    if kind == 'add':
+        return 256
+    if kind == 'add_batch':
+        return 256 * len(action['elements'])
+    if kind == 'replace':
+        return 256 * sum(len(items) for side in ('before', 'after') for items in action[side].values())
+    if kind == 'delete':
+        return 128 + sum(change['indices'].nbytes + 256 * len(change['elements'])
+                         for change in action['changes'].values())
+    size = 128
+    for change in action['changes'].values():
+        size += change['indices'].nbytes
+        if 'after_color' in change:
+            size += 64 * len(change['before_colors'])
+        elif 'after_elements' in change:
+            size += sum(256 + shape.points.nbytes for side in ('before_elements', 'after_elements')
+                        for shape in change[side])
+        else:
+            size += change['before'].nbytes + change['after'].nbytes
+    return size
+
+def encode_history(value):
+    if isinstance(value, np.ndarray):
+        return {'__ndarray__': value.tolist(), 'dtype': str(value.dtype)}
+    if isinstance(value, Shape):
+        return dict(value.to_dict(), __shape__=value.element_type)
+    raise TypeError(f"Cannot store {type(value).__name__} in the edit history")
+
+def decode_history(value):
+    if '__ndarray__' in value:
+        return np.array(value['__ndarray__'], dtype=value['dtype'])
+    if '__shape__' in value:
+        return SHAPE_TYPES[value.pop('__shape__')].from_dict(value)
+    return value
+
+class EditHistory:
+    """
+    Undo/redo log stored as blocks of actions. Every block opens with a snapshot
+    of each layer's element lists, so any step is at most one block of deltas
+    away. A block is closed once it holds block_size actions and its deltas
+    cost about as much as its snapshot, so snapshots of a large scene are
+    taken as rarely as replaying the deltas stays cheaper than reading one,
+    and snapshots grow the log by no more than the edits themselves. When the
+    log outgrows its memory budget the oldest blocks are written to gzip
+    files in the project's history folder and read back on demand.
+    """
+    def __init__(self, directory, memory_budget=HISTORY_MEMORY_BUDGET, block_size=100, snapshot=None):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.block_size = block_size
+        self.count = 0
+        self.cursor = 0
+        # Actions recorded since the log was opened, whatever was undone since
+        self.recorded = 0
+        self.blocks = []
+        self.loaded = None
+        # Background write started by the last save, which block files read back wait for
+        self.pending = None
+        self.start_block(snapshot or {})
+
+    def start_block(self, snapshot):
+        count = shape_count(snapshot)
+        self.blocks.append({
+            'start': self.count,
+            'length': 0,
+            'actions': [],
+            'snapshot': snapshot,
+            # Shapes are shared with the scene, so in memory a snapshot costs one reference per shape
+            'size': 16 * count,
+            # Written out, a snapshot costs what action_size counts for adding its shapes
+            'snapshot_cost': 256 * count,
+            'deltas': 0,
+            'file': None,
+            'dirty': True
+        })
+
+    def block_full(self, block):
+        # Capped at a quarter of the budget, so the open block never holds up spilling
+        return (block['length'] >= self.block_size
+                and block['deltas'] >= min(block['snapshot_cost'], self.memory_budget // 4))
+
+    def block_for(self, position):
+        """The block holding the snapshot nearest at or before a position."""
+        index = bisect.bisect_right([block['start'] for block in self.blocks], position) - 1
+        return self.blocks[max(index, 0)]
+
+    def block_path(self, block):
+        return os.path.join(self.directory, block['file'])
+
+    def contents(self, block):
+        """Return (actions, snapshot) for a block, reading it back from disk if it was spilled."""
+        if block['actions'] is not None:
+            return block['actions'], block['snapshot']
+        if self.loaded is None or self.loaded[0] is not block:
+            if self.pending is not None:
+                # The block may have been spilled after a save that has yet to write its file
+                wait([self.pending])
+            object_hook = decode_history
+            grid = block.get('grid')
+            if grid is not None:
+                def object_hook(value):
+                    value = decode_history(value)
+                    return quantize_shape(value, grid) if isinstance(value, Shape) else value
+            with gzip.open(self.block_path(block), 'rt') as f:
+                data = json.load(f, object_hook=object_hook)
+            self.loaded = (block, data['actions'], data['snapshot'])
+        return self.loaded[1], self.loaded[2]
+
+    def snapshot_of(self, block):
+        return self.contents(block)[1]
+
+    def action_at(self, position):
+        block = self.block_for(position)
+        return self.contents(block)[0][position - block['start']]
+
+    def undo_action(self):
+        return self.action_at(self.cursor - 1) if self.cursor > 0 else None
+
+    def redo_action(self):
+        return self.action_at(self.cursor) if self.cursor < self.count else None
+
+    def record(self, action, snapshot_source):
+        """
+        Append an action that has just been applied. Anything that could have
+        been redone is dropped first. snapshot_source() is called when a full
+        block needs a fresh snapshot of the scene.
+        """
+        if self.cursor < self.count:
+            self.truncate()
+
+        block = self.blocks[-1]
+        if block['actions'] is None:
+            self.reload(block)
+        block['actions'].append(action)
+        block['length'] += 1
+        size = action_size(action)
+        block['size'] += size
+        block['deltas'] += size
+        block['dirty'] = True
+        self.count += 1
+        self.cursor += 1
+        self.recorded += 1
+
+        if self.block_full(block):
+            self.start_block(snapshot_source())
+
+        self.enforce_budget()
+
+    def truncate(self):
+        # Blocks starting past the cursor only hold undone steps
+        # Their files stay until the next save, which may still be what the saved index points at
+        while len(self.blocks) > 1 and self.blocks[-1]['start'] > self.cursor:
+            self.blocks.pop()
+
+        block = self.blocks[-1]
+        if block['actions'] is None:
+            self.reload(block)
+        del block['actions'][self.cursor - block['start']:]
+        block['length'] = len(block['actions'])
+        self.measure(block)
+        block['dirty'] = True
+        self.count = self.cursor
+        self.loaded = None
+
+    def reload(self, block):
+        actions, snapshot = self.contents(block)
+        block['actions'], block['snapshot'] = actions, snapshot
+        self.measure(block)
+        self.loaded = None
+
+    @staticmethod
+    def measure(block):
+        count = shape_count(block['snapshot'])
+        block['deltas'] = sum(map(action_size, block['actions']))
+        block['size'] = 16 * count + block['deltas']
+        block['snapshot_cost'] = 256 * count
+
+    def memory_used(self):
+        return sum(block['size'] for block in self.blocks if block['actions'] is not None)
+
+    def enforce_budget(self):
+        """Spill the oldest in-memory blocks to disk until the log fits its budget."""
+        used = self.memory_used()
+        for block in self.blocks[:-1]:
+            if used <= self.memory_budget:
+                break
+            if block['actions'] is None:
+                continue
+            if block['dirty']:
+                self.write_block(block)
+            used -= block['size']
+            block['actions'] = None
+            block['snapshot'] = None
+
+    def write_block(self, block):
+        block['file'] = self.block_file_name(block)
+        self.write_file(block['file'], block['actions'], block['snapshot'])
+        block['dirty'] = False
+
+    @staticmethod
+    def block_file_name(block):
+        # A fresh file name each time, so files the saved index refers to are never overwritten
+        return f"block_{block['start']}_{uuid.uuid4().hex[:8]}.json.gz"
+
+    def write_file(self, file_name, actions, snapshot):
+        os.makedirs(self.directory, exist_ok=True)
+        with gzip.open(os.path.join(self.directory, file_name), 'wt', compresslevel=1) as f:
+            json.dump({'actions': actions, 'snapshot': snapshot}, f, default=encode_history)
+
+    def save(self, element_count):
+        """Write unsaved blocks and the index describing them."""
+        self.prepare_save(element_count)()
+
+    def prepare_save(self, element_count):
+        """
+        Take what save() writes and return a function writing it, which may
+        run on another thread while edits go on. Set pending to where it runs,
+        so blocks are only read back from disk once their files exist.
+        """
+        blocks = []
+        for block in self.blocks:
+            if block['actions'] is not None and block['dirty']:
+                block['file'] = self.block_file_name(block)
+                block['dirty'] = False
+                # The last block keeps taking actions; snapshots are never modified
+                blocks.append((block['file'], list(block['actions']), block['snapshot']))
+
+        # Listed now, so blocks spilled while the write runs are not taken for stale ones
+        kept = {block['file'] for block in self.blocks}
+        stale = [path for path in glob.glob(os.path.join(self.directory, "block_*.json.gz"))
+                 if os.path.basename(path) not in kept]
+        index = {
+            'count': self.count,
+            'cursor': self.cursor,
+            'block_size': self.block_size,
+            'element_count': element_count,
+            'blocks': [[block['start'], block['length'], block['file']] for block in self.blocks]
+        }
+
+        def write():
+            for file_name, actions, snapshot in blocks:
+                self.write_file(file_name, actions, snapshot)
+            os.makedirs(self.directory, exist_ok=True)
+            for path in stale:
+                os.remove(path)
+            with open(os.path.join(self.directory, "index.json"), 'w') as f:
+                json.dump(index, f)
+        return write
+
+    def remove_stale_files(self, kept=()):
+        # Blocks dropped by truncation, or spilled since the last save
+        for path in glob.glob(os.path.join(self.directory, "block_*.json.gz")):
+            if os.path.basename(path) not in kept:
+                os.remove(path)
+
+    @classmethod
+    def load(cls, directory, snapshot, memory_budget=HISTORY_MEMORY_BUDGET, grid=None):
+        """
+        Reopen a saved history. Blocks stay on disk until they are needed. A
+        history that no longer matches the saved elements is started afresh.
+        With a grid, the project was saved with rounded coordinates, so shapes
+        read back from the saved blocks are rounded the same way to match it.
+        """
+        element_count = shape_count(snapshot)
+        index_path = os.path.join(directory, "index.json")
+        index = None
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'r') as f:
+                    index = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read edit history in {directory}: {e}")
+
+        if index is not None and index.get('element_count') != element_count:
+            logger.warning(f"Discarding edit history in {directory}: it does not match the saved elements")
+            index = None
+
+        if index is None:
+            history = cls(directory, memory_budget, snapshot=snapshot)
+            history.remove_stale_files()
+            return history
+
+        history = cls(directory, memory_budget, index.get('block_size', 100))
+        history.blocks = [
+            {'start': start, 'length': length, 'actions': None, 'snapshot': None, 'size': 0,
+             'snapshot_cost': 0, 'deltas': 0, 'file': file_name, 'dirty': False, 'grid': grid}
+            for start, length, file_name in index['blocks']
+        ]
+        history.count = index['count']
+        history.cursor = index['cursor']
+        history.remove_stale_files({block['file'] for block in history.blocks})
+        return history
+
+def coords_array(elements, element_type, indices=None):
+    """Gather the numeric fields of elements into an (n, k) float array."""
+    fields = ELEMENT_COORDS[element_type]
+    if indices is not None:
+        elements = [elements[i] for i in indices.tolist()]
+    coords = np.array(list(map(operator.attrgetter(*fields), elements)), dtype=float)
+    return coords.reshape(len(elements), len(fields))
+
+def write_coords(elements, element_type, indices, coords):
+    # Replace rather than modify the shapes: the edit history may still reference them
+    fields = ELEMENT_COORDS[element_type]
+    for i, row in zip(indices.tolist(), coords.tolist()):
+        elements[i] = elements[i].replace(**dict(zip(fields, row)))
+
+def element_bounds(element_type, coords):
+    """Return (xmin, xmax, ymin, ymax) arrays for an (n, k) coordinate array."""
+    xs = coords[:, X_COLUMNS[element_type]]
+    ys = coords[:, Y_COLUMNS[element_type]]
+    xmin, xmax = xs.min(axis=1), xs.max(axis=1)
+    ymin, ymax = ys.min(axis=1), ys.max(axis=1)
+    if element_type == 'circles':
+        radius = coords[:, 2]
+        xmin, xmax, ymin, ymax = xmin - radius, xmax + radius, ymin - radius, ymax + radius
+    return xmin, xmax, ymin, ymax
+
+def element_extents(ax, element_type, elements, coords=None):
+    """
+    Screen-space (x0, x1, y0, y1) arrays around each element of one type,
+    including the stroke width and, for labels, the size of the rendered text.
+    """
+    if coords is None:
+        coords = coords_array(elements, element_type)
+    xmin, xmax, ymin, ymax = element_bounds(element_type, coords)
+    low = ax.transData.transform(np.column_stack((xmin, ymin)))
+    high = ax.transData.transform(np.column_stack((xmax, ymax)))
+    x0, x1 = np.minimum(low[:, 0], high[:, 0]), np.maximum(low[:, 0], high[:, 0])
+    y0, y1 = np.minimum(low[:, 1], high[:, 1]), np.maximum(low[:, 1], high[:, 1])
+
+    dpi = ax.figure.dpi
+    if element_type == 'texts':
+        # Labels are centred on their anchor, padded as in TextCache.run
+        sizes = np.array([text_cache.measure(element.text, element.font_size, dpi)[:2]
+                          for element in elements], dtype=float).reshape(-1, 2)
+        half = (sizes + 4) / 2 + 1
+        cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+        x0, x1, y0, y1 = cx - half[:, 0], cx + half[:, 0], cy - half[:, 1], cy + half[:, 1]
+
+    # Half the widest stroke (2 points) plus antialiasing
+    pad = dpi / 72 + 2
+    return x0 - pad, x1 + pad, y0 - pad, y1 + pad
+
+def display_bounds(ax, element_type, elements, coords=None):
+    """One screen-space (x0, x1, y0, y1) box around elements, or None if there are none."""
+    if not len(elements):
+        return None
+    x0, x1, y0, y1 = element_extents(ax, element_type, elements, coords)
+    return x0.min(), x1.max(), y0.min(), y1.max()
+
+def union_bounds(boxes):
+    boxes = [box for box in boxes if box is not None]
+    if not boxes:
+        return None
+    x0, x1, y0, y1 = zip(*boxes)
+    return min(x0), max(x1), min(y0), max(y1)
+
+def action_bounds(ax, layer, action):
+    """Screen-space box a history entry draws into, or None if it may touch anything."""
+    if action['action'] == 'add':
+        return display_bounds(ax, action['type'], [action['element']])
+    if action['action'] == 'add_batch':
+        return display_bounds(ax, action['type'], action['elements'])
+    if action['action'] == 'delete':
+        return union_bounds([display_bounds(ax, element_type, change['elements'])
+                             for element_type, change in action['changes'].items()])
+    if action['action'] != 'transform':
+        return None
+
+    # Both where the shapes were and where they are now
+    boxes = []
+    for element_type, change in action['changes'].items():
+        elements = [layer.elements[element_type][i] for i in change['indices'].tolist()]
+        if 'after_color' in change:
+            boxes.append(display_bounds(ax, element_type, elements))
+        elif 'after_elements' in change:
+            boxes.append(display_bounds(ax, element_type, change['before_elements']))
+            boxes.append(display_bounds(ax, element_type, change['after_elements']))
+        else:
+            boxes.append(display_bounds(ax, element_type, elements, change['before']))
+            boxes.append(display_bounds(ax, element_type, elements, change['after']))
+    return union_bounds(boxes)
+
+def artist_bounds(artist):
+    """Screen-space (x0, x1, y0, y1) box around a live artist such as a preview or outline."""
+    box = artist.get_window_extent()
+    pad = artist.figure.dpi / 72 + 2
+    return box.x0 - pad, box.x1 + pad, box.y0 - pad, box.y1 + pad
+
+def pixel_box(bounds, clip):
+    """Round a (x0, x1, y0, y1) box out to whole pixels inside a clipping Bbox, or None if they miss."""
+    x0, x1, y0, y1 = bounds
+    box = Bbox.from_extents(math.floor(x0), math.floor(y0), math.ceil(x1), math.ceil(y1))
+    return Bbox.intersection(box, clip)
+
+def crop_image(image, region):
+    """
+    A temporary copy of an origin='upper' AxesImage holding only the pixels
+    under a display-space Bbox, on the same pixel grid. Resampling a whole
+    layer raster just to redraw a few pixels of it would cost a full frame.
+    """
+    data = image.get_array()
+    rows, cols = data.shape[:2]
+    left, right, bottom, top = image.get_extent()
+    pixel_w, pixel_h = (right - left) / cols, (top - bottom) / rows
+
+    (x0, y0), (x1, y1) = image.get_transform().inverted().transform(
+        [[region.x0, region.y0], [region.x1, region.y1]])
+    col0 = max(math.floor((min(x0, x1) - left) / pixel_w) - 1, 0)
+    col1 = min(math.ceil((max(x0, x1) - left) / pixel_w) + 1, cols)
+    row0 = max(math.floor((top - max(y0, y1)) / pixel_h) - 1, 0)
+    row1 = min(math.ceil((top - min(y0, y1)) / pixel_h) + 1, rows)
+    if col0 >= col1 or row0 >= row1:
+        return None
+
+    crop = AxesImage(image.axes, interpolation=image.get_interpolation(), origin='upper',
+                     zorder=image.get_zorder())
+    crop.set_transform(image.get_transform())
+    crop.set_data(data[row0:row1, col0:col1])
+    crop.set_extent((left + col0 * pixel_w, left + col1 * pixel_w,
+                     top - row1 * pixel_h, top - row0 * pixel_h))
+    return crop
+
+def draw_region(ax, renderer, region):
+    """
+    Redraw everything an axes shows inside a display-space Bbox, in the same
+    z-order as a full draw, without touching pixels outside it.
+    """
+    artists = []
+    for child in ax.get_children():
+        if child is ax.patch or not child.get_visible():
+            continue
+        if isinstance(child, Axis):
+            # Tick marks and labels sit outside the axes; only grid lines fall inside
+            artists.extend((child.get_zorder(), line) for line in child.get_gridlines() if line.get_visible())
+        elif isinstance(child, AxesImage) and child.origin == 'upper':
+            crop = crop_image(child, region)
+            if crop is not None:
+                artists.append((child.get_zorder(), crop))
+        else:
+            artists.append((child.get_zorder(), child))
+
+    ordered = [ax.patch] + [artist for _, artist in sorted(artists, key=operator.itemgetter(0))]
+    for artist in ordered:
+        clip_box, clip_on = artist.get_clip_box(), artist.get_clip_on()
+        artist.set_clip_box(region if clip_box is None or not clip_on else Bbox.intersection(clip_box, region))
+        artist.set_clip_on(True)
+        if artist.clipbox is not None:
+            artist.draw(renderer)
+        artist.set_clip_box(clip_box)
+        artist.set_clip_on(clip_on)
+
+def transform_coords(element_type, coords, operation, args, center=None):
+    """
+    Apply a move, scale or rotate to an (n, k) coordinate array in one pass.
+    Rectangles stay axis-aligned: rotation moves their centre and swaps
+    width and height on odd quarter turns.
+    """
+    result = coords.copy()
+    xs, ys = X_COLUMNS[element_type], Y_COLUMNS[element_type]
+
+    if operation == 'move':
+        dx, dy = args
+        result[:, xs] += dx
+        result[:, ys] += dy
+
+    elif operation == 'scale':
+        factor = args[0]
+        cx, cy = center
+        result[:, xs] = cx + (result[:, xs] - cx) * factor
+        result[:, ys] = cy + (result[:, ys] - cy) * factor
+        if element_type == 'circles':
+            result[:, 2] *= factor
+
+    elif operation == 'rotate':
+        theta = np.radians(args[0])
+        cos, sin = np.cos(theta), np.sin(theta)
+        cx, cy = center
+
+        if element_type == 'rectangles':
+            mid_x = (result[:, 0] + result[:, 1]) / 2 - cx
+            mid_y = (result[:, 2] + result[:, 3]) / 2 - cy
+            half_w = (result[:, 1] - result[:, 0]) / 2
+            half_h = (result[:, 3] - result[:, 2]) / 2
+            if round(args[0] / 90) % 2:
+                half_w, half_h = half_h, half_w
+            new_x = cx + mid_x * cos - mid_y * sin
+            new_y = cy + mid_x * sin + mid_y * cos
+            result = np.column_stack((new_x - half_w, new_x + half_w, new_y - half_h, new_y + half_h))
+        else:
+            for x_col, y_col in zip(xs, ys):
+                dx = coords[:, x_col] - cx
+                dy = coords[:, y_col] - cy
+                result[:, x_col] = cx + dx * cos - dy * sin
+                result[:, y_col] = cy + dx * sin + dy * cos
+
+    else:
+        raise ValueError(f"Unknown transform: {operation}")
+
+    return result
+
+def apply_action(layer, action, reverse=False):
+    """
+    Apply a history entry to a layer's elements, or revert it when reverse
+    is set. Changes other than appends are reported to the layer's indexes.
+    """
+    if action['action'] == 'add':
+        elements = layer.elements[action['type']]
+        index = layer.indexes[action['type']]
+        if not reverse:
+            elements.append(action['element'])
+        elif elements and (elements[-1] is action['element'] or elements[-1] == action['element']):
+            elements.pop()
+            index.truncate(len(elements))
+        else:
+            elements.remove(action['element'])
+            index.reset()
+
+    elif action['action'] == 'add_batch':
+        elements = layer.elements[action['type']]
+        if not reverse:
+            elements.extend(action['elements'])
+        else:
+            # Batches are undone in stack order, so they sit at the end of the list
+            del elements[len(elements) - len(action['elements']):]
+            layer.indexes[action['type']].truncate(len(elements))
+
+    elif action['action'] == 'replace':
+        for element_type, elements in (action['before'] if reverse else action['after']).items():
+            layer.elements[element_type][:] = elements
+            layer.indexes[element_type].reset()
+
+    elif action['action'] == 'delete':
+        for element_type, change in action['changes'].items():
+            elements = layer.elements[element_type]
+            indices = change['indices']
+            if reverse:
+                merged = np.empty(len(elements) + len(indices), dtype=object)
+                keep = np.ones(len(merged), bool)
+                keep[indices] = False
+                merged[keep] = elements
+                merged[indices] = change['elements']
+                elements[:] = merged.tolist()
+                layer.indexes[element_type].insert(elements, indices)
+            else:
+                keep = np.ones(len(elements), bool)
+                keep[indices] = False
+                elements[:] = itertools.compress(elements, keep.tolist())
+                layer.indexes[element_type].delete(indices, len(elements))
+
+    elif action['action'] == 'transform':
+        for element_type, change in action['changes'].items():
+            elements = layer.elements[element_type]
+            indices = change['indices']
+            if 'after_color' in change:
+                if reverse:
+                    for i, color in zip(indices.tolist(), change['before_colors']):
+                        elements[i] = elements[i].replace(color=color)
+                else:
+                    for i in indices.tolist():
+                        elements[i] = elements[i].replace(color=change['after_color'])
+            elif 'after_elements' in change:
+                for i, shape in zip(indices.tolist(), change['before_elements' if reverse else 'after_elements']):
+                    elements[i] = shape
+            else:
+                write_coords(elements, element_type, indices,
+                             change['before'] if reverse else change['after'])
+            layer.indexes[element_type].update(elements, indices)
+
+def normalize_element_type(name):
+    """Accept 'circle', 'CIRCLES' etc. for the 'circles' element type."""
+    element_type = name.lower().rstrip('s') + 's'
+    if element_type not in ELEMENT_TYPES:
+        raise ValueError(f"Unknown shape type: {name}")
+    return element_type
+
+def degenerate_mask(element_type, elements, coords, tolerance):
+    """True for shapes that draw nothing: zero-size rectangles, zero-length lines, etc."""
+    if element_type == 'rectangles':
+        return (np.abs(coords[:, 1] - coords[:, 0]) <= tolerance) | (np.abs(coords[:, 3] - coords[:, 2]) <= tolerance)
+    if element_type == 'lines':
+        return np.hypot(coords[:, 2] - coords[:, 0], coords[:, 3] - coords[:, 1]) <= tolerance
+    if element_type == 'circles':
+        return coords[:, 2] <= tolerance
+    if element_type == 'polylines':
+        return (np.abs(coords[:, 1] - coords[:, 0]) <= tolerance) & (np.abs(coords[:, 3] - coords[:, 2]) <= tolerance)
+    return np.array([not element.text.strip() for element in elements], dtype=bool)
+
+def dedupe_elements(element_type, elements, coords):
+    """Keep the first of each set of identical shapes, hashing their normalized fields."""
+    coords = coords.copy()
+    if element_type == 'rectangles':
+        coords[:, 0:2].sort(axis=1)
+        coords[:, 2:4].sort(axis=1)
+    elif element_type == 'lines':
+        # A segment is the same whichever end it was drawn from
+        swap = (coords[:, 0] > coords[:, 2]) | ((coords[:, 0] == coords[:, 2]) & (coords[:, 1] > coords[:, 3]))
+        coords[swap] = coords[swap][:, [2, 3, 0, 1]]
+
+    unique = {}
+    for element, row in zip(elements, coords.tolist()):
+        if element_type == 'polylines':
+            # The vertices fix the bounding box
+            key = (element.points.tobytes(), element.style)
+        else:
+            key = (*row, *(getattr(element, name) for name in element.__slots__
+                           if name not in ELEMENT_COORDS[element_type]))
+        unique.setdefault(key, element)
+    return list(unique.values())
+
+def merge_collinear_lines(lines, tolerance):
+    """
+    Merge overlapping or touching collinear lines of the same color. Lines are
+    grouped by color, direction and offset from the origin, sorted along their
+    direction, and overlapping intervals are joined with a running maximum.
+    """
+    coords = coords_array(lines, 'lines')
+    count = len(lines)
+
+    delta = coords[:, 2:4] - coords[:, 0:2]
+    angle = np.arctan2(delta[:, 1], delta[:, 0]) % np.pi
+    angle[np.isclose(angle, np.pi)] = 0
+    direction = np.column_stack((np.cos(angle), np.sin(angle)))
+    normal = np.column_stack((-direction[:, 1], direction[:, 0]))
+
+    offset = (coords[:, 0:2] * normal).sum(axis=1)
+    t_a = (coords[:, 0:2] * direction).sum(axis=1)
+    t_b = (coords[:, 2:4] * direction).sum(axis=1)
+    t_start, t_end = np.minimum(t_a, t_b), np.maximum(t_a, t_b)
+    # Lines share a style exactly when they share a color
+    color_ids = style_ids(lines)
+
+    angle_key, offset_key = np.round(angle, 9), np.round(offset, 6)
+    order = np.lexsort((t_start, offset_key, angle_key, color_ids))
+    keys = np.column_stack((color_ids, angle_key, offset_key))[order]
+    new_group = np.ones(count, dtype=bool)
+    new_group[1:] = (keys[1:] != keys[:-1]).any(axis=1)
+
+    # Shift each group past the previous one so one running maximum serves all groups
+    span = 2 * (t_end.max() - t_start.min() + 1)
+    shift = (np.cumsum(new_group) - 1) * span
+    starts, ends = t_start[order] + shift, t_end[order] + shift
+    reach = np.maximum.accumulate(ends)
+    new_segment = new_group.copy()
+    new_segment[1:] |= starts[1:] > reach[:-1] + tolerance
+
+    segment_starts = np.flatnonzero(new_segment)
+    segment_ends = np.append(segment_starts[1:], count) - 1
+    segment_ids = np.cumsum(new_segment) - 1
+
+    # The member reaching furthest supplies each merged segment's end point
+    by_end = np.lexsort((ends, segment_ids))
+    first_members = order[segment_starts]
+    last_members = order[by_end[segment_ends]]
+    first_index = np.minimum.reduceat(order, segment_starts)
+
+    merged = []
+    for segment in np.argsort(first_index, kind='stable').tolist():
+        first, last = int(first_members[segment]), int(last_members[segment])
+        if segment_starts[segment] == segment_ends[segment]:
+            merged.append(lines[first])
+            continue
+
+        start = coords[first, 0:2] if t_a[first] <= t_b[first] else coords[first, 2:4]
+        end = coords[last, 2:4] if t_a[last] <= t_b[last] else coords[last, 0:2]
+        merged.append(lines[first].replace(x1=start[0], y1=start[1], x2=end[0], y2=end[1]))
+
+    return merged
+
+def compact_elements(elements, tolerance=1e-9):
+    """
+    Drop degenerate shapes and exact duplicates and merge overlapping
+    collinear lines. Returns the compacted elements and a report.
+    """
+    compacted = empty_elements()
+    report = {'before': 0, 'after': 0, 'degenerate': 0, 'duplicates': 0, 'merged': 0}
+
+    for element_type in ELEMENT_TYPES:
+        items = elements.get(element_type, [])
+        report['before'] += len(items)
+        if not items:
+            continue
+
+        coords = coords_array(items, element_type)
+        keep = ~degenerate_mask(element_type, items, coords, tolerance)
+        report['degenerate'] += len(items) - int(keep.sum())
+        indices = np.flatnonzero(keep)
+        items = [items[i] for i in indices.tolist()]
+
+        unique = dedupe_elements(element_type, items, coords[indices])
+        report['duplicates'] += len(items) - len(unique)
+
+        if element_type == 'lines' and unique:
+            merged = merge_collinear_lines(unique, tolerance)
+            report['merged'] += len(unique) - len(merged)
+            unique = merged
+
+        compacted[element_type] = unique
+
+    report['after'] = sum(len(items) for items in compacted.values())
+    return compacted, report
+
+def format_compaction_report(report):
+    removed = report['before'] - report['after']
+    percent = 100 * removed / report['before'] if report['before'] else 0
+    return (f"Removed {report['duplicates']} duplicates and {report['degenerate']} degenerate shapes, "
+            f"merged away {report['merged']} lines: {report['before']} -> {report['after']} shapes "
+            f"({percent:.1f}% smaller)")
+
+SVG_NUMBER = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+SVG_UNITS = {'': 1.0, 'px': 1.0, 'pt': 4 / 3, 'pc': 16.0, 'mm': 96 / 25.4, 'cm': 96 / 2.54, 'in': 96.0}
+
+# Containers whose content is never drawn directly
+SVG_HIDDEN = {'defs', 'clipPath', 'mask', 'marker', 'pattern', 'symbol'}
+SVG_SHAPES = {'rect', 'line', 'circle', 'polyline', 'polygon', 'text'}
+
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+def compose_affine(m, n):
+    """The affine (a, b, c, d, e, f) applying n first and then m, as in SVG's matrix()."""
+    return (
+        m[0] * n[0] + m[2] * n[1], m[1] * n[0] + m[3] * n[1],
+        m[0] * n[2] + m[2] * n[3], m[1] * n[2] + m[3] * n[3],
+        m[0] * n[4] + m[2] * n[5] + m[4], m[1] * n[4] + m[3] * n[5] + m[5]
+    )
+
+def apply_affine(m, x, y):
+    return m[0] * x + m[2] * y + m[4], m[1] * x + m[3] * y + m[5]
+
+def parse_svg_length(value, default=0.0):
+    if value is None:
+        return default
+    match = re.match(rf'\s*({SVG_NUMBER})\s*([a-z]*)', value)
+    if match is None:
+        return default
+    return float(match.group(1)) * SVG_UNITS.get(match.group(2), 1.0)
+
+def parse_svg_transform(text):
+    """Flatten an SVG transform list into one affine."""
+    matrix = IDENTITY
+    for name, args in re.findall(r'(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)', text):
+        values = [float(value) for value in re.findall(SVG_NUMBER, args)]
+        if name == 'matrix':
+            step = tuple(values[:6])
+        elif name == 'translate':
+            step = (1.0, 0.0, 0.0, 1.0, values[0], values[1] if len(values) > 1 else 0.0)
+        elif name == 'scale':
+            step = (values[0], 0.0, 0.0, values[1] if len(values) > 1 else values[0], 0.0, 0.0)
+        elif name == 'rotate':
+            angle = math.radians(values[0])
+            cos, sin = math.cos(angle), math.sin(angle)
+            cx, cy = values[1:3] if len(values) >= 3 else (0.0, 0.0)
+            step = (cos, sin, -sin, cos, cx - cos * cx + sin * cy, cy - sin * cx - cos * cy)
+        elif name == 'skewX':
+            step = (1.0, 0.0, math.tan(math.radians(values[0])), 1.0, 0.0, 0.0)
+        else:
+            step = (1.0, math.tan(math.radians(values[0])), 0.0, 1.0, 0.0, 0.0)
+        matrix = compose_affine(matrix, step)
+    return matrix
+
+def svg_color(value):
+    """A matplotlib color for an SVG paint, or None when nothing is painted."""
+    if value is None or value.strip() == 'none':
+        return None
+    value = value.strip()
+    match = re.fullmatch(r'rgb\(\s*([^,]+),\s*([^,]+),\s*([^)]+)\)', value)
+    if match:
+        channels = [float(part.rstrip('%')) * (2.55 if part.endswith('%') else 1) for part in match.groups()]
+        value = '#' + ''.join(f"{min(max(round(channel), 0), 255):02x}" for channel in channels)
+    try:
+        return check_color(value)
+    except ValueError:
+        # Gradients, patterns and currentColor have no single color
+        return 'black'
+
+def svg_style(element, inherited):
+    """Resolve fill, stroke and font size from attributes and the style attribute."""
+    style = inherited
+    declared = {name: element.get(name) for name in ('fill', 'stroke', 'font-size') if element.get(name) is not None}
+    for declaration in element.get('style', '').split(';'):
+        name, _, value = declaration.partition(':')
+        if name.strip() in ('fill', 'stroke', 'font-size'):
+            declared[name.strip()] = value.strip()
+    if declared:
+        style = dict(inherited, **declared)
+    return style
+
+def svg_root_transform(element, fallback_height):
+    """Map SVG user units to Ziggle coordinates: apply the viewBox and flip y upwards."""
+    view_box = [float(value) for value in re.findall(SVG_NUMBER, element.get('viewBox', ''))]
+    width = parse_svg_length(element.get('width'), view_box[2] if len(view_box) == 4 else 0.0)
+    height = parse_svg_length(element.get('height'), view_box[3] if len(view_box) == 4 else fallback_height)
+
+    matrix = IDENTITY
+    if len(view_box) == 4 and view_box[2] > 0 and view_box[3] > 0:
+        scale_x, scale_y = width / view_box[2], height / view_box[3]
+        matrix = (scale_x, 0.0, 0.0, scale_y, -view_box[0] * scale_x, -view_box[1] * scale_y)
+    return compose_affine((1.0, 0.0, 0.0, -1.0, 0.0, height), matrix)
+
+def svg_element_shapes(tag, element, matrix, style):
+    """Convert one SVG element into (element_type, shape) pairs in Ziggle coordinates."""
+    fill, stroke = svg_color(style.get('fill', 'black')), svg_color(style.get('stroke'))
+    scale = math.sqrt(abs(matrix[0] * matrix[3] - matrix[1] * matrix[2]))
+
+    if tag == 'rect':
+        x, y = parse_svg_length(element.get('x')), parse_svg_length(element.get('y'))
+        width, height = parse_svg_length(element.get('width')), parse_svg_length(element.get('height'))
+        color = fill or stroke
+        if color is None or width <= 0 or height <= 0:
+            return []
+        corners = [apply_affine(matrix, cx, cy) for cx, cy in
+                   ((x, y), (x + width, y), (x + width, y + height), (x, y + height))]
+        if matrix[1] == 0 and matrix[2] == 0:
+            xs, ys = [c[0] for c in corners], [c[1] for c in corners]
+            return [('rectangles', RectangleShape(min(xs), max(xs), min(ys), max(ys), color, fill is not None))]
+        # Rotated or skewed rectangles keep their outline as lines
+        return [('lines', LineShape(*corners[i], *corners[(i + 1) % 4], color)) for i in range(4)]
+
+    if tag == 'circle':
+        color = fill or stroke
+        radius = parse_svg_length(element.get('r'))
+        if color is None or radius <= 0:
+            return []
+        cx, cy = apply_affine(matrix, parse_svg_length(element.get('cx')), parse_svg_length(element.get('cy')))
+        return [('circles', CircleShape(cx, cy, radius * scale, color, fill is not None))]
+
+    if tag == 'text':
+        text = ' '.join(''.join(element.itertext()).split())
+        if not text:
+            return []
+        x = parse_svg_length((element.get('x') or '0').replace(',', ' ').split()[0])
+        y = parse_svg_length((element.get('y') or '0').replace(',', ' ').split()[0])
+        x, y = apply_affine(matrix, x, y)
+        font_size = max(1, round(parse_svg_length(style.get('font-size'), 16.0) * scale))
+        return [('texts', TextShape(x, x, y, y, text, fill or stroke or 'black', font_size))]
+
+    color = stroke or 'black'
+    if tag == 'line':
+        points = [(parse_svg_length(element.get('x1')), parse_svg_length(element.get('y1'))),
+                  (parse_svg_length(element.get('x2')), parse_svg_length(element.get('y2')))]
+    else:
+        values = [float(value) for value in re.findall(SVG_NUMBER, element.get('points', ''))]
+        points = list(zip(values[0::2], values[1::2]))
+        if tag == 'polygon' and len(points) > 2:
+            points.append(points[0])
+
+    points = [apply_affine(matrix, x, y) for x, y in points]
+    if len(points) > 2:
+        return [('polylines', PolylineShape(points, color))]
+    return [('lines', LineShape(*start, *end, color)) for start, end in zip(points, points[1:])]
+
+class ProgressReader:
+    """File wrapper counting the bytes a streaming parser has consumed."""
+    def __init__(self, file):
+        self.file = file
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.bytes_read += len(data)
+        return data
+
+def iter_svg_shapes(path, fallback_height=0.0, chunk_size=5000, cancelled=None):
+    """
+    Stream shapes out of an SVG file as (fraction_read, {element_type: shapes})
+    chunks. The document is parsed with iterparse and every element is dropped
+    once handled, so memory follows the chunk size rather than the file size.
+    """
+    total = max(os.path.getsize(path), 1)
+    chunk, count = empty_elements(), 0
+    with open(path, 'rb') as f:
+        reader = ProgressReader(f)
+        # Per open element: (element, affine, style, hidden, inside_text)
+        stack = []
+        for event, element in ET.iterparse(reader, events=('start', 'end')):
+            tag = element.tag.rpartition('}')[2]
+            if event == 'start':
+                if stack:
+                    _, matrix, style, hidden, inside_text = stack[-1]
+                else:
+                    matrix, style, hidden, inside_text = svg_root_transform(element, fallback_height), {}, False, False
+                transform = element.get('transform')
+                if transform:
+                    matrix = compose_affine(matrix, parse_svg_transform(transform))
+                stack.append((element, matrix, svg_style(element, style), hidden or tag in SVG_HIDDEN,
+                              inside_text or tag == 'text'))
+                continue
+
+            _, matrix, style, hidden, inside_text = stack.pop()
+            if tag in SVG_SHAPES and not hidden:
+                try:
+                    for element_type, shape in svg_element_shapes(tag, element, matrix, style):
+                        chunk[element_type].append(shape)
+                        count += 1
+                except ValueError as e:
+                    logger.warning(f"Skipping SVG {tag}: {e}")
+
+            # Drop the handled element so the tree never grows with the file; a
+            # label's tspans are kept until the label itself is read
+            if tag == 'text' or not inside_text:
+                element.clear()
+                if stack and len(stack[-1][0]) and stack[-1][0][-1] is element:
+                    del stack[-1][0][-1]
+
+            if count >= chunk_size:
+                yield reader.bytes_read / total, chunk
+                chunk, count = empty_elements(), 0
+                if cancelled is not None and cancelled.is_set():
+                    return
+
+    yield 1.0, chunk
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class JsonStream:
+    """
+    Reads one JSON document from a text file a block at a time. Objects and
+    arrays can be walked member by member while everything else is decoded
+    whole, so a huge document is never parsed in a single call.
+    """
+    # Unread text kept buffered, more than any number or shape dict needs
+    LOOKAHEAD = 1 << 16
+
+    def __init__(self, file, block_size=1 << 20):
+        self.file = file
+        self.block_size = block_size
+        self.decoder = json.JSONDecoder()
+        self.text = ''
+        self.pos = 0
+        self.consumed = 0
+        self.eof = False
+
+    @property
+    def chars_read(self):
+        return self.consumed + self.pos
+
+    def _fill(self, wanted=LOOKAHEAD):
+        while not self.eof and len(self.text) - self.pos < wanted:
+            block = self.file.read(self.block_size)
+            self.eof = not block
+            self.consumed += self.pos
+            self.text = self.text[self.pos:] + block
+            self.pos = 0
+
+    def peek(self):
+        """The next non-blank character, or '' at the end of the file."""
+        while True:
+            self._fill()
+            self.pos = JSON_WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text) or self.eof:
+                return self.text[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected '{char}' but found '{found}' at character {self.chars_read}")
+        self.pos += 1
+
+    def value(self):
+        """Decode the next value whole."""
+        self.peek()
+        while True:
+            try:
+                value, self.pos = self.decoder.raw_decode(self.text, self.pos)
+                return value
+            except json.JSONDecodeError as e:
+                # A long string may run past the buffered text
+                if self.eof:
+                    raise ValueError(f"{e.msg} at character {self.consumed + e.pos}") from None
+                self._fill(len(self.text) - self.pos + self.block_size)
+
+    def members(self):
+        """Yield the keys of the next object; each value must be read before the next key."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() != ',':
+                self.expect('}')
+                return
+            self.pos += 1
+
+    def items(self):
+        """Yield the indices of the next array; each item must be read before the next index."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            if self.peek() != ',':
+                self.expect(']')
+                return
+            self.pos += 1
+            index += 1
+
+def write_project_file(project_dir, state, compressed=False):
+    """
+    Write project_state.json, or project_state.json.gz when compressed. The
+    file is written under a temporary name and moved into place, so a load
+    never reads a half-written save.
+    """
+    project_info_path = os.path.join(project_dir, "project_state.json")
+    if compressed:
+        path, stale_path = project_info_path + ".gz", project_info_path
+    else:
+        path, stale_path = project_info_path, project_info_path + ".gz"
+
+    partial_path = path + ".partial"
+    if compressed:
+        with gzip.open(partial_path, 'wt', encoding='utf-8') as f:
+            json.dump(state, f, separators=(',', ':'))
+    else:
+        with open(partial_path, 'w') as f:
+            json.dump(state, f, indent=4)
+    os.replace(partial_path, path)
+
+    # Keep one form only, so loading never picks up an older save
+    if os.path.exists(stale_path):
+        os.remove(stale_path)
+
+def iter_project_file(path, chunk_size=5000):
+    """
+    Stream a saved project_state.json, or a gzipped one, as ('layer', index,
+    fields) before each layer's shapes, ('shapes', index, fraction_read,
+    {element_type: shapes}) chunks, and finally ('project', fields). Layer
+    fields exclude the shapes; save_project writes them first, and any
+    stored after a layer's shapes are ignored.
+    """
+    total = max(os.path.getsize(path), 1)
+    with open(path, 'rb') as raw:
+        if path.endswith('.gz'):
+            text = io.TextIOWrapper(gzip.GzipFile(fileobj=raw), encoding='utf-8')
+        else:
+            text = io.TextIOWrapper(raw, encoding='utf-8')
+        stream = JsonStream(text)
+        project = {}
+
+        def shape_chunks(index, packed):
+            storage = project.get('storage', {})
+            grid = storage.get('grid', STORAGE_GRID)
+            chunk, count = empty_elements(), 0
+            for element_type in stream.members():
+                if element_type not in SHAPE_TYPES:
+                    raise ValueError(f"Unknown element type: {element_type}")
+                shape_type = SHAPE_TYPES[element_type]
+                for _ in stream.items():
+                    if packed:
+                        shapes = unpack_chunk(element_type, stream.value(), grid, storage.get('styles', ()))
+                    else:
+                        shapes = [shape_type.from_dict(stream.value())]
+                    chunk[element_type].extend(shapes)
+                    count += len(shapes)
+                    if count >= chunk_size:
+                        yield 'shapes', index, raw.tell() / total, chunk
+                        chunk, count = empty_elements(), 0
+            if count:
+                yield 'shapes', index, raw.tell() / total, chunk
+
+        for key in stream.members():
+            if key == 'layers':
+                for index in stream.items():
+                    fields, announced = {}, False
+                    for field in stream.members():
+                        if field in ('elements', 'packed'):
+                            if not announced:
+                                yield 'layer', index, dict(fields)
+                                announced = True
+                            yield from shape_chunks(index, field == 'packed')
+                        else:
+                            fields[field] = stream.value()
+                    if not announced:
+                        yield 'layer', index, fields
+            elif key == 'elements':
+                # Older projects stored one flat element dict
+                yield 'layer', 0, {'name': "Layer 1"}
+                yield from shape_chunks(0, False)
+            else:
+                project[key] = stream.value()
+        yield 'project', project
+
+def redraw_after_script():
+    # An open project redraws just the areas its edits touched
+    if ziggle_state.project is None:
+        ziggle_state.fig.canvas.draw_idle()
 
 def submit_command():
     command = command_input.get("1.0", tk.END).strip()
@@ -836,7 +5317,7 @@ def submit_command():
                 if cmd:
                     process_zigglescript_command(cmd)
             command_input.delete("1.0", tk.END)
-            ziggle_state.fig.canvas.draw_idle()
+            redraw_after_script()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to process command: {str(e)}")
     else:
@@ -844,60 +5325,355 @@ def submit_command():
 
 def process_zigglescript_command(command):
     try:
-        command_parts = command.split()
-        command_name = " ".join(command_parts[:2])
-
-        json_path = get_json_path()
-        with open(json_path, 'r') as json_file:
-            command_data = json.load(json_file)
-            command_definitions = command_data['commands']
+        result = run_zigglescript_command(command)
+        if result is not None:
+            messagebox.showinfo("Query", f"{command}: {result}")
+    except json.JSONDecodeError as e:
+        messagebox.showerror("JSON Error", f"Failed to parse JSON: {str(e)}")
+    except Exception as e:
+        messagebox.showerror("Command Error", f"Failed to process command: {str(e)}")
 
-        if command_name not in command_definitions:
-            raise ValueError(f"Unknown command: {command_name}")
+def run_zigglescript_command(command):
+    """
+    Run one ZiggleScript command, raising on errors instead of showing
+    dialogs. Queries such as COUNT WHERE return their answer.
+    """
+    command_parts = command.split()
+    if command_parts[0] in GENERATOR_COMMANDS:
+        command_name = command_parts[0]
+    else:
+        command_name = " ".join(command_parts[:2])
 
-        cmd_def = command_definitions[command_name]
-        parameters = command_parts[2:]
+    command_definitions = load_command_definitions()
 
-        if command_name == "CREATE TEXT":
-            params = parameters
-            x1, x2, y1, y2 = params[:4]
-            text = ' '.join(params[4:-2]).strip('"')
-            color = params[-2]
-            font_size = params[-1]
-            create_text(float(x1), float(x2), float(y1), float(y2), text, color, int(font_size))
+    if command_name not in command_definitions:
+        raise ValueError(f"Unknown command: {command_name}")
 
-        elif command_name == "CREATE RECTANGLE":
-            x1, x2, y1, y2, color, *options = parameters
-            filled = "FILLED" in options
-            create_rectangle(float(x1), float(x2), float(y1), float(y2), color.strip('"'), filled)
+    cmd_def = command_definitions[command_name]
+    parameters = command_parts[2:]
 
-        elif command_name == "CREATE LINE":
-            parameters = [param.strip('"') for param in parameters]
-            x1, y1, x2, y2, color = parameters
-            create_line(float(x1), float(y1), float(x2), float(y2), color)
+    if command_name in GENERATOR_COMMANDS:
+        # Expanded as arrays and inserted in one batch, never shape by shape
+        add_script_batch(*expand_script_batch(command_parts))
+        return
 
-        elif command_name == "CREATE CIRCLE":
-            x, y, radius, color, *options = parameters
-            filled = "FILLED" in options
-            create_circle(float(x), float(y), float(radius), color.strip('"'), filled)
+    elif command_name.startswith("CREATE "):
+        if command_name == "CREATE POLYLINE":
+            element_type, element = 'polylines', parse_polyline(parameters)
+        else:
+            element_type, coords, attrs = parse_create_batch(command_name, parameters)
+            if len(coords) > 1:
+                add_script_batch(element_type, coords, attrs)
+                return
+            element = elements_from_coords(element_type, coords, attrs)[0]
+        add_script_element(element_type, element)
 
+        # Keep the parsed shape so undo and redo replay it without parsing again
         ziggle_state.undo_stack.append({
             'command': command_name,
-            'parameters': parameters
+            'type': element_type,
+            'element': element
         })
+        return
+
+    elif command_name.startswith("LAYER "):
+        process_layer_command(command_name, ' '.join(parameters).strip('"'))
+        return
+
+    elif command_name in ("SELECT WHERE", "COUNT WHERE", "DELETE WHERE"):
+        return process_query_command(command_name, [param.strip('"') for param in parameters])
+
+    elif command_name.startswith("SELECT "):
+        process_select_command(command_name, [param.strip('"') for param in parameters])
+        return
+
+    elif command_name.startswith("TRANSFORM "):
+        process_transform_command(command_name, [param.strip('"') for param in parameters])
+        return
+
+    elif command_name.startswith("HISTORY "):
+        project = ziggle_state.project
+        if project is None:
+            raise ValueError("History commands need an open project")
+        if command_name == "HISTORY GOTO":
+            project.goto_history(int(parameters[0]))
+        elif command_name == "HISTORY UNDO":
+            project.undo_last_action()
+        elif command_name == "HISTORY REDO":
+            project.redo_last_action()
+        return
+
+    elif command_name == "IMPORT SVG":
+        project = ziggle_state.project
+        if project is None:
+            raise ValueError("Importing needs an open project")
+        project.import_svg(' '.join(parameters).strip('"'))
+        return
+
+    elif command_name == "EXPORT PREVIEW":
+        project = ziggle_state.project
+        if project is None:
+            raise ValueError("Previews need an open project")
+        size = int(parameters[-1])
+        if size <= 0:
+            raise ValueError("Preview size must be positive")
+        project.export_preview(' '.join(parameters[:-1]).strip('"'), size)
+        return
+
+    elif command_name.startswith("COMPACT "):
+        project = ziggle_state.project
+        if project is None:
+            raise ValueError("Compaction needs an open project")
+        project.compact_scene([project.active_layer] if command_name == "COMPACT LAYER" else None)
+        return
+
+@functools.lru_cache(maxsize=None)
+def load_command_definitions():
+    # Read once instead of on every command of a long script
+    with open(get_json_path(), 'r') as json_file:
+        return json.load(json_file)['commands']
+
+def parse_script_numbers(token):
+    """A number, or a start:stop:step range expanded like numpy.arange."""
+    if ':' in token:
+        start, stop, step = (float(part) for part in token.split(':'))
+        return np.arange(start, stop, step)
+    return np.array([float(token)])
+
+def parse_create_batch(command_name, parameters):
+    """
+    Parse a CREATE command into (element_type, coords, attrs). Numeric
+    parameters may be ranges; ranges in one command are zipped, so
+    CREATE LINE 0:100:10 0 0:100:10 100 black draws ten lines.
+    """
+    parameters = [param.strip('"') for param in parameters]
+
+    if command_name == "CREATE TEXT":
+        element_type = 'texts'
+        numbers = parameters[:4]
+        attrs = {
+            'text': ' '.join(parameters[4:-2]),
+            'color': parameters[-2],
+            'font_size': parameters[-1]
+        }
+    elif command_name == "CREATE RECTANGLE":
+        element_type = 'rectangles'
+        numbers = parameters[:4]
+        attrs = {'color': parameters[4], 'filled': "FILLED" in parameters[5:]}
+    elif command_name == "CREATE LINE":
+        element_type = 'lines'
+        numbers = parameters[:4]
+        color, = parameters[4:]
+        attrs = {'color': color}
+    elif command_name == "CREATE CIRCLE":
+        element_type = 'circles'
+        numbers = parameters[:3]
+        attrs = {'color': parameters[3], 'filled': "FILLED" in parameters[4:]}
+    elif command_name == "CREATE POLYLINE":
+        raise ValueError("CREATE POLYLINE draws one polyline and cannot take ranges or generators")
+    else:
+        raise ValueError(f"Unknown command: {command_name}")
 
-    except json.JSONDecodeError as e:
-        messagebox.showerror("JSON Error", f"Failed to parse JSON: {str(e)}")
-    except Exception as e:
-        messagebox.showerror("Command Error", f"Failed to process command: {str(e)}")
+    columns = [parse_script_numbers(token) for token in numbers]
+    count = max(len(column) for column in columns)
+    if any(len(column) not in (1, count) for column in columns):
+        raise ValueError("Ranges in one command must have the same length")
+
+    coords = np.column_stack([np.broadcast_to(column, count) for column in columns])
+    return element_type, coords, attrs
+
+def parse_polyline(parameters):
+    """Parse CREATE POLYLINE x1 y1 x2 y2 ... color into a PolylineShape."""
+    parameters = [param.strip('"') for param in parameters]
+    if len(parameters) < 5 or len(parameters) % 2 == 0:
+        raise ValueError("CREATE POLYLINE takes x y pairs of at least two points, then a color")
+    return PolylineShape([float(value) for value in parameters[:-1]], parameters[-1])
+
+def expand_script_batch(command_parts):
+    """
+    Expand a generator command around a CREATE command (or another generator)
+    into one coordinate array:
+        REPEAT n dx dy <command>
+        GRID nx ny dx dy <command>
+        ARRAY n cx cy [sweep_degrees] <command>
+    """
+    keyword = command_parts[0]
+    if keyword == "CREATE":
+        return parse_create_batch(" ".join(command_parts[:2]), command_parts[2:])
+
+    if keyword == "REPEAT":
+        count, dx, dy = int(command_parts[1]), float(command_parts[2]), float(command_parts[3])
+        element_type, coords, attrs = expand_script_batch(command_parts[4:])
+        offsets = np.arange(count)[:, None] * np.array([dx, dy])
+
+    elif keyword == "GRID":
+        nx, ny = int(command_parts[1]), int(command_parts[2])
+        dx, dy = float(command_parts[3]), float(command_parts[4])
+        element_type, coords, attrs = expand_script_batch(command_parts[5:])
+        ix, iy = np.meshgrid(np.arange(nx), np.arange(ny))
+        offsets = np.column_stack((ix.ravel() * dx, iy.ravel() * dy))
+
+    elif keyword == "ARRAY":
+        count, cx, cy = int(command_parts[1]), float(command_parts[2]), float(command_parts[3])
+        body = command_parts[4:]
+        sweep = 360.0
+        if body and body[0] not in GENERATOR_COMMANDS + ("CREATE",):
+            sweep = float(body[0])
+            body = body[1:]
+        element_type, coords, attrs = expand_script_batch(body)
+
+        # A full turn spaces copies evenly; a partial sweep includes both ends
+        if sweep % 360 == 0:
+            angles = np.arange(count) * sweep / count
+        else:
+            angles = np.linspace(0, sweep, count)
+        coords = np.concatenate([
+            transform_coords(element_type, coords, 'rotate', (angle,), (cx, cy))
+            for angle in angles
+        ])
+        return element_type, coords, attrs
+
+    else:
+        raise ValueError(f"Unknown generator: {keyword}")
+
+    # One offset per copy, broadcast over every coordinate of the template
+    copies = np.repeat(coords[None, :, :], len(offsets), axis=0)
+    copies[:, :, X_COLUMNS[element_type]] += offsets[:, 0, None, None]
+    copies[:, :, Y_COLUMNS[element_type]] += offsets[:, 1, None, None]
+    return element_type, copies.reshape(-1, coords.shape[1]), attrs
+
+def elements_from_coords(element_type, coords, attrs):
+    shape_type = SHAPE_TYPES[element_type]
+    return [shape_type(*row, **attrs) for row in coords.tolist()]
+
+def add_script_batch(element_type, coords, attrs):
+    elements = elements_from_coords(element_type, coords, attrs)
+    if ziggle_state.project is not None:
+        ziggle_state.project.commit_elements(element_type, elements)
+    else:
+        add_element_artists(ziggle_state.ax, {element_type: elements})
+
+def add_script_element(element_type, element):
+    # Scripted shapes belong to the open project's active layer
+    if ziggle_state.project is not None:
+        ziggle_state.project.commit_element(element_type, element)
+    else:
+        draw_element(ziggle_state.ax, element_type, element)
+
+def process_layer_command(command_name, layer_name):
+    project = ziggle_state.project
+    if project is None:
+        raise ValueError("Layer commands need an open project")
+
+    if command_name == "LAYER ADD":
+        project.add_layer(layer_name or None)
+        return
+
+    layer = project.get_layer(layer_name)
+    if layer is None:
+        raise ValueError(f"Unknown layer: {layer_name}")
+
+    if command_name == "LAYER SELECT":
+        project.set_active_layer(layer.id)
+    elif command_name == "LAYER SHOW":
+        project.set_layer_visible(layer, True)
+    elif command_name == "LAYER HIDE":
+        project.set_layer_visible(layer, False)
+    elif command_name == "LAYER LOCK":
+        project.set_layer_locked(layer, True)
+    elif command_name == "LAYER UNLOCK":
+        project.set_layer_locked(layer, False)
+
+def process_select_command(command_name, parameters):
+    project = ziggle_state.project
+    if project is None:
+        raise ValueError("Selection commands need an open project")
+
+    if command_name == "SELECT ALL":
+        project.select()
+    elif command_name == "SELECT NONE":
+        project.clear_selection()
+    elif command_name == "SELECT BOX":
+        x1, x2, y1, y2 = map(float, parameters)
+        project.select(box=(min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2)))
+    elif command_name == "SELECT COLOR":
+        project.select(color=parameters[0])
+    elif command_name == "SELECT TYPE":
+        project.select([normalize_element_type(name) for name in parameters])
+
+def parse_where(parameters):
+    """
+    The filters of a WHERE clause as select keywords, from any of
+    TYPE types... COLOR color INSIDE x1 x2 y1 y2, in any order.
+    """
+    clauses = {}
+    keyword = None
+    for token in parameters:
+        if token.upper() in ("TYPE", "COLOR", "INSIDE"):
+            keyword = token.upper()
+            if keyword in clauses:
+                raise ValueError(f"{keyword} given twice")
+            clauses[keyword] = []
+        elif keyword is None:
+            raise ValueError(f"Expected TYPE, COLOR or INSIDE, got {token}")
+        else:
+            clauses[keyword].append(token)
+
+    filters = {}
+    if "TYPE" in clauses:
+        if not clauses["TYPE"]:
+            raise ValueError("TYPE needs at least one shape type")
+        filters['element_types'] = [normalize_element_type(name) for name in clauses["TYPE"]]
+    if "COLOR" in clauses:
+        if len(clauses["COLOR"]) != 1:
+            raise ValueError("COLOR takes one color")
+        filters['color'] = check_color(clauses["COLOR"][0])
+    if "INSIDE" in clauses:
+        if len(clauses["INSIDE"]) != 4:
+            raise ValueError("INSIDE takes x1 x2 y1 y2")
+        x1, x2, y1, y2 = map(float, clauses["INSIDE"])
+        filters['box'] = (min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2))
+    return filters
+
+def process_query_command(command_name, parameters):
+    project = ziggle_state.project
+    if project is None:
+        raise ValueError("Query commands need an open project")
+
+    filters = parse_where(parameters)
+    if command_name == "SELECT WHERE":
+        project.select(**filters)
+    elif command_name == "COUNT WHERE":
+        return project.count_elements(**filters)
+    elif command_name == "DELETE WHERE":
+        if not filters:
+            raise ValueError("DELETE WHERE needs at least one filter")
+        project.delete_elements(**filters)
+
+def process_transform_command(command_name, parameters):
+    project = ziggle_state.project
+    if project is None:
+        raise ValueError("Transform commands need an open project")
+
+    if command_name == "TRANSFORM RECOLOR":
+        project.transform_selection('recolor', parameters[0])
+        return
+
+    values = [float(param) for param in parameters]
+    if command_name == "TRANSFORM MOVE":
+        dx, dy = values
+        project.transform_selection('move', dx, dy)
+    elif command_name in ("TRANSFORM SCALE", "TRANSFORM ROTATE"):
+        # Optional trailing cx cy; defaults to the selection's centre
+        center = tuple(values[1:3]) if len(values) >= 3 else None
+        operation = 'scale' if command_name == "TRANSFORM SCALE" else 'rotate'
+        project.transform_selection(operation, values[0], center=center)
 
 def undo_last_command():
     global ziggle_state
     if ziggle_state.undo_stack:
         last_command = ziggle_state.undo_stack.pop()
         ziggle_state.redo_stack.append(last_command)
-        command_name = last_command['command']
-        parameters = last_command['parameters']
 
         ziggle_state.ax.clear()
         ziggle_state.ax.grid(True)
@@ -906,17 +5682,7 @@ def undo_last_command():
         ziggle_state.ax.set_aspect('equal')
 
         for command in ziggle_state.undo_stack:
-            cmd_name = command['command']
-            params = command['parameters']
-
-            if cmd_name == "CREATE TEXT":
-                create_text(float(params[0]), float(params[1]), float(params[2]), float(params[3]), params[4], params[5], int(params[6]))
-            elif cmd_name == "CREATE RECTANGLE":
-                create_rectangle(float(params[0]), float(params[1]), float(params[2]), float(params[3]), params[4], "FILLED" in params)
-            elif cmd_name == "CREATE LINE":
-                create_line(float(params[0]), float(params[1]), float(params[2]), float(params[3]), params[4])
-            elif cmd_name == "CREATE CIRCLE":
-                create_circle(float(params[0]), float(params[1]), float(params[2]), params[3], "FILLED" in params)
+            draw_element(ziggle_state.ax, command['type'], command['element'])
 
         ziggle_state.fig.canvas.draw_idle()
 
@@ -925,20 +5691,628 @@ def redo_last_command():
     if ziggle_state.redo_stack:
         last_command = ziggle_state.redo_stack.pop()
         ziggle_state.undo_stack.append(last_command)
-        command_name = last_command['command']
-        parameters = last_command['parameters']
-
-        if command_name == "CREATE TEXT":
-            create_text(float(parameters[0]), float(parameters[1]), float(parameters[2]), float(parameters[3]), parameters[4], parameters[5], int(parameters[6]))
-        elif command_name == "CREATE RECTANGLE":
-            create_rectangle(float(parameters[0]), float(parameters[1]), float(parameters[2]), float(parameters[3]), parameters[4], "FILLED" in parameters)
-        elif command_name == "CREATE LINE":
-            create_line(float(parameters[0]), float(parameters[1]), float(parameters[2]), float(parameters[3]), parameters[4])
-        elif command_name == "CREATE CIRCLE":
-            create_circle(float(parameters[0]), float(parameters[1]), float(parameters[2]), parameters[3], "FILLED" in parameters)
+
+        draw_element(ziggle_state.ax, last_command['type'], last_command['element'])
 
         ziggle_state.fig.canvas.draw_idle()
 
+class BackgroundReader:
+    """
+    Reads a file without blocking Tk. A thread of the shared background_pool
+    turns it into items in a small bounded queue, so it never runs far ahead
+    of the screen; the Tk thread handles them from root.after in time-boxed
+    slices and reports progress. Subclasses provide items(), handle() and
+    done().
+    """
+    # Errors that end the read and are reported instead of raised
+    errors = (OSError, ValueError)
+
+    def __init__(self, project, path, poll_ms=15, time_budget=0.025):
+        self.project = project
+        self.path = path
+        self.poll_ms = poll_ms
+        self.time_budget = time_budget
+
+        self.queue = queue.Queue(maxsize=4)
+        self.cancelled = threading.Event()
+        self.fraction = 0.0
+        self.error = None
+        self.future = None
+        self.on_progress = None
+        self.on_done = None
+
+    def items(self):
+        raise NotImplementedError
+
+    def handle(self, item):
+        raise NotImplementedError
+
+    def done(self):
+        raise NotImplementedError
+
+    def run(self):
+        """Read on the calling thread, for use without a Tk root."""
+        try:
+            with self.project.batch_paint():
+                for item in self.items():
+                    self.handle(item)
+        except self.errors as e:
+            self.error = e
+        self.finish()
+
+    def start(self):
+        # Reads of other projects may hold every worker; items are drained once this one gets a turn
+        self.future = background_pool.submit(self._read)
+        self.project.root.after(self.poll_ms, self.drain)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def _read(self):
+        try:
+            for item in self.items():
+                if not self._put(('item', item)):
+                    return
+        except self.errors as e:
+            self._put(('error', e))
+            return
+        self._put(('done',))
+
+    def _put(self, message):
+        # Waits for the Tk thread to catch up, unless the read was cancelled
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def drain(self):
+        """Handle read items on the Tk thread for at most time_budget seconds."""
+        deadline = time.perf_counter() + self.time_budget
+        finished = self.cancelled.is_set()
+
+        while not finished and time.perf_counter() < deadline:
+            try:
+                message = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == 'item':
+                # Painted per item, so the deadline covers the drawing too
+                with self.project.batch_paint():
+                    self.handle(message[1])
+            else:
+                finished = True
+                if message[0] == 'error':
+                    self.error = message[1]
+
+        if self.on_progress is not None:
+            self.on_progress(self.fraction)
+        if finished:
+            self.finish()
+        else:
+            self.project.root.after(1 if not self.queue.empty() else self.poll_ms, self.drain)
+
+    def finish(self):
+        self.cancelled.set()
+        self.done()
+        if self.on_done is not None:
+            self.on_done()
+
+class SvgImport(BackgroundReader):
+    """Streams an SVG file into a layer, in chunks of chunk_size shapes."""
+    errors = (ET.ParseError, OSError, ValueError)
+
+    def __init__(self, project, path, layer, chunk_size=500, poll_ms=15, time_budget=0.025):
+        super().__init__(project, path, poll_ms, time_budget)
+        self.layer = layer
+        self.chunk_size = chunk_size
+        self.imported = empty_elements()
+
+    def items(self):
+        return iter_svg_shapes(self.path, self.project.height_val, self.chunk_size, self.cancelled)
+
+    def handle(self, item):
+        self.fraction, chunk = item
+        self.add(chunk)
+
+    def add(self, chunk):
+        self.project.add_imported_elements(self.layer, chunk)
+        for element_type, items in chunk.items():
+            self.imported[element_type].extend(items)
+
+    def done(self):
+        self.project.finish_import(self)
+
+class ProjectLoad(BackgroundReader):
+    """
+    Streams a saved project into the open window, so the canvas and tools
+    can be used before a large project has been read. Layers are added as
+    they are reached and stay locked until their shapes are all in.
+    """
+    def __init__(self, project, path, chunk_size=500, poll_ms=15, time_budget=0.025):
+        super().__init__(project, path, poll_ms, time_budget)
+        self.chunk_size = chunk_size
+        self.layers = []
+        # Lock flags as saved, restored once loading is done
+        self.locked = {}
+        self.fields = {}
+        self.count = 0
+        # Whether shape types arrived other than in DRAW_ORDER, as older files store them
+        self.out_of_order = False
+        self.last_drawn = {}
+
+    def items(self):
+        return iter_project_file(self.path, self.chunk_size)
+
+    def handle(self, item):
+        if item[0] == 'layer':
+            _, index, fields = item
+            layer = Layer.from_dict(dict(fields, name=fields.get('name', f"Layer {index + 1}")))
+            self.locked[layer] = layer.locked
+            layer.locked = True
+            self.layers.append(layer)
+            self.project.add_loaded_layer(self, layer)
+        elif item[0] == 'shapes':
+            _, index, self.fraction, chunk = item
+            for rank, element_type in enumerate(DRAW_ORDER):
+                if chunk[element_type]:
+                    self.out_of_order |= rank < self.last_drawn.get(index, 0)
+                    self.last_drawn[index] = rank
+            self.project.add_imported_elements(self.layers[index], chunk)
+            self.count += sum(len(items) for items in chunk.values())
+        else:
+            self.fields = item[1]
+
+    def done(self):
+        self.project.finish_load(self)
+
+class ScriptJob:
+    """
+    Runs a ZiggleScript program on the Tk thread in time-boxed slices from
+    root.after, so a long program keeps the window responsive and reports
+    its progress. Errors are collected rather than shown one by one, and a
+    cancelled program is rolled back to where it started.
+    """
+    def __init__(self, project, commands, time_budget=0.025):
+        self.project = project
+        self.commands = commands
+        self.time_budget = time_budget
+
+        self.position = 0
+        self.errors = []
+        self.results = []
+        self.cancelled = False
+        self.started = None
+        self.after_id = None
+        self.mark = project.script_mark()
+        self.on_progress = None
+        self.on_done = None
+
+    def rate(self):
+        """Commands run per second so far."""
+        elapsed = time.perf_counter() - self.started if self.started is not None else 0
+        return self.position / elapsed if elapsed > 0 else 0.0
+
+    def run(self):
+        """Run every command on the calling thread, for use without a Tk root."""
+        self.started = time.perf_counter()
+        with self.project.batch_paint():
+            while self.position < len(self.commands):
+                self.step()
+        redraw_after_script()
+        self.finish()
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.after_id = self.project.root.after_idle(self.slice)
+
+    def step(self):
+        command = self.commands[self.position]
+        self.position += 1
+        try:
+            # The project may be behind another tab by now
+            with self.project.current():
+                result = run_zigglescript_command(command)
+            if result is not None:
+                self.results.append(f"{command}: {result}")
+        except Exception as e:
+            self.errors.append(f"{command}: {e}")
+
+    def slice(self):
+        """Run commands for at most time_budget seconds."""
+        self.after_id = None
+        deadline = time.perf_counter() + self.time_budget
+        with self.project.batch_paint():
+            while self.position < len(self.commands) and time.perf_counter() < deadline:
+                self.step()
+        redraw_after_script()
+
+        if self.on_progress is not None:
+            self.on_progress(self)
+        if self.position < len(self.commands):
+            self.after_id = self.project.root.after(1, self.slice)
+        else:
+            self.finish()
+
+    def cancel(self):
+        if self.project.script_job is not self:
+            return
+        if self.after_id is not None:
+            self.project.root.after_cancel(self.after_id)
+            self.after_id = None
+        self.cancelled = True
+        try:
+            self.project.rollback_script(self.mark)
+        except ValueError as e:
+            logger.error(f"Could not roll back the cancelled script: {e}")
+        self.finish()
+
+    def finish(self):
+        self.project.finish_script(self)
+        if self.on_done is not None:
+            self.on_done()
+
+class CommandServer:
+    """
+    Accepts ZiggleScript from other processes while the Tk app runs.
+
+    Clients connect to a localhost port (or a Unix socket) and send one batch
+    per line, with commands separated by '<>' as in the command input. An
+    asyncio loop on a background thread only reads batches into a thread-safe
+    queue; the Tk thread drains that queue from root.after in time-boxed
+    slices and answers each batch with one JSON line, with the answers of
+    any queries such as COUNT WHERE in order:
+        {"batch": 1, "applied": 998, "errors": ["...", "..."], "results": [42]}
+    """
+    def __init__(self, root, host='127.0.0.1', port=DEFAULT_COMMAND_PORT, socket_path=None,
+                 poll_ms=15, time_budget=0.025):
+        self.root = root
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.poll_ms = poll_ms
+        self.time_budget = time_budget
+
+        self.pending = queue.Queue()
+        self.current = None
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.after_id = None
+        self.start_error = None
+
+    def start(self):
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._serve, args=(ready,),
+                                       name="ziggle-command-server", daemon=True)
+        self.thread.start()
+        ready.wait()
+        if self.start_error is not None:
+            raise self.start_error
+
+        self.after_id = self.root.after(self.poll_ms, self.drain)
+        logger.info(f"Listening for ZiggleScript on {self.socket_path or f'{self.host}:{self.port}'}")
+
+    def stop(self):
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+
+    def _serve(self, ready):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            if self.socket_path:
+                start = asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+            else:
+                start = asyncio.start_server(self.handle_client, self.host, self.port)
+            self.server = self.loop.run_until_complete(start)
+        except OSError as e:
+            self.start_error = e
+            self.loop.close()
+            ready.set()
+            return
+
+        ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            self.loop.close()
+            if self.socket_path and os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    async def handle_client(self, reader, writer):
+        # Batches are acknowledged in order while later ones are still being read
+        acks = asyncio.Queue()
+        ack_task = asyncio.ensure_future(self.send_acks(acks, writer))
+        batch_id = 0
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                commands = [cmd.strip() for cmd in line.decode('utf-8').replace('<>', '\n').splitlines()]
+                commands = [cmd for cmd in commands if cmd]
+                if not commands:
+                    continue
+
+                batch_id += 1
+                done = self.loop.create_future()
+                self.pending.put((commands, done))
+                await acks.put((batch_id, done))
+        finally:
+            await acks.put(None)
+            await ack_task
+            writer.close()
+
+    async def send_acks(self, acks, writer):
+        while True:
+            item = await acks.get()
+            if item is None:
+                return
+            batch_id, done = item
+            result = await done
+            writer.write((json.dumps({'batch': batch_id, **result}) + '\n').encode('utf-8'))
+            try:
+                await writer.drain()
+            except ConnectionError:
+                return
+
+    def drain(self):
+        """Apply queued commands on the Tk thread for at most time_budget seconds."""
+        deadline = time.perf_counter() + self.time_budget
+        project = ziggle_state.project
+        applied = False
+
+        with project.batch_paint() if project is not None else contextlib.nullcontext():
+            while time.perf_counter() < deadline:
+                if self.current is None:
+                    try:
+                        commands, done = self.pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    self.current = (iter(commands), done, {'applied': 0, 'errors': [], 'results': []})
+
+                commands, done, result = self.current
+                for command in commands:
+                    applied = True
+                    try:
+                        answer = run_zigglescript_command(command)
+                        result['applied'] += 1
+                        if answer is not None:
+                            result['results'].append(answer)
+                    except Exception as e:
+                        result['errors'].append(f"{command}: {e}")
+                    if time.perf_counter() >= deadline:
+                        break
+                else:
+                    self.loop.call_soon_threadsafe(self._resolve, done, result)
+                    self.current = None
+
+        if applied and ziggle_state.fig is not None:
+            redraw_after_script()
+
+        # Come straight back while work is queued, otherwise poll at a relaxed rate
+        busy = self.current is not None or not self.pending.empty()
+        self.after_id = self.root.after(1 if busy else self.poll_ms, self.drain)
+
+    @staticmethod
+    def _resolve(done, result):
+        if not done.done():
+            done.set_result(result)
+
+class HeadlessCanvas(FigureCanvasAgg):
+    """
+    Agg canvas of a GraphPlot without Tk. Like the Tk canvas it defers
+    draw_idle, so however many redraws the handlers of one event ask for,
+    draw_pending draws the figure once.
+    """
+    pending = False
+
+    def draw_idle(self, *args, **kwargs):
+        self.pending = True
+
+    def draw_pending(self):
+        if self.pending:
+            self.pending = False
+            self.draw()
+
+def open_session(path, mode):
+    # Sessions ending in .gz are gzipped
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+class SessionRecorder:
+    """
+    Writes the canvas input of an editing session to a JSON Lines file for
+    replay_session. The first line holds the project state, figure size and
+    view the session starts from; then every canvas event follows with its
+    time since the start, preceded by the tool state whenever a toolbar,
+    dialog or the layers panel changed it in between. The last line holds
+    the scene digest the session ended with. Edits made other than on the
+    canvas, such as commands or undo, are not recorded and make a replay
+    end on a different digest.
+    """
+    def __init__(self, project, path):
+        self.project = project
+        self.path = path
+        self.count = 0
+        self.tool_state = None
+        fig, ax = project.state.fig, project.state.ax
+        header = {
+            'session': 1,
+            'state': project.project_state(),
+            'size': fig.get_size_inches().tolist(),
+            'dpi': fig.dpi,
+            'xlim': list(ax.get_xlim()),
+            'ylim': list(ax.get_ylim()),
+            'use_raster_cache': project.use_raster_cache,
+            'digest': project.scene_digest()
+        }
+        self.file = open_session(path, 'w')
+        self.write(header)
+        self.start = time.perf_counter()
+        logger.info(f"Recording session to {path}")
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry, separators=(',', ':')) + "\n")
+
+    def record(self, event):
+        t = round(time.perf_counter() - self.start, 6)
+        state = self.project.tool_state()
+        if state != self.tool_state:
+            self.tool_state = state
+            self.write({'t': t, 'tool': state})
+
+        entry = {'t': t, 'event': event.name}
+        if event.name == 'resize_event':
+            entry['size'] = self.project.state.fig.get_size_inches().tolist()
+        else:
+            # Scroll events carry 'up' or 'down' rather than a mouse button
+            button = event.button
+            entry.update(x=event.x, y=event.y, key=event.key, step=event.step, dblclick=event.dblclick,
+                         button=int(button) if isinstance(button, MouseButton) else button)
+            if event.inaxes is not None:
+                # Taken from the unrounded position, which x and y no longer hold
+                entry.update(xdata=float(event.xdata), ydata=float(event.ydata))
+        self.write(entry)
+        self.count += 1
+
+    def close(self):
+        self.write({'t': round(time.perf_counter() - self.start, 6), 'events': self.count,
+                    'digest': self.project.scene_digest()})
+        self.file.close()
+        logger.info(f"Recorded {self.count} events to {self.path}")
+
+def replay_session(path):
+    """
+    Feed a session written by SessionRecorder back into a headless GraphPlot
+    on an Agg canvas, as fast as possible, in a scratch directory so the
+    projects on disk stay untouched. Each event is timed from dispatch until
+    its handlers have run and the frame they asked for is drawn. Returns a report with every
+    event's latency in milliseconds, per event type statistics, and the
+    final scene digest next to the recorded one. Handlers that raise are
+    logged and counted, and the replay goes on.
+    """
+    with open_session(path, 'r') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    if not entries or entries[0].get('session') != 1:
+        raise ValueError(f"{path} is not a recorded session")
+    header, entries = entries[0], entries[1:]
+    footer = entries.pop() if entries and 'event' not in entries[-1] and 'tool' not in entries[-1] else {}
+    state = header['state']
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            # The recorded state loads like a saved project
+            project_dir = os.path.join("project", state['name'])
+            os.makedirs(project_dir)
+            with open(os.path.join(project_dir, "project_state.json"), 'w') as f:
+                json.dump(state, f)
+            project = GraphPlot(None, state['name'], state['id'], state['width'], state['height'])
+
+            fig, ax = project.state.fig, project.state.ax
+            canvas = fig.canvas
+            project.use_raster_cache = header['use_raster_cache']
+            fig.set_dpi(header['dpi'])
+            fig.set_size_inches(header['size'])
+            project.redraw_project_elements()
+            ax.set_xlim(header['xlim'])
+            ax.set_ylim(header['ylim'])
+            project.refresh_view()
+            canvas.draw_pending()
+            if project.scene_digest() != header['digest']:
+                logger.warning("Replay starts from a different scene than was recorded")
+
+            latencies = []
+            errors = 0
+            for index, entry in enumerate(entries):
+                if 'tool' in entry:
+                    project.set_tool_state(entry['tool'])
+                    continue
+                name = entry['event']
+                started = time.perf_counter()
+                if name == 'resize_event':
+                    fig.set_size_inches(entry['size'])
+                    event = ResizeEvent(name, canvas)
+                else:
+                    button = entry['button']
+                    event = MouseEvent(name, canvas, entry['x'], entry['y'],
+                                       MouseButton(button) if isinstance(button, int) else button,
+                                       entry['key'], step=entry['step'], dblclick=entry['dblclick'])
+                    if 'xdata' in entry and event.inaxes is not None:
+                        event.xdata, event.ydata = entry['xdata'], entry['ydata']
+                try:
+                    canvas.callbacks.process(name, event)
+                    canvas.draw_pending()
+                except Exception as e:
+                    # Tk reports a failing handler and carries on with the next event
+                    errors += 1
+                    logger.warning(f"Replayed {name} at {entry['t']:.3f} s failed: {e}")
+                latencies.append((name, entry['t'], (time.perf_counter() - started) * 1000))
+            digest = project.scene_digest()
+        finally:
+            os.chdir(cwd)
+
+    by_event = {}
+    for name in SESSION_EVENTS:
+        times = np.array([ms for event, _, ms in latencies if event == name])
+        if len(times):
+            by_event[name] = {
+                'count': len(times),
+                'mean_ms': round(float(times.mean()), 3),
+                'p50_ms': round(float(np.percentile(times, 50)), 3),
+                'p95_ms': round(float(np.percentile(times, 95)), 3),
+                'max_ms': round(float(times.max()), 3)
+            }
+    return {
+        'session': path,
+        'events': len(latencies),
+        'total_ms': round(sum(ms for _, _, ms in latencies), 3),
+        'by_event': by_event,
+        'errors': errors,
+        'digest': digest,
+        'recorded_digest': footer.get('digest'),
+        'latencies': [[name, t, round(ms, 3)] for name, t, ms in latencies]
+    }
+
+def replay_main(path, report_path=None, slowest=10):
+    """Command line replay: print a summary, optionally save the report, and fail on a changed scene."""
+    try:
+        report = replay_session(path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Could not replay {path}: {e}", file=sys.stderr)
+        return 2
+
+    print(f"Replayed {report['events']} events in {report['total_ms']:.1f} ms, {report['errors']} failed")
+    for name, stats in report['by_event'].items():
+        print(f"  {name:22} {stats['count']:6d}  mean {stats['mean_ms']:8.2f}  p50 {stats['p50_ms']:8.2f}"
+              f"  p95 {stats['p95_ms']:8.2f}  max {stats['max_ms']:8.2f} ms")
+    ranked = sorted(enumerate(report['latencies']), key=lambda item: item[1][2], reverse=True)
+    for index, (name, t, ms) in ranked[:slowest]:
+        print(f"  slow: #{index} {name} at {t:.3f} s: {ms:.2f} ms")
+    print(f"Scene digest {report['digest']}")
+
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=4)
+    if report['errors']:
+        return 1
+    if report['recorded_digest'] is not None and report['digest'] != report['recorded_digest']:
+        print(f"Scene differs from the recording, which ended on {report['recorded_digest']}", file=sys.stderr)
+        return 1
+    return 0
+
 def create_command_buttons(root):
     command_frame = tk.Frame(root)
     command_frame.pack(side=tk.TOP, fill=tk.X)
@@ -1063,6 +6437,27 @@ def ask_for_project_details(root):
 
     recent_projects_listbox.bind('<Double-1>', on_project_select)
 
+    # Preview of the selected project, from the image written on save
+    preview_label = tk.Label(sidebar, bg='#2c3e50')
+    preview_label.pack(pady=10)
+
+    def on_project_highlight(event):
+        selection = recent_projects_listbox.curselection()
+        if not selection:
+            return
+        figure_path = os.path.join("project", recent_projects[selection[0]]['name'], "project_figure.png")
+        try:
+            image = tk.PhotoImage(file=figure_path)
+        except tk.TclError:
+            preview_label.config(image='')
+            preview_label.image = None
+            return
+        factor = max(1, math.ceil(max(image.width(), image.height()) / PREVIEW_SIZE))
+        preview_label.image = image.subsample(factor)
+        preview_label.config(image=preview_label.image)
+
+    recent_projects_listbox.bind('<<ListboxSelect>>', on_project_highlight)
+
     # Main content frame (right side)
     main_content = tk.Frame(main_container, bg='#f0f4f8')
     main_content.pack(side=tk.RIGHT, expand=True, fill=tk.BOTH, padx=40, pady=40)
@@ -1211,9 +6606,18 @@ def ensure_project_directory():
     return index_path
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ziggle drawing editor")
+    parser.add_argument("--replay", metavar="SESSION",
+                        help="replay a recorded session headless and report per-event latency")
+    parser.add_argument("--report", metavar="JSON", help="with --replay, also write the full report here")
+    args = parser.parse_args()
+    if args.replay:
+        sys.exit(replay_main(args.replay, args.report))
+
     root = tk.Tk()
     root.title("Welcome to Ziggle")
     root.geometry("1280x720")
 
     ask_for_project_details(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    workspace.shutdown()
\ No newline at end of file